@@ -1,18 +1,136 @@
 import os
 import gc
 import time
-import csv
 
 import numpy as np
 import pandas as pd
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
+from tensorflow.keras.utils import Sequence
 
 from bionet.config import (classes,
                            workers, max_queue_size, use_multiprocessing,
                            contrast_level, image_size, interpolation_names,
                            perturbation_columns
                           )
-from bionet.preparation import stochastic_perturbations, get_noise_preprocessor
+from bionet.cache import PerturbedImageCache, CachedImageSequence
+from bionet.results import write_predictions, MetricsWriter
+from bionet.preparation import (stochastic_perturbations, get_noise_preprocessor,
+                                get_batch_perturbation, ImageSeededRNG)
+
+
+class PerturbedImageSequence(Sequence):
+    """Batches of perturbed and normalised test images.
+
+    The perturbation is applied to each batch at once with a vectorised 
+    function from `get_batch_perturbation` rather than image by image through
+    the `preprocessing_function` hook of an `ImageDataGenerator`. Images are 
+    read in order from either arrays (which may be memory-mapped) or a 
+    `DirectoryIterator` created with `shuffle=False`.
+
+    Args:
+        perturb (function): Vectorised perturbation for images in the range [0, 255].
+        x (np.ndarray): Test images with shape (n_images, n_rows, n_cols, 1).
+        y (np.ndarray): One-hot test labels.
+        source (DirectoryIterator): Unshuffled iterator of unprocessed images from disk.
+        batch_size (int): Number of images per batch (ignored when `source` is given).
+        mean (float): Featurewise mean. If None, samplewise normalisation is used.
+        std (float): Featurewise standard deviation. If None, samplewise normalisation is used.
+    """
+
+    def __init__(self, perturb, x=None, y=None, source=None, batch_size=64, 
+                 mean=None, std=None):
+        if source is None:
+            assert (x is not None) and (y is not None)
+            assert len(x) == len(y)
+            self.n = len(x)
+        else:
+            assert not source.shuffle
+            self.n = source.n
+            batch_size = source.batch_size
+        self.perturb = perturb
+        self.x = x
+        self.y = y
+        self.source = source
+        self.batch_size = batch_size
+        self.mean = mean
+        self.std = std
+
+    def __len__(self):
+        return int(np.ceil(self.n / self.batch_size))
+
+    def get_indices(self, index):
+        """Return the indices of the images in a batch."""
+        start = index * self.batch_size
+        return np.arange(start, min(start + self.batch_size, self.n))
+
+    def get_unprocessed_batch(self, index):
+        if self.source is not None:
+            return self.source[index]
+        indices = self.get_indices(index)
+        return self.x[indices[0]:indices[-1]+1], self.y[indices[0]:indices[-1]+1]
+
+    def standardise(self, images):
+        # Equivalent to ImageDataGenerator.standardize
+        if (self.mean is not None) and (self.std is not None):
+            images -= self.mean
+            images /= (self.std + 1e-6)
+        else:
+            images -= np.mean(images, axis=(1, 2, 3), keepdims=True)
+            images /= (np.std(images, axis=(1, 2, 3), keepdims=True) + 1e-6)
+        return images
+
+    def __getitem__(self, index):
+        images, labels = self.get_unprocessed_batch(index)
+        images = self.perturb(images, indices=self.get_indices(index))
+        return self.standardise(images), labels
+
+
+def calculate_metrics(predictions, y_labels, epsilon=1e-7):
+    """Calculate the loss and accuracy from a set of predicted probabilities.
+
+    This reproduces the categorical cross-entropy and accuracy reported by 
+    `model.evaluate` so that the metrics and the per-image predictions can be
+    derived from a single forward sweep through the network with `model.predict`.
+
+    Args:
+        predictions (np.ndarray): Class probabilities with shape (n_images, n_classes).
+        y_labels (np.ndarray): Integer class labels with shape (n_images,).
+        epsilon (float): Clipping value for the probabilities (as for `tf.keras.backend.epsilon()`).
+
+    Returns:
+        tuple: (loss, accuracy, classifications)
+    """
+    assert len(predictions) == len(y_labels)
+    y_labels = np.asarray(y_labels, dtype=int)
+    # Keras rescales the probabilities to sum to 1 and clips them before taking logs
+    probabilities = predictions.astype(np.float64)
+    probabilities /= np.sum(probabilities, axis=1, keepdims=True)
+    probabilities = np.clip(probabilities, epsilon, 1 - epsilon)
+    loss = -np.mean(np.log(probabilities[np.arange(len(y_labels)), y_labels]))
+    classifications = np.argmax(predictions, axis=1)
+    accuracy = np.mean(classifications == y_labels)
+    return loss, accuracy, classifications
+
+
+def compare_perturbation_results(reference_file, results_file, label=""):
+    """Report the change in accuracy for each perturbation between two results files.
+
+    Args:
+        reference_file (str): Perturbation results of the reference (e.g. float32) model.
+        results_file (str): Perturbation results of the modified (e.g. quantised) model.
+        label (str): Description of the modification to print.
+
+    Returns:
+        pd.DataFrame: The accuracy change by noise type (mean, min and max over levels).
+    """
+    df_reference = pd.read_csv(reference_file)
+    df_results = pd.read_csv(results_file)
+    df_change = df_reference.merge(df_results, on=['Set', 'Noise', 'LI', 'Level'], suffixes=('', '_new'))
+    df_change['Change'] = df_change['Accuracy_new'] - df_change['Accuracy']
+    summary = df_change.groupby('Noise', sort=False)['Change'].agg(['mean', 'min', 'max'])
+    print(f"Accuracy change{' with ' + label if label else ''}:")
+    print(summary.to_string())
+    return summary
 
 
 def test_noise_perturbations(model, sim, noise_types, sim_results_dir="", test_set="",
@@ -25,6 +143,20 @@ def test_noise_perturbations(model, sim, noise_types, sim_results_dir="", test_s
     std = sim["image_std"]
     colour = sim["colour"]
     save_predictions = sim["save_predictions"]
+    # Derive loss, accuracy and predictions from one pass with model.predict
+    single_pass = sim.get("single_pass", False)
+    # Perturb whole batches of images with the vectorised perturbation functions
+    vectorise = sim.get("vectorise_perturbations", False)
+    # Seed the stochastic perturbations for each image (requires vectorisation)
+    seed_per_image = sim.get("seed_per_image", False)
+    if seed_per_image:
+        vectorise = True
+    # Stream perturbed images from a cache shared between models (requires vectorisation)
+    if sim.get("perturbation_cache_dir"):
+        perturbation_cache = PerturbedImageCache(sim["perturbation_cache_dir"])
+        vectorise = True
+    else:
+        perturbation_cache = None
     image_out_dir = sim["image_out_dir"]
     interpolation_name = interpolation_names[sim["interpolation"]]
     model_name = f'{sim["model"]}_{sim["trial"]}'
@@ -68,133 +200,119 @@ def test_noise_perturbations(model, sim, noise_types, sim_results_dir="", test_s
     else:
         y_labels = np.squeeze(np.argmax(y_test, axis=1))
 
-    # Write results file header
-    results_file = os.path.join(sim_results_dir, "metrics", f"{model_name}_perturb_{test_set.lower()}_s{seed}.csv")
-    with open(results_file, 'w') as results:
-        writer = csv.DictWriter(results, fieldnames=perturbation_columns)
-        writer.writeheader()
+    if vectorise and image_out_dir:
+        print("INFO: Saving perturbed images requires the ImageDataGenerator so vectorisation is disabled.")
+        vectorise = False
+        seed_per_image = False
+        perturbation_cache = None
 
-    # TODO: Optionally test (and generate through the ImageDataGenerator) unperturbed images (L0)
+    # Perturbed images are reproducible regardless of the number of workers
+    reproducible = seed_per_image or (perturbation_cache is not None)
 
-    # Loop over types of noise
-    for noise, noise_function, levels in noise_types:
-        print(f"[{model_name}] Perturbing test images with {noise} noise...")
-        print("-" * 80)
+    if vectorise and load_images_from_disk:
+        # Iterator of unprocessed images to be perturbed in batches
+        source_batches = ImageDataGenerator().flow_from_directory(
+            test_images_path,
+            target_size=image_size,
+            color_mode=colour,
+            interpolation=interpolation_name,
+            batch_size=batch,
+            shuffle=False,
+            follow_links=True,
+           )
+    else:
+        source_batches = None
 
-        if noise in stochastic_perturbations:
-            # Set the number of workers to 1 for reproducility as this avoids 
-            # ordering effects when getting batches with stochastic perturbations
-            perturbation_workers = 1
-        else:
-            perturbation_workers = workers
-
-        for l_ind, level in enumerate(levels):
-            print(f"[{l_ind+1:02d}/{len(levels):02d}] level={float(level):6.2f}: ", end='', flush=True)
-
-            t0 = time.time()
-
-            rng = np.random.RandomState(seed=seed+l_ind)  # Ensure a new RNG state for each level
-            prep_image = get_noise_preprocessor(noise, noise_function, level, 
-                                                contrast_level=contrast_level, 
-                                                bg_grey=bg_grey, rng=rng)
-
-
-            # TODO: Check this is still deterministic when parallelised
-            data_gen = ImageDataGenerator(
-                preprocessing_function=prep_image,
-                featurewise_center=featurewise_normalisation, 
-                featurewise_std_normalization=featurewise_normalisation,
-                samplewise_center=samplewise_normalisation,
-                samplewise_std_normalization=samplewise_normalisation,
-                # dtype='float16')
-            )
-
-            if featurewise_normalisation:
-                # data_gen.fit(x_train)  # Set mean and std
-                data_gen.mean = mean
-                data_gen.std = std
-
-            if image_out_dir:  # save_images:
-                perturbation_image_out_dir = os.path.join(image_out_dir, test_set, noise.replace(' ', '_').lower())
-                os.makedirs(perturbation_image_out_dir, exist_ok=True)
-                image_prefix = f"L{l_ind:02d}"
-            else:
-                perturbation_image_out_dir = None
-                image_prefix = ""
-
-            if load_images_from_disk:
-                gen_test = data_gen.flow_from_directory(
-                    test_images_path,  # os.path.join(image_path, 'test'),
-                    target_size=image_size,
-                    color_mode=colour,  # Not needed?
-                    interpolation=interpolation_name,  # Not needed?
-                    batch_size=batch,
-                    shuffle=False,
-                    seed=seed,
-                    save_to_dir=perturbation_image_out_dir,
-                    save_prefix=image_prefix,
-                    follow_links=True,
-    #                 subset=None,
-    #             classes=classes,
-    #             class_mode='categorical',
-                )
-            else:
-                gen_test = data_gen.flow(
-                    x_test, 
-                    y=y_test, 
-                    batch_size=batch,
-                    shuffle=False, 
-                    seed=seed,
-                    save_to_dir=perturbation_image_out_dir,
-                    save_prefix=image_prefix
-                )
-
-            # Evaluate model performance
-            metrics = model.evaluate(gen_test, 
-                                     steps=len(gen_test),
-                                     verbose=0,
-                                     max_queue_size=max_queue_size,
-                                     workers=perturbation_workers,
-                                     use_multiprocessing=use_multiprocessing
-                                    )
-
-            t_elapsed = time.time() - t0
-
-            if train:
-                metrics_dict = {metric: score for metric, score in zip(model.metrics_names, metrics)}
-                print(f"{metrics_dict} [{t_elapsed:.3f}s]")
+    # The results file is only created (from a temporary file) when all the perturbations have been tested
+    results_file = os.path.join(sim_results_dir, "metrics", f"{model_name}_perturb_{test_set.lower()}_s{seed}.csv")
+    metrics_store = sim.get("metrics_store")
+    metrics_writer = MetricsWriter(results_file, perturbation_columns,
+                                   store=os.path.join(metrics_store, "perturb.csv") if metrics_store else None)
+
+    # Closing the writer without an error moves the completed results file into place
+    with metrics_writer:
+        # TODO: Optionally test (and generate through the ImageDataGenerator) unperturbed images (L0)
+
+        # Loop over types of noise
+        for noise, noise_function, levels in noise_types:
+            print(f"[{model_name}] Perturbing test images with {noise} noise...")
+            print("-" * 80)
+
+            if noise in stochastic_perturbations and not reproducible:
+                # Set the number of workers to 1 for reproducility as this avoids 
+                # ordering effects when getting batches with stochastic perturbations
+                perturbation_workers = 1
             else:
-                print(f"{metrics} [{t_elapsed:.3f}s]")
-
-
-            if save_predictions:
-
-                # NOTE: The results from randomised perturbations do not match 
-                # those calculated from the predictions because .evaluate and
-                # .predict appear to use generators differently
-                # Precise values for Uniform, Salt & Pepper and Phase scrambling
-                # are unreproducible. This is likely due to using multiple workers
-                # with the ImageDataGenerator. 
-
-                # TODO: Alternatively, generate the same mask for each image
-                rng = np.random.RandomState(seed=seed+l_ind)
-                prep_image = get_noise_preprocessor(noise, noise_function, level,
-                                                    contrast_level=contrast_level,
-                                                    bg_grey=bg_grey, rng=rng)
-
-                data_gen = ImageDataGenerator(
-                    preprocessing_function=prep_image,
-                    featurewise_center=featurewise_normalisation, 
-                    featurewise_std_normalization=featurewise_normalisation,
-                    samplewise_center=samplewise_normalisation,
-                    samplewise_std_normalization=samplewise_normalisation,
-                    # dtype='float16'
-                )
-                if featurewise_normalisation:
-                    data_gen.mean = mean
-                    data_gen.std = std
-
-                if load_images_from_disk:
+                perturbation_workers = workers
+
+            for l_ind, level in enumerate(levels):
+                print(f"[{l_ind+1:02d}/{len(levels):02d}] level={float(level):6.2f}: ", end='', flush=True)
+
+                t0 = time.time()
+
+                if seed_per_image:
+                    # Each image has its own stream so batches may be generated in any order
+                    rng = ImageSeededRNG(seed, l_ind)
+                else:
+                    rng = np.random.RandomState(seed=seed+l_ind)  # Ensure a new RNG state for each level
+
+                if vectorise:
+                    prep_image = get_batch_perturbation(noise, level, 
+                                                        contrast_level=contrast_level, 
+                                                        bg_grey=bg_grey, rng=rng)
+                    data_gen = None
+                else:
+                    prep_image = get_noise_preprocessor(noise, noise_function, level, 
+                                                        contrast_level=contrast_level, 
+                                                        bg_grey=bg_grey, rng=rng)
+
+                    # TODO: Check this is still deterministic when parallelised
+                    data_gen = ImageDataGenerator(
+                        preprocessing_function=prep_image,
+                        featurewise_center=featurewise_normalisation, 
+                        featurewise_std_normalization=featurewise_normalisation,
+                        samplewise_center=samplewise_normalisation,
+                        samplewise_std_normalization=samplewise_normalisation,
+                        # dtype='float16')
+                    )
+
+                    if featurewise_normalisation:
+                        # data_gen.fit(x_train)  # Set mean and std
+                        data_gen.mean = mean
+                        data_gen.std = std
+
+                if image_out_dir:  # save_images:
+                    perturbation_image_out_dir = os.path.join(image_out_dir, test_set, noise.replace(' ', '_').lower())
+                    os.makedirs(perturbation_image_out_dir, exist_ok=True)
+                    image_prefix = f"L{l_ind:02d}"
+                else:
+                    perturbation_image_out_dir = None
+                    image_prefix = ""
+
+                if vectorise:
+                    gen_test = PerturbedImageSequence(prep_image, x=x_test, y=y_test, 
+                                                      source=source_batches, batch_size=batch, 
+                                                      mean=mean, std=std)
+                    if perturbation_cache is not None:
+                        # Everything which determines the perturbed and normalised images
+                        cache_params = {"test_set": test_set, "n_images": gen_test.n, 
+                                        "test_images_path": (os.path.realpath(test_images_path) 
+                                                             if load_images_from_disk else None),
+                                        "dtype": perturbation_cache.dtype.name,
+                                        "colour": colour, "image_size": image_size, 
+                                        "interpolation": interpolation_name,
+                                        "image_mean": mean, "image_std": std, 
+                                        "contrast_level": contrast_level, 
+                                        "noise": noise, "level": float(level), 
+                                        "l_ind": l_ind, "seed": seed, 
+                                        "seed_per_image": seed_per_image}
+                        cache_key = perturbation_cache.get_key(**cache_params)
+                        if cache_key not in perturbation_cache:
+                            print("(caching) ", end='', flush=True)
+                        images, labels = perturbation_cache.fetch(cache_key, gen_test, 
+                                                                  params=cache_params)
+                        gen_test = CachedImageSequence(images, labels, batch_size=batch)
+                elif load_images_from_disk:
                     gen_test = data_gen.flow_from_directory(
                         test_images_path,  # os.path.join(image_path, 'test'),
                         target_size=image_size,
@@ -203,67 +321,155 @@ def test_noise_perturbations(model, sim, noise_types, sim_results_dir="", test_s
                         batch_size=batch,
                         shuffle=False,
                         seed=seed,
-                        save_to_dir=None,
+                        save_to_dir=perturbation_image_out_dir,
+                        save_prefix=image_prefix,
                         follow_links=True,
+        #                 subset=None,
+        #             classes=classes,
+        #             class_mode='categorical',
                     )
                 else:
-                    gen_test = data_gen.flow(x_test, y=y_test, batch_size=batch,
-                                             shuffle=False, seed=seed, save_to_dir=None)
-
-                predictions = model.predict(gen_test, 
-                                            steps=len(gen_test),
-                                            verbose=0,
-                                            max_queue_size=max_queue_size,
-                                            workers=perturbation_workers,
-                                            use_multiprocessing=use_multiprocessing)
-
-                predictions_file = os.path.join(sim_results_dir, 'predictions', 
-                                                f'{model_name}_perturb_{test_set.lower()}_s{seed}' \
-                                                f'_{noise.replace(" ", "_").lower()}_L{l_ind:02d}.csv')
-
-                classifications = np.argmax(predictions, axis=1)
-
-                # Check accuracy based on probabilities matches accuracy from .evaluate
-                assert len(classifications) == len(y_labels)
-                accuracy = sum(classifications == y_labels) / len(y_labels)
-                assert np.isclose(accuracy, metrics[1], atol=1e-6), \
-        f"{noise} [{l_ind+1:02d}/{len(levels):02d}]: Calculated: {accuracy} =/= Evaluated: {metrics[1]}"
-
-                # Put predictions into DataFrame
-                df_noise = pd.DataFrame(predictions, columns=classes)
-                df_noise["Predicted"] = classifications
-                df_noise["Class"] = y_labels
-                df_noise["Correct"] = classifications == y_labels
-                df_noise["Image"] = range(len(y_labels))
-                df_noise["Noise"] = [noise] * len(y_labels)
-                df_noise["LI"] = [l_ind] * len(y_labels)
-                df_noise["Level"] = [level] * len(y_labels)
-
-                df_noise.to_csv(predictions_file, index=False)
-
-                del predictions
-
-            if save_predictions:
-                acc = accuracy  # Manual calculation is more accurate, probably due to rounding errors
-            else:
-                acc = metrics[1]
-
-            # perturbation_columns = ['Model', 'Convolution', 'Base', 'Weights', 'Trial', 'Seed',
-            #                         'Set', 'Noise', 'LI', 'Level', 'Loss', 'Accuracy']
-
-            row = {'Model': sim["model"], 'Convolution': sim["convolution"],
-                   'Base': sim["base"], 'Weights': str(sim["weights"]),
-                   'Trial': sim["trial"], 'Seed': seed,
-                   'Set': test_set, 'Noise': noise, 'LI': l_ind, 'Level': level,
-                   'Loss': metrics[0], 'Accuracy': acc}
-            with open(results_file, 'a') as results:
-                writer = csv.DictWriter(results, fieldnames=perturbation_columns)
-                writer.writerow(row)
-
-            # Clean up after every perturbation level
-            del prep_image
-            del gen_test
-            del data_gen
-            gc.collect()
-
-        print("-" * 80)
+                    gen_test = data_gen.flow(
+                        x_test, 
+                        y=y_test, 
+                        batch_size=batch,
+                        shuffle=False, 
+                        seed=seed,
+                        save_to_dir=perturbation_image_out_dir,
+                        save_prefix=image_prefix
+                    )
+
+                # Evaluate model performance
+                if single_pass:
+                    predictions = model.predict(gen_test, 
+                                                steps=len(gen_test),
+                                                verbose=0,
+                                                max_queue_size=max_queue_size,
+                                                workers=perturbation_workers,
+                                                use_multiprocessing=use_multiprocessing)
+                    loss, accuracy, classifications = calculate_metrics(predictions, y_labels)
+                    metrics = [loss, accuracy]
+                else:
+                    metrics = model.evaluate(gen_test, 
+                                             steps=len(gen_test),
+                                             verbose=0,
+                                             max_queue_size=max_queue_size,
+                                             workers=perturbation_workers,
+                                             use_multiprocessing=use_multiprocessing
+                                            )
+
+                t_elapsed = time.time() - t0
+
+                if train:
+                    metrics_dict = {metric: score for metric, score in zip(model.metrics_names, metrics)}
+                    print(f"{metrics_dict} [{t_elapsed:.3f}s]")
+                else:
+                    print(f"{metrics} [{t_elapsed:.3f}s]")
+
+
+                if save_predictions:
+
+                    if not single_pass and reproducible:
+                        # The perturbations are reproducible so the same sequence can be reused
+                        predictions = model.predict(gen_test, 
+                                                    steps=len(gen_test),
+                                                    verbose=0,
+                                                    max_queue_size=max_queue_size,
+                                                    workers=perturbation_workers,
+                                                    use_multiprocessing=use_multiprocessing)
+
+                    elif not single_pass:
+                        # NOTE: The results from randomised perturbations do not match 
+                        # those calculated from the predictions because .evaluate and
+                        # .predict appear to use generators differently
+                        # Precise values for Uniform, Salt & Pepper and Phase scrambling
+                        # are unreproducible. This is likely due to using multiple workers
+                        # with the ImageDataGenerator. 
+
+                        # NOTE: Use --seed_per_image to generate the same mask for each image
+                        rng = np.random.RandomState(seed=seed+l_ind)
+                        if vectorise:
+                            # Regenerate the evaluated batches (in order) from a fresh RNG
+                            prep_image = get_batch_perturbation(noise, level, 
+                                                                contrast_level=contrast_level, 
+                                                                bg_grey=bg_grey, rng=rng)
+                            gen_test = PerturbedImageSequence(prep_image, x=x_test, y=y_test, 
+                                                              source=source_batches, batch_size=batch, 
+                                                              mean=mean, std=std)
+                        else:
+                            prep_image = get_noise_preprocessor(noise, noise_function, level,
+                                                                contrast_level=contrast_level,
+                                                                bg_grey=bg_grey, rng=rng)
+
+                            data_gen = ImageDataGenerator(
+                                preprocessing_function=prep_image,
+                                featurewise_center=featurewise_normalisation, 
+                                featurewise_std_normalization=featurewise_normalisation,
+                                samplewise_center=samplewise_normalisation,
+                                samplewise_std_normalization=samplewise_normalisation,
+                                # dtype='float16'
+                            )
+                            if featurewise_normalisation:
+                                data_gen.mean = mean
+                                data_gen.std = std
+
+                            if load_images_from_disk:
+                                gen_test = data_gen.flow_from_directory(
+                                    test_images_path,  # os.path.join(image_path, 'test'),
+                                    target_size=image_size,
+                                    color_mode=colour,  # Not needed?
+                                    interpolation=interpolation_name,  # Not needed?
+                                    batch_size=batch,
+                                    shuffle=False,
+                                    seed=seed,
+                                    save_to_dir=None,
+                                    follow_links=True,
+                                )
+                            else:
+                                gen_test = data_gen.flow(x_test, y=y_test, batch_size=batch,
+                                                         shuffle=False, seed=seed, save_to_dir=None)
+
+                        predictions = model.predict(gen_test, 
+                                                    steps=len(gen_test),
+                                                    verbose=0,
+                                                    max_queue_size=max_queue_size,
+                                                    workers=perturbation_workers,
+                                                    use_multiprocessing=use_multiprocessing)
+
+                    classifications = np.argmax(predictions, axis=1)
+
+                    # Check accuracy based on probabilities matches accuracy from .evaluate
+                    assert len(classifications) == len(y_labels)
+                    accuracy = sum(classifications == y_labels) / len(y_labels)
+                    assert np.isclose(accuracy, metrics[1], atol=1e-6), \
+            f"{noise} [{l_ind+1:02d}/{len(levels):02d}]: Calculated: {accuracy} =/= Evaluated: {metrics[1]}"
+
+                    write_predictions(os.path.join(sim_results_dir, 'predictions', 'perturb'),
+                                      {'Model': sim["model"], 'Trial': sim["trial"], 'Seed': seed,
+                                       'Set': test_set, 'Noise': noise, 'LI': l_ind},
+                                      predictions, y_labels, columns={'Level': level})
+
+                if save_predictions or single_pass:
+                    acc = accuracy  # Manual calculation is more accurate, probably due to rounding errors
+                    del predictions
+                else:
+                    acc = metrics[1]
+
+                # perturbation_columns = ['Model', 'Convolution', 'Base', 'Weights', 'Trial', 'Seed',
+                #                         'Set', 'Noise', 'LI', 'Level', 'Loss', 'Accuracy']
+
+                row = {'Model': sim["model"], 'Convolution': sim["convolution"],
+                       'Base': sim["base"], 'Weights': str(sim["weights"]),
+                       'Trial': sim["trial"], 'Seed': seed,
+                       'Set': test_set, 'Noise': noise, 'LI': l_ind, 'Level': level,
+                       'Loss': metrics[0], 'Accuracy': acc}
+                metrics_writer.writerow(row)
+
+                # Clean up after every perturbation level
+                del prep_image
+                del gen_test
+                del data_gen
+                gc.collect()
+
+            print("-" * 80)
+
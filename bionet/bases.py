@@ -45,7 +45,9 @@ from tensorflow.python.lib.io import file_io
 from tensorflow.python.util.tf_export import keras_export
 
 # from tensorflow.python.keras.applications.resnet import stack1  # block1, block2, stack2, block3, stack3
-from bionet.utils import GaborInitializer, DifferenceOfGaussiansInitializer, LowPassInitializer
+from bionet.utils import (GaborInitializer, DifferenceOfGaussiansInitializer, LowPassInitializer,
+                          select_frontend_conv)
+from bionet.config import fft_kernel_threshold
 
 
 layers = None
@@ -63,6 +65,8 @@ def BioResNet(stack_fn,
               pooling=None,
               classes=1000,
               classifier_activation='softmax',
+              fft_threshold=fft_kernel_threshold,
+              separable=False,
               **kwargs):
     """Instantiates the ResNet, ResNetV2, and ResNeXt architecture.
     Args:
@@ -105,6 +109,10 @@ def BioResNet(stack_fn,
           `classifier_activation=None` to return the logits of the "top" layer.
           When loading pretrained weights, `classifier_activation` can only
           be `None` or `"softmax"`.
+        fft_threshold: bio-inspired kernels at least this large are convolved
+          with `FFTConv2D` (`0` or `None` always uses `Conv2D`).
+        separable: whether to convolve low-rank (low-pass and DoG) kernels
+          with 1-D passes (`SeparableKernelConv2D`).
         **kwargs: For backwards compatibility only.
     Returns:
         A `keras.Model` instance.
@@ -182,7 +190,10 @@ def BioResNet(stack_fn,
 
             # Input shape: (batch, rows, cols, channels)
             # Output shape: (batch, new_rows, new_cols, filters)
-            x = layers.Conv2D(n_kernels, params['ksize'], #padding='same',
+            ksize = params['ksize']
+            conv, conv_kwargs = select_frontend_conv(ksize, kernel_initializer, fft_threshold,
+                                                     separable) or (layers.Conv2D, {})
+            x = conv(n_kernels, ksize, **conv_kwargs, #padding='same',
                     activation='relu', use_bias=True,
                     #    activation=None, use_bias=use_bias, strides=2, padding='valid',
                     name=f"{layer_type.lower()}_conv",
@@ -0,0 +1,501 @@
+import os
+import json
+import hashlib
+import functools
+import contextlib
+
+import numpy as np
+import cv2
+from numpy.lib.format import open_memmap
+from tensorflow.keras.datasets import cifar10
+from tensorflow.keras.utils import Sequence, to_categorical
+
+from bionet.config import (perturbation_cache_dtype, perturbation_cache_max_size, 
+                           luminance_weights, n_classes, image_size, interpolation_names)
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+
+@contextlib.contextmanager
+def build_lock(path):
+    """Hold an exclusive lock (on `<path>.lock`) while building a shared artefact.
+
+    Processes started together (e.g. by the sweep scheduler) wait for the
+    first one to build the artefact then load it rather than each building
+    their own copy, so callers should check again for the artefact once the
+    lock is acquired.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(f"{path}.lock", 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_cache_key(**params):
+    """Return a content hash for a set of (JSON serialisable) parameters.
+
+    The parameters are sorted by name so the key does not depend on the order
+    in which they are given.
+    """
+    serialised = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(serialised.encode("utf-8")).hexdigest()
+
+
+class PerturbedImageCache:
+    """Content-addressed cache of perturbed and normalised test images.
+
+    Each entry is stored under `cache_dir` as a pair of `.npy` files (images
+    and one-hot labels) named by the hash of the parameters which determine
+    the perturbed images, with a JSON manifest of those parameters. Entries are
+    written to temporary files then renamed so concurrent processes never read
+    a partially written entry. Images are loaded as read-only memory maps.
+
+    Each 224x224 CIFAR10 level takes 2 GB as float32, so when `max_size` is
+    set the least recently used entries are removed after storing a new one
+    to keep the cache within that many GB.
+
+    Args:
+        cache_dir (str): Directory to store the cached tensors in.
+        dtype: The data type to store the perturbed images as.
+        max_size (float): Maximum size of the cache in GB (None or 0 for no limit).
+    """
+
+    def __init__(self, cache_dir, dtype=perturbation_cache_dtype, max_size=perturbation_cache_max_size):
+        self.cache_dir = cache_dir
+        self.dtype = np.dtype(dtype)
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, **params):
+        params.setdefault("dtype", self.dtype.name)
+        return get_cache_key(**params)
+
+    def get_paths(self, key):
+        stem = os.path.join(self.cache_dir, key)
+        return {"images": f"{stem}_images.npy",
+                "labels": f"{stem}_labels.npy",
+                "manifest": f"{stem}.json"}
+
+    def __contains__(self, key):
+        # The manifest is written last so marks a complete entry
+        return os.path.isfile(self.get_paths(key)["manifest"])
+
+    def load(self, key):
+        """Return memory-mapped images and labels for a key or None if not cached."""
+        if key not in self:
+            return None
+        paths = self.get_paths(key)
+        os.utime(paths["manifest"])  # Mark the entry as recently used
+        images = np.load(paths["images"], mmap_mode='r')
+        labels = np.load(paths["labels"])
+        return images, labels
+
+    def get_entries(self):
+        """Return the (key, size in bytes, last used time) of each complete entry, oldest first."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-len(".json")]
+            paths = self.get_paths(key)
+            try:
+                size = sum(os.path.getsize(path) for path in paths.values())
+                last_used = os.path.getmtime(paths["manifest"])
+            except FileNotFoundError:  # Removed by another process
+                continue
+            entries.append((key, size, last_used))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def remove(self, key):
+        # Remove the manifest first so the entry is no longer considered complete
+        for name in ("manifest", "images", "labels"):
+            path = self.get_paths(key)[name]
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def prune(self, max_size=None, keep=()):
+        """Remove the least recently used entries until the cache is within `max_size` GB.
+
+        Args:
+            max_size (float): Size limit in GB (defaults to `self.max_size`, 0 removes everything).
+            keep (tuple): Keys not to remove.
+
+        Returns:
+            int: The number of bytes removed.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return 0
+        entries = self.get_entries()
+        total = sum(size for _, size, _ in entries)
+        limit = max_size * 1024**3
+        removed = 0
+        for key, size, _ in entries:
+            if total - removed <= limit:
+                break
+            if key in keep:
+                continue
+            self.remove(key)
+            removed += size
+        if removed:
+            print(f"Removed {removed / 1024**3:.1f} GB of perturbed images from {self.cache_dir}")
+        return removed
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        return self.prune(max_size=0)
+
+    def store(self, key, sequence, params=None):
+        """Write the batches of a sequence to the cache and return the memory-mapped entry.
+
+        Args:
+            key (str): The key returned by `get_key`.
+            sequence (Sequence): Batches of (images, labels) to cache in order.
+            params (dict): Parameters to record in the manifest.
+
+        Returns:
+            tuple: The cached (images, labels).
+        """
+        paths = self.get_paths(key)
+        suffix = f".{os.getpid()}.tmp"
+        images = None
+        labels = []
+        start = 0
+        try:
+            for index in range(len(sequence)):
+                x_batch, y_batch = sequence[index]
+                if images is None:
+                    shape = (sequence.n,) + x_batch.shape[1:]
+                    images = open_memmap(paths["images"] + suffix, mode='w+',
+                                         dtype=self.dtype, shape=shape)
+                images[start:start+len(x_batch)] = x_batch
+                labels.append(y_batch)
+                start += len(x_batch)
+            assert start == sequence.n, f"Cached {start} of {sequence.n} images!"
+            images.flush()
+            del images
+            with open(paths["labels"] + suffix, 'wb') as labels_file:
+                np.save(labels_file, np.concatenate(labels))
+            for name in ("images", "labels"):
+                os.replace(paths[name] + suffix, paths[name])
+            with open(paths["manifest"] + suffix, 'w') as manifest:
+                json.dump({"key": key, "dtype": self.dtype.name, "n_images": sequence.n,
+                           "params": params or {}}, manifest, indent=4, default=str)
+            os.replace(paths["manifest"] + suffix, paths["manifest"])
+        finally:
+            for name in paths:
+                if os.path.isfile(paths[name] + suffix):
+                    os.remove(paths[name] + suffix)
+        return self.load(key)
+
+    def fetch(self, key, sequence, params=None):
+        """Load an entry from the cache, generating it from the sequence if missing."""
+        entry = self.load(key)
+        if entry is None:
+            with build_lock(os.path.join(self.cache_dir, key)):
+                entry = self.load(key)  # Stored by another process while waiting
+                if entry is None:
+                    entry = self.store(key, sequence, params=params)
+                    if self.max_size:
+                        self.prune(keep=(key,))
+        return entry
+
+
+class CachedImageSequence(Sequence):
+    """Batches of (images, labels) read in order from cached arrays."""
+
+    def __init__(self, images, labels, batch_size=64, dtype=np.float32):
+        assert len(images) == len(labels)
+        self.images = images
+        self.labels = labels
+        self.n = len(images)
+        self.batch_size = batch_size
+        self.dtype = dtype
+
+    def __len__(self):
+        return int(np.ceil(self.n / self.batch_size))
+
+    def __getitem__(self, index):
+        start = index * self.batch_size
+        stop = min(start + self.batch_size, self.n)
+        return (np.asarray(self.images[start:stop], dtype=self.dtype),
+                self.labels[start:stop])
+
+
+def upscale_images(images, out, image_size=image_size, interpolation=4):
+    """Write luminance images upscaled with OpenCV into a preallocated array.
+
+    Args:
+        images (np.ndarray): Luminance images with shape (n_images, n_rows, n_cols).
+        out (np.ndarray): Array (which may be memory-mapped) with shape (n_images, *image_size, 1).
+        image_size (tuple): Size of the upscaled images.
+        interpolation (int): OpenCV interpolation code (0: nearest, 4: lanczos).
+
+    Returns:
+        np.ndarray: The clipped, upscaled images in `out`.
+    """
+    assert len(images) == len(out)
+    for i, image in enumerate(images):
+        if interpolation:
+            upscaled = cv2.resize(image, dsize=image_size, interpolation=interpolation)
+        else:  # Equivalent to cv2.INTER_NEAREST (or PIL.Image.NEAREST)
+            factor = image_size[0] // image.shape[0]
+            upscaled = image.repeat(factor, axis=0).repeat(factor, axis=1)
+        out[i, :, :, 0] = np.clip(upscaled, 0, 255)
+    return out
+
+
+def get_cifar10_store_dir(store_dir, interpolation, image_size=image_size):
+    name = f"CIFAR10_{image_size[0]}x{image_size[1]}_{interpolation_names[interpolation]}"
+    return os.path.join(store_dir, name)
+
+
+def build_cifar10_store(store_dir, interpolation=4, image_size=image_size, 
+                        dtype=np.float16):
+    """Write the luminance-converted, upscaled and clipped CIFAR10 images to disk.
+
+    The train and test images are written once for each interpolation method
+    as `.npy` files which can be memory-mapped, along with one-hot labels and
+    a JSON manifest (written last to mark the store as complete).
+
+    Args:
+        store_dir (str): Root directory of the dataset stores.
+        interpolation (int): OpenCV interpolation code (0: nearest, 4: lanczos).
+        image_size (tuple): Size of the upscaled images.
+        dtype: The data type of the stored images.
+
+    Returns:
+        str: The directory of the store.
+    """
+    cifar10_dir = get_cifar10_store_dir(store_dir, interpolation, image_size)
+    os.makedirs(cifar10_dir, exist_ok=True)
+    suffix = f".{os.getpid()}.tmp"
+    dtype = np.dtype(dtype)
+
+    print(f'Building CIFAR10 store with "{interpolation}" ({interpolation_names[interpolation]}) '
+          f'interpolation in {cifar10_dir}...')
+    (x_train, y_train), (x_test, y_test) = cifar10.load_data()  # RGB format
+    manifest = {"data_set": "CIFAR10", "image_size": list(image_size), 
+                "interpolation": interpolation, "dtype": dtype.name,
+                "luminance_rgb_weights": luminance_weights.tolist(), "arrays": {}}
+    for subset, images, labels in (("train", x_train, y_train), ("test", x_test, y_test)):
+        images = np.dot(images, luminance_weights)
+        x_path = os.path.join(cifar10_dir, f"x_{subset}.npy")
+        y_path = os.path.join(cifar10_dir, f"y_{subset}.npy")
+        x_out = open_memmap(x_path + suffix, mode='w+', dtype=dtype, 
+                            shape=(len(images), *image_size, 1))
+        upscale_images(images, x_out, image_size=image_size, interpolation=interpolation)
+        x_out.flush()
+        del x_out
+        with open(y_path + suffix, 'wb') as labels_file:
+            np.save(labels_file, to_categorical(labels, num_classes=n_classes, dtype='uint8'))
+        os.replace(x_path + suffix, x_path)
+        os.replace(y_path + suffix, y_path)
+        manifest["arrays"][subset] = {"n_images": len(images), 
+                                      "shape": [len(images), *image_size, 1]}
+
+    manifest_file = os.path.join(cifar10_dir, "manifest.json")
+    with open(manifest_file + suffix, 'w') as mf:
+        json.dump(manifest, mf, indent=4)
+    os.replace(manifest_file + suffix, manifest_file)
+    return cifar10_dir
+
+
+@functools.lru_cache(maxsize=None)
+def load_cifar10_store(store_dir, interpolation=4, image_size=image_size):
+    """Open the upscaled CIFAR10 images as read-only memory maps, building them if missing.
+
+    Memory-mapping the arrays allows processes on the same node to share the 
+    pages of the images rather than each holding their own copy.
+
+    Returns:
+        tuple: ((x_train, y_train), (x_test, y_test))
+    """
+    image_size = tuple(image_size)
+    cifar10_dir = get_cifar10_store_dir(store_dir, interpolation, image_size)
+    if not os.path.isfile(os.path.join(cifar10_dir, "manifest.json")):
+        with build_lock(cifar10_dir):
+            if not os.path.isfile(os.path.join(cifar10_dir, "manifest.json")):
+                build_cifar10_store(store_dir, interpolation=interpolation, image_size=image_size)
+    x_train = np.load(os.path.join(cifar10_dir, "x_train.npy"), mmap_mode='r')
+    y_train = np.load(os.path.join(cifar10_dir, "y_train.npy"))
+    x_test = np.load(os.path.join(cifar10_dir, "x_test.npy"), mmap_mode='r')
+    y_test = np.load(os.path.join(cifar10_dir, "y_test.npy"))
+    return (x_train, y_train), (x_test, y_test)
+
+
+def get_statistics_path(cache_dir, data_set, interpolation, colour, image_size=image_size, source=None):
+    """Return the path of the cached training statistics for a dataset and its preprocessing.
+
+    `source` identifies the images of datasets loaded from disk (e.g. their 
+    resolved path and number) so datasets with the same name do not share statistics.
+    """
+    stem = f"{data_set.lower()}_{interpolation}_{colour}_{image_size[0]}x{image_size[1]}"
+    if source is not None:
+        stem += f"_{get_cache_key(source=source)[:12]}"
+    return os.path.join(cache_dir, f"{stem}.json")
+
+
+def load_statistics(cache_dir, data_set, interpolation, colour, image_size=image_size, source=None):
+    """Return the cached (mean, std) of the training images or None if not cached."""
+    path = get_statistics_path(cache_dir, data_set, interpolation, colour, image_size, source)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as sf:
+        statistics = json.load(sf)
+    return statistics["mean"], statistics["std"]
+
+
+def store_statistics(cache_dir, mean, std, data_set, interpolation, colour, image_size=image_size, 
+                     source=None):
+    """Store the (mean, std) of the training images for a dataset and its preprocessing."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = get_statistics_path(cache_dir, data_set, interpolation, colour, image_size, source)
+    suffix = f".{os.getpid()}.tmp"
+    with open(path + suffix, 'w') as sf:
+        json.dump({"data_set": data_set, "interpolation": interpolation, "colour": colour,
+                   "image_size": list(image_size), "source": source, "mean": mean, "std": std}, 
+                  sf, indent=4, default=str)
+    os.replace(path + suffix, path)
+    return path
+
+
+def cache_features(frontend, batches, n_images, path, quantise=False, n_calibration=8):
+    """Compute the responses of a frozen front-end to a set of images and store them on disk.
+
+    The features are written to a memory-mapped `.npy` file (via a temporary
+    file) with the labels and a JSON manifest. When quantised, the (ReLU) 
+    responses are stored as uint8 with a scale for each channel set from the 
+    maximum response over the first `n_calibration` batches (larger responses
+    saturate). Otherwise they are stored as float16.
+
+    Args:
+        frontend (tf.keras.Model): The frozen front-end (see `utils.split_frontend`).
+        batches: Unshuffled, unaugmented batches of normalised (images, labels).
+        n_images (int): The number of images in `batches`.
+        path (str): Path of the features file (ending in `.npy`).
+        quantise (bool): Store the features as uint8.
+        n_calibration (int): Number of batches to calibrate the quantisation scales with.
+
+    Returns:
+        tuple: The cached (features, labels, scales) from `load_features`.
+    """
+    suffix = f".{os.getpid()}.tmp"
+    stem = path[:-len(".npy")] if path.endswith(".npy") else path
+    paths = {"features": f"{stem}.npy", "labels": f"{stem}_labels.npy", "manifest": f"{stem}.json"}
+    features = None
+    labels = []
+    pending = []  # Batches held back until the quantisation scales are calibrated
+    scales = None
+    start = 0
+
+    def write(responses):
+        nonlocal start
+        if quantise:
+            responses = np.clip(np.rint(responses / scales * 255), 0, 255)
+        features[start:start+len(responses)] = responses
+        start += len(responses)
+
+    try:
+        n_seen = 0
+        for images, y_batch in batches:
+            if n_seen >= n_images:  # Guard against repeating iterators
+                break
+            n_seen += len(images)
+            responses = np.asarray(frontend.predict_on_batch(images), dtype=np.float32)
+            labels.append(np.asarray(y_batch))
+            if features is None:
+                features = open_memmap(paths["features"] + suffix, mode='w+',
+                                       dtype=np.uint8 if quantise else np.float16,
+                                       shape=(n_images, *responses.shape[1:]))
+            if quantise and scales is None:
+                pending.append(responses)
+                if len(pending) < n_calibration and n_seen < n_images:
+                    continue
+                scales = np.amax(np.concatenate(pending), axis=(0, 1, 2))
+                scales[scales == 0] = 1
+                for responses in pending:
+                    write(responses)
+                pending = []
+            else:
+                write(responses)
+        assert start == n_images, f"Cached {start} of {n_images} images!"
+        features.flush()
+        del features
+        with open(paths["labels"] + suffix, 'wb') as labels_file:
+            np.save(labels_file, np.concatenate(labels)[:n_images])
+        for name in ("features", "labels"):
+            os.replace(paths[name] + suffix, paths[name])
+        with open(paths["manifest"] + suffix, 'w') as manifest:
+            json.dump({"n_images": n_images, "quantised": quantise,
+                       "scales": None if scales is None else scales.tolist()}, 
+                      manifest, indent=4)
+        os.replace(paths["manifest"] + suffix, paths["manifest"])
+    finally:
+        for name in paths:
+            if os.path.isfile(paths[name] + suffix):
+                os.remove(paths[name] + suffix)
+    return load_features(path)
+
+
+def load_features(path):
+    """Load cached front-end features as a read-only memory map (or None if not cached).
+
+    Returns:
+        tuple: (features, labels, scales) where `scales` is None unless quantised.
+    """
+    stem = path[:-len(".npy")] if path.endswith(".npy") else path
+    if not os.path.isfile(f"{stem}.json"):
+        return None
+    with open(f"{stem}.json") as manifest_file:
+        manifest = json.load(manifest_file)
+    features = np.load(f"{stem}.npy", mmap_mode='r')
+    labels = np.load(f"{stem}_labels.npy")
+    scales = manifest["scales"]
+    if scales is not None:
+        scales = np.array(scales, dtype=np.float32)
+    return features, labels, scales
+
+
+class FeatureSequence(Sequence):
+    """Batches of cached front-end features and labels for training the back-end.
+
+    Quantised features are rescaled with their per-channel `scales`. The order
+    of the images is reshuffled at the end of each epoch if `shuffle` is True.
+    """
+
+    def __init__(self, features, labels, batch_size=64, scales=None, shuffle=False, seed=None):
+        assert len(features) == len(labels)
+        self.features = features
+        self.labels = labels
+        self.n = len(features)
+        self.batch_size = batch_size
+        self.scales = scales
+        self.shuffle = shuffle
+        self.rng = np.random.RandomState(seed)
+        self.index_array = np.arange(self.n)
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(self.n / self.batch_size))
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.index_array = self.rng.permutation(self.n)
+
+    def __getitem__(self, index):
+        indices = self.index_array[index*self.batch_size:(index+1)*self.batch_size]
+        indices = np.sort(indices)  # Faster reads from the memory map
+        features = np.asarray(self.features[indices], dtype=np.float32)
+        if self.scales is not None:
+            features *= self.scales / 255
+        return features, self.labels[indices]
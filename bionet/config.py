@@ -36,6 +36,9 @@ else:
     # image_shape = (32, 32, 1)
 interpolation = cv2.INTER_LANCZOS4
 contrast_level = 1  # Proportion of original contrast level for uniform and salt and pepper noise
+perturbation_cache_dtype = np.float32  # Storage type of cached perturbed (normalised) test images (np.float16 halves the size but rounds the images)
+perturbation_cache_max_size = 100  # GB of cached perturbed images to keep (least recently used entries are removed, 0 for no limit)
+fft_kernel_threshold = 31  # Front-end kernels at least this size are convolved with FFTs (0 disables)
 
 # Map of names to OpenCV (cv2) codes
 interpolation_codes = {
@@ -88,7 +91,7 @@ extension = 'h5'  # For saving model/weights
 # logs_dir = '/work/logs'
 # results_dir = '/work/results'
 
-# image_dir = '/work/data'
+image_dir = '/work/data'
 # TODO: Remove all_test_sets
 # all_test_sets = ['line_drawings', 'silhouettes', 'contours']  # , 'scharr']
 generalisation_types = ['line_drawings', 'silhouettes', 'contours']
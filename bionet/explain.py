@@ -8,33 +8,182 @@ import tensorflow as tf
 # from tensorflow.keras.preprocessing.image import ImageDataGenerator
 import cv2
 from matplotlib import pyplot as plt
-from tf_explain.core.grad_cam import GradCAM
 
 from bionet.preparation import (get_directory_generator, 
                                   get_noise_preprocessor, 
                                   invert_luminance)
 from bionet.utils import load_model, find_conv_layer
-from bionet.config import (luminance_weights, interpolation,
+from bionet.config import (luminance_weights, interpolation, interpolation_names,
                            train_image_stats, 
                            generalisation_sets, generalisation_types,
                            image_dir)
 
 
-mean, std = train_image_stats["cifar10"][interpolation]
+mean, std = train_image_stats["cifar10"][interpolation_names[interpolation]]
+
+
+def infer_grad_cam_layer(model):
+    """Return the name of the last layer with a 4D output (the target layer for Grad-CAM)."""
+    for layer in reversed(model.layers):
+        if len(layer.output.shape) == 4:
+            return layer.name
+    raise ValueError("Model does not contain a 4D layer: Grad-CAM cannot be applied.")
+
+
+def get_grad_cams(model, images, class_indices, layer_name=None, use_guided_grads=True, batch_size=100):
+    """Calculate Grad-CAM class activation maps for a batch of images.
+
+    The maps for each batch are computed with a single compiled gradient pass
+    with respect to the output of the target layer.
+
+    Args:
+        model (tf.keras.Model): The model to explain.
+        images (np.ndarray): (Preprocessed) images of shape (n_images, height, width, channels).
+        class_indices (int or list): The class to explain for all images or for each image.
+        layer_name (str): Target layer (defaults to the last layer with a 4D output).
+        use_guided_grads (bool): Only keep positive gradients where the layer output is positive.
+        batch_size (int): Number of images per gradient pass.
+
+    Returns:
+        np.ndarray: Class activation maps of shape (n_images, layer_height, layer_width).
+    """
+    if layer_name is None:
+        layer_name = infer_grad_cam_layer(model)
+    grad_model = tf.keras.models.Model([model.inputs], [model.get_layer(layer_name).output, model.output])
+    n_classes = model.output.shape[-1]
+    class_indices = np.broadcast_to(class_indices, (len(images),))
+
+    @tf.function
+    def grad_cam_step(inputs, class_mask):
+        with tf.GradientTape() as tape:
+            conv_outputs, predictions = grad_model(inputs, training=False)
+            conv_outputs = tf.cast(conv_outputs, tf.float32)
+            # Each image only contributes the score of its own class
+            loss = tf.reduce_sum(tf.cast(predictions, tf.float32) * class_mask)
+        grads = tape.gradient(loss, conv_outputs)
+        if use_guided_grads:
+            grads = tf.cast(conv_outputs > 0, tf.float32) * tf.cast(grads > 0, tf.float32) * grads
+        weights = tf.reduce_mean(grads, axis=(1, 2), keepdims=True)
+        return tf.reduce_sum(weights * conv_outputs, axis=-1)
+
+    cams = []
+    for start in range(0, len(images), batch_size):
+        inputs = tf.cast(images[start:start+batch_size], tf.float32)
+        class_mask = tf.one_hot(class_indices[start:start+batch_size], n_classes)
+        cams.append(grad_cam_step(inputs, class_mask).numpy())
+    del grad_model
+    return np.concatenate(cams)
+
+
+def render_grad_cam(cam, image, colormap=cv2.COLORMAP_VIRIDIS, image_weight=0.7):
+    """Overlay a class activation map on its image, returning an RGB uint8 image."""
+    heatmap = cv2.resize(cam, (image.shape[1], image.shape[0]))
+    heatmap = (heatmap - np.min(heatmap)) / (np.max(heatmap) - np.min(heatmap))
+    heatmap = cv2.applyColorMap(cv2.cvtColor((heatmap * 255).astype("uint8"), cv2.COLOR_GRAY2BGR),
+                                colormap)
+    image = np.asarray(image)
+    if image.dtype != np.uint8:
+        if image.min() < 0:
+            image = (image + 1.0) / 2.0
+        image = (image * 255).astype("uint8")
+    if image.ndim == 2 or image.shape[-1] == 1:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+    output = cv2.addWeighted(cv2.cvtColor(image, cv2.COLOR_RGB2BGR), image_weight, heatmap, 1, 0)
+    return cv2.cvtColor(output, cv2.COLOR_BGR2RGB)
+
+
+def load_generalisation_images(test_set, invert=False, n_samples=None, rescale=1/255):
+    """Load and normalise the images of a generalisation test set.
+
+    Returns:
+        tuple: (images, class_indices, categories)
+    """
+    if invert:
+        prep_image = get_noise_preprocessor("Invert", invert_luminance, level=1, rescale=rescale)
+    else:
+        prep_image = get_noise_preprocessor("None", rescale=rescale)
+
+    root = os.path.join(image_dir, test_set)
+    categories = sorted(os.listdir(root))
+    images, class_indices = [], []
+    for c_ind, category in enumerate(categories):
+        for s_ind, img in enumerate(sorted(os.listdir(os.path.join(root, category)))):
+            if n_samples is not None and s_ind >= n_samples:
+                break
+            image = plt.imread(os.path.join(root, category, img)) * 255
+            if image.shape == (224, 224):
+                image = image[..., np.newaxis]
+            if image.shape == (224, 224, 3):
+                image = np.dot(image, luminance_weights)[..., np.newaxis]
+            image = prep_image(image)
+            image -= mean
+            image /= std
+            images.append(image)
+            class_indices.append(c_ind)
+    return np.array(images, dtype=np.float32), np.array(class_indices), categories
+
+
+def calculate_grad_cams(data_set, model_names, test_set=None, layer_name=None, batch_size=100,
+                        results_dir="/work/results", fresh=False, image_sets=None, verbose=0):
+    """Calculate (and cache) Grad-CAM maps of the generalisation test sets for one or more models.
+
+    Each test set (upright and inverted) is loaded once and shared between
+    the models. The maps are cached to
+    `<results_dir>/<data_set>/<model_name>/grad_cam/<test_set>[_inverted].npy`.
+    If a dictionary is passed as `image_sets`, the loaded test sets are added
+    to it (keyed by the annotated test set) and any sets it holds are reused.
+
+    Returns:
+        dict: {model_name: {test_set: class activation maps}}
+    """
+    if isinstance(model_names, str):
+        model_names = [model_names]
+    if test_set is None or test_set == 'all':
+        test_sets = generalisation_types
+    else:
+        assert test_set in generalisation_types
+        test_sets = [test_set]
+
+    cams = {model_name: {} for model_name in model_names}
+    models = {}
+    for test_set in test_sets:
+        for invert_test_images in [False, True]:
+            annotated_test_set = f'{test_set}_inverted' if invert_test_images else test_set
+            if image_sets is not None and annotated_test_set in image_sets:
+                images, class_indices, _ = image_sets[annotated_test_set]
+            else:
+                images = None
+            for model_name in model_names:
+                cam_dir = os.path.join(results_dir, data_set, model_name, 'grad_cam')
+                cam_file = os.path.join(cam_dir, f'{annotated_test_set}.npy')
+                if os.path.isfile(cam_file) and not fresh:
+                    cams[model_name][annotated_test_set] = np.load(cam_file)
+                    continue
+                if images is None:
+                    images, class_indices, categories = load_generalisation_images(test_set, invert_test_images)
+                    if image_sets is not None:
+                        image_sets[annotated_test_set] = (images, class_indices, categories)
+                if model_name not in models:
+                    models[model_name] = load_model(data_set, model_name, verbose=verbose)
+                if verbose:
+                    print(f"Calculating Grad-CAM maps for {model_name} on {annotated_test_set}...",
+                          flush=True)
+                cams[model_name][annotated_test_set] = get_grad_cams(models[model_name], images, class_indices,
+                                                                     layer_name=layer_name, batch_size=batch_size)
+                os.makedirs(cam_dir, exist_ok=True)
+                np.save(cam_file, cams[model_name][annotated_test_set])
+    del models
+    return cams
 
 
 def plot_grad_cam(data_set, model_name, test_set=None, image_weight=0.7, fig_sf=2, save_figure=False):
 
-    rescale = 1/255
     n_classes = 10
     n_samples = 10
 
+    image_sets = {}  # Test sets loaded to calculate uncached maps
+    cams = calculate_grad_cams(data_set, model_name, test_set=test_set, image_sets=image_sets)[model_name]
 
-    model = load_model(data_set, model_name)
-
-    # Instantiation of the explainer
-    explainer = GradCAM()
-    
     if test_set is None or test_set == 'all':
         test_sets = generalisation_types
     else:
@@ -42,51 +191,31 @@ def plot_grad_cam(data_set, model_name, test_set=None, image_weight=0.7, fig_sf=
         test_sets = [test_set]
     
     for test_set in test_sets:
-        # root = f'/work/data/{test_set}/'
-        root = os.path.join(image_dir, test_set)
         for invert_test_images in [False, True]:
-            if invert_test_images:
-                prep_image = get_noise_preprocessor("Invert", invert_luminance, level=1, rescale=rescale)
-                annotated_test_set = f'{test_set}_inverted'
+            annotated_test_set = f'{test_set}_inverted' if invert_test_images else test_set
+            if annotated_test_set in image_sets:
+                images, class_indices, categories = image_sets.pop(annotated_test_set)
             else:
-                prep_image = get_noise_preprocessor("None", rescale=rescale)
-                annotated_test_set = f'{test_set}'
+                images, class_indices, categories = load_generalisation_images(test_set, invert_test_images)
 
             fig, axes = plt.subplots(nrows=n_classes, ncols=n_samples, 
                                     figsize=(fig_sf*n_samples, fig_sf*n_classes))
-            i = 0
-            for c_ind, category in enumerate(sorted(os.listdir(root))):
-                for s_ind, img in enumerate(sorted(os.listdir(os.path.join(root, category)))):
-                    if annotated_test_set.startswith('scharr') and s_ind >= 10:
-                        break
-                    full_path = os.path.join(root, category, img)
-                    image = plt.imread(full_path) * 255
-                    if image.shape == (224, 224):
-                        image = image[..., np.newaxis]
-                    if image.shape == (224, 224, 3):
-                        image = np.dot(image, luminance_weights)[..., np.newaxis]
-        #             image = np.squeeze(prep_image(image))
-                    image = prep_image(image)
-                    
-                    image -= mean
-                    image /= std
-
-                    data = ([image], None)
-
-                    # Call to explain() method
-                    output = explainer.explain(data, model, class_index=c_ind, image_weight=image_weight)
-
-                    # print(np.amin(output), np.amax(output))
-                    axes[c_ind, s_ind].imshow(output, vmin=0, vmax=255)  # cmap='gray', 
-                    axes[c_ind, s_ind].set_xticks([])
-                    axes[c_ind, s_ind].set_yticks([])
-                    axes[c_ind, s_ind].get_xaxis().set_visible(False)
-                    axes[c_ind, s_ind].get_yaxis().set_visible(False)
-                    axes[c_ind, s_ind].set_axis_off()
-
-                    if s_ind == 0:
-                        axes[c_ind, s_ind].set_ylabel(category.capitalize())
-                    i += 1
+            for i, (image, cam, c_ind) in enumerate(zip(images, cams[annotated_test_set], class_indices)):
+                s_ind = i - np.searchsorted(class_indices, c_ind)
+                if s_ind >= n_samples:
+                    continue
+                image = np.clip(image * std + mean, 0, 255).astype("uint8")  # Undo the normalisation
+                output = render_grad_cam(cam, image, image_weight=image_weight)
+
+                axes[c_ind, s_ind].imshow(output, vmin=0, vmax=255)  # cmap='gray', 
+                axes[c_ind, s_ind].set_xticks([])
+                axes[c_ind, s_ind].set_yticks([])
+                axes[c_ind, s_ind].get_xaxis().set_visible(False)
+                axes[c_ind, s_ind].get_yaxis().set_visible(False)
+                axes[c_ind, s_ind].set_axis_off()
+
+                if s_ind == 0:
+                    axes[c_ind, s_ind].set_ylabel(categories[c_ind].capitalize())
 
             fig.subplots_adjust(0.02,0.02,0.98,0.98)
             if save_figure:
@@ -94,7 +223,7 @@ def plot_grad_cam(data_set, model_name, test_set=None, image_weight=0.7, fig_sf=
                 os.makedirs(fig_output_dir, exist_ok=True)
                 output = f'{fig_output_dir}/{test_set}{"_invert" if invert_test_images else ""}.png'
                 fig.savefig(output)
-            f"Created figure: {output}"
+                print(f"Created figure: {output}")
 
 
 def get_activations(image_path, data_set, model_name, layer_id=None, verbose=0):
@@ -237,58 +366,116 @@ def plot_activations(image_path, data_set, model_name, layer_name=None, fig_sf=2
     return (fig, axes)
 
 
-def get_occlusion_map(model, image, class_index, patch_size=8):
-
-    # Create function to apply a grey patch on an image
-    def apply_grey_patch(image, top_left_x, top_left_y, patch_size):
-        patched_image = np.array(image, copy=True)
-        patched_image[top_left_y:top_left_y + patch_size, top_left_x:top_left_x + patch_size, :] = 0  # 127.5
-
-        return patched_image
-    
-    # Model to examine
-    # model = tf.keras.applications.resnet50.ResNet50(weights='imagenet', include_top=True)
-    input_shape = model.input.get_shape().as_list()
-
-    # # Image to pass as input
-    # # TODO: replace with the same routines as used elsewhere
-    # img = tf.keras.preprocessing.image.load_img(image, target_size=input_shape[1:-1], #(224, 224), 
-    #                                             color_mode="grayscale", interpolation="lanczos")
-    # img = tf.keras.preprocessing.image.img_to_array(img) # * 255
-
-    # # print(np.amin(img), np.amax(img), flush=True)
-    # # img = np.expand_dims(np.dot(img, luminance_weights), axis=-1)
-    # # cv2.resize(image, dsize=image_size, interpolation=interpolation)
-    # img[img < 0] = 0
-    # img[img > 255] = 255
-
-    # img -= mean
-    # img /= std
-    img = image
-
+def get_occlusion_positions(image_shape, patch_size=8, stride=None):
+    """Return the (top, left) coordinates of each position of the occluding patch.
 
-    # CAT_CLASS_INDEX = 5 #281  # Imagenet tabby cat class index
-    PATCH_SIZE = patch_size  # 16 #32 #40
+    Args:
+        image_shape (tuple): (height, width) of the images.
+        patch_size (int): Side length of the square patch.
+        stride (int): Step between patch positions (at most and defaults to `patch_size`).
 
-    sensitivity_map = np.zeros((img.shape[0], img.shape[1]))
-
-    # Iterate the patch over the image
-    for top_left_x in range(0, img.shape[0], PATCH_SIZE):
-        for top_left_y in range(0, img.shape[1], PATCH_SIZE):
-            patched_image = apply_grey_patch(img, top_left_x, top_left_y, PATCH_SIZE)
-            predicted_classes = model.predict(np.array([patched_image]))[0]
-            confidence = predicted_classes[class_index]
-
-            # Save confidence for this specific patched image in map
-            sensitivity_map[
-                top_left_y:top_left_y + PATCH_SIZE,
-                top_left_x:top_left_x + PATCH_SIZE,
-            ] = confidence
-    
-    return sensitivity_map
-
-
-def plot_occlusion_sensitivity(data_set, model_name, image, class_index, patch_size=8, ax=None, verbose=0):
+    Returns:
+        np.ndarray: Array of shape (n_positions, 2).
+    """
+    if stride is None:
+        stride = patch_size
+    assert patch_size > 0 and stride > 0
+    assert stride <= patch_size, f"A stride of {stride} would leave pixels between the {patch_size}px patches unoccluded!"
+    tops, lefts = np.meshgrid(np.arange(0, image_shape[0], stride),
+                              np.arange(0, image_shape[1], stride), indexing="ij")
+    return np.stack([tops.ravel(), lefts.ravel()], axis=1)
+
+
+def generate_occluded_batches(images, positions, patch_size=8, patch_value=0, batch_size=256):
+    """Yield batches of occluded copies of each image at each patch position.
+
+    The (image, position) pairs are flattened so every batch is full
+    (except the last) regardless of the number of positions per image.
+
+    Args:
+        images (np.ndarray): Batch of images (n_images, height, width, channels).
+        positions (np.ndarray): Patch coordinates from `get_occlusion_positions`.
+        patch_size (int): Side length of the square patch.
+        patch_value (float): Value of the occluded pixels (0 is the mean for normalised images).
+        batch_size (int): Number of occluded images per batch.
+
+    Yields:
+        tuple: (image_indices, position_indices, occluded_images)
+    """
+    n_positions = len(positions)
+    rows = np.arange(images.shape[1])
+    cols = np.arange(images.shape[2])
+    for start in range(0, len(images) * n_positions, batch_size):
+        indices = np.arange(start, min(start + batch_size, len(images) * n_positions))
+        image_indices, position_indices = np.divmod(indices, n_positions)
+        tops, lefts = positions[position_indices].T
+        row_mask = (rows >= tops[:, None]) & (rows < tops[:, None] + patch_size)
+        col_mask = (cols >= lefts[:, None]) & (cols < lefts[:, None] + patch_size)
+        batch = images[image_indices]  # Fancy indexing copies the images
+        batch[row_mask[:, :, None] & col_mask[:, None, :]] = patch_value
+        yield image_indices, position_indices, batch
+
+
+def get_occlusion_maps(model, images, class_indices=None, patch_size=8, stride=None,
+                       patch_value=0, batch_size=256, verbose=0):
+    """Calculate occlusion sensitivity maps for a batch of images and a set of classes.
+
+    A square patch is slid over each image and the model's confidence in each
+    class is recorded for every occluded copy. The occluded copies are
+    predicted in large batches rather than one at a time. Where patches
+    overlap (`stride < patch_size`) each pixel takes the mean confidence of
+    the patches covering it.
+
+    Args:
+        model: A model with a `predict_on_batch` method (e.g. `tf.keras.Model` or `QuantisedModel`).
+        images (np.ndarray): A (preprocessed) image (height, width, channels) or batch of images.
+        class_indices (int or list): Classes to map (defaults to all outputs of the model).
+        patch_size (int): Side length of the square patch.
+        stride (int): Step between patch positions (at most and defaults to `patch_size`).
+        patch_value (float): Value of the occluded pixels.
+        batch_size (int): Number of occluded images to predict at once.
+        verbose (int): Print the number of occluded images.
+
+    Returns:
+        np.ndarray: Maps of shape (n_images, n_classes, height, width).
+    """
+    images = np.asarray(images, dtype=np.float32)
+    if images.ndim == 3:
+        images = images[np.newaxis]
+    assert images.ndim == 4
+    n_images, height, width = images.shape[:3]
+
+    positions = get_occlusion_positions((height, width), patch_size, stride)
+    confidences = None  # (n_images, n_positions, n_classes)
+    if verbose:
+        print(f"Predicting {n_images * len(positions)} occluded images...", flush=True)
+    for image_indices, position_indices, batch in generate_occluded_batches(
+            images, positions, patch_size, patch_value, batch_size):
+        predictions = np.asarray(model.predict_on_batch(batch))
+        if class_indices is None:
+            class_indices = np.arange(predictions.shape[-1])
+        class_indices = np.atleast_1d(class_indices)
+        if confidences is None:
+            confidences = np.zeros((n_images, len(positions), len(class_indices)))
+        confidences[image_indices, position_indices] = predictions[:, class_indices]
+
+    sensitivity_maps = np.zeros((n_images, len(class_indices), height, width))
+    coverage = np.zeros((height, width))
+    for p_ind, (top, left) in enumerate(positions):
+        sensitivity_maps[:, :, top:top + patch_size, left:left + patch_size] \
+            += confidences[:, p_ind, :, np.newaxis, np.newaxis]
+        coverage[top:top + patch_size, left:left + patch_size] += 1
+    return sensitivity_maps / coverage
+
+
+def get_occlusion_map(model, image, class_index, patch_size=8, stride=None, batch_size=256):
+    """Calculate the occlusion sensitivity map of a single image and class (see `get_occlusion_maps`)."""
+    return get_occlusion_maps(model, image, class_index, patch_size=patch_size,
+                              stride=stride, batch_size=batch_size)[0, 0]
+
+
+def plot_occlusion_sensitivity(data_set, model_name, image, class_index, patch_size=8, stride=None,
+                               ax=None, verbose=0):
 
     fig = None
     if ax is None:
@@ -297,7 +484,7 @@ def plot_occlusion_sensitivity(data_set, model_name, image, class_index, patch_s
     print(f"Plotting occlusion sensitivity for {data_set}/{model_name}...")
     model = load_model(data_set, model_name, verbose=verbose)
 
-    sensitivity_map = get_occlusion_map(model, image, class_index, patch_size=8)
+    sensitivity_map = get_occlusion_map(model, image, class_index, patch_size=patch_size, stride=stride)
 
     cmap = ax.imshow(sensitivity_map) #, vmin=0.5, vmax=1)
     ax.set_xticks([])
@@ -310,7 +497,68 @@ def plot_occlusion_sensitivity(data_set, model_name, image, class_index, patch_s
     return cmap #(fig, axes)
 
 
-def get_most_activating_features(model, layer_index, channel_index, epochs=100, step_size=1., seed=None):
+def get_initial_features(n_images, input_shape=(224, 224, 1)):
+    """Return random noise images to start the gradient ascent from (using the numpy RNG)."""
+    input_img_data = np.random.random((n_images, *input_shape))
+    return (input_img_data - 0.5) * 20  #+ 128.
+
+
+def ascend_activations(submodel, input_img_data, channel_indices, epochs=100, step_size=1., batch_size=None):
+    """Optimise a batch of input images to maximise the mean activation of one channel each.
+
+    Image `i` is optimised for channel `channel_indices[i]` and all images are
+    updated together in a single compiled gradient ascent step. Since each
+    image only contributes to its own loss, the (per-image normalised)
+    gradients are the same as optimising each channel separately.
+
+    Args:
+        submodel (tf.keras.Model): Model from the input to the layer of interest.
+        input_img_data (np.ndarray): Initial images, one per channel.
+        channel_indices (list): Channel to maximise for each image.
+        epochs (int): Number of gradient ascent steps.
+        step_size (float): Size of each (normalised) step.
+        batch_size (int): Maximum number of images to optimise at once (defaults to all).
+
+    Returns:
+        np.ndarray: The optimised images.
+    """
+    channel_indices = np.asarray(channel_indices, dtype=np.int32)
+    assert len(channel_indices) == len(input_img_data)
+    n_channels = submodel.output.shape[-1]
+    assert np.all((0 <= channel_indices) & (channel_indices < n_channels))
+
+    @tf.function
+    def ascent_step(images, channel_mask):
+        with tf.GradientTape() as tape:
+            tape.watch(images)
+            outputs = tf.cast(submodel(images, training=False), tf.float32)
+            outputs = tf.reshape(outputs, (tf.shape(outputs)[0], -1, n_channels))
+            # Mean activation of the selected channel of each image
+            loss_value = tf.reduce_sum(tf.reduce_mean(outputs, axis=1) * channel_mask)
+        grads = tape.gradient(loss_value, images)
+        axes = list(range(1, len(images.shape)))
+        normalized_grads = grads / (tf.sqrt(tf.reduce_mean(tf.square(grads), axis=axes, keepdims=True)) + 1e-5)
+        return images + normalized_grads * step_size
+
+    if batch_size is None:
+        batch_size = len(input_img_data)
+    feature_maps = []
+    for start in range(0, len(input_img_data), batch_size):
+        images = tf.cast(input_img_data[start:start+batch_size], tf.float32)
+        channel_mask = tf.one_hot(channel_indices[start:start+batch_size], n_channels)
+        for _ in range(epochs):
+            images = ascent_step(images, channel_mask)
+        feature_maps.append(images.numpy())
+    return np.concatenate(feature_maps)
+
+
+def get_most_activating_features(model, layer_index, channel_index, epochs=100, step_size=1., seed=None,
+                                 batch_size=None):
+    """Return the input maximising the activation of a channel (or list of channels) of a layer.
+
+    When a list of channels is given they are optimised together as a batch
+    and an array of feature maps (one per channel) is returned.
+    """
 
     # Set the RNG seed for reproducibility
     if seed is None:
@@ -318,58 +566,28 @@ def get_most_activating_features(model, layer_index, channel_index, epochs=100,
     assert 0 <= seed < np.iinfo(np.int32).max
     np.random.seed(seed)
 
-    if layer_index >= 0:
-        pass  # Create submodel
-    else:
-        pass  # Skip creating submodel
     # Create submodel
     layer = model.get_layer(index=layer_index)
-    # assert 0 <= channel_index < layer.output.shape[-1]
     submodel = tf.keras.models.Model([model.inputs[0]], [layer.output])
 
-    # out_dir = os.path.join(results_dir, data_set, 'activating_features')
-    # os.makedirs(out_dir, exist_ok=True)
-
-    # maf_filename = os.path.join(out_dir, f'{model_name}_L{layer_index}_C{filter_index}.npy')
-    # if os.path.isfile(maf_filename) and not fresh:
-    #     feature_map = np.load(maf_filename)
-
-    # else:
-
-
+    channel_indices = np.atleast_1d(channel_index)
+    input_shape = tuple(submodel.input.shape[1:])
+    if None in input_shape:
+        input_shape = (224, 224, 1)
     # Initiate random noise
-    # Reinitialise the RNG so specify a filter_index gives the same results
-    # as when one is randomly selected above
-#     np.random.seed(seed)
-    input_img_data = np.random.random((1, 224, 224, 1))
-    input_img_data = (input_img_data - 0.5) * 20 #+ 128.
-    # Cast random noise from np.float64 to tf.float32 Variable
-    input_img_data = tf.Variable(tf.cast(input_img_data, tf.float32))
-
-    # Iterate gradient ascents
-    for _ in range(epochs):
-        with tf.GradientTape() as tape:
-            outputs = submodel(input_img_data)
-            # loss_value = tf.reduce_mean(outputs[:, :, :, channel_index])
-            loss_value = tf.reduce_mean(outputs[..., channel_index])
-        grads = tape.gradient(loss_value, input_img_data)
-        normalized_grads = grads / (tf.sqrt(tf.reduce_mean(tf.square(grads))) + 1e-5)
-        input_img_data.assign_add(normalized_grads * step_size)
-    feature_map = np.squeeze(input_img_data.numpy())
-
-
-        # with open(maf_filename, 'wb') as maf:
-        #     np.save(maf, feature_map)
-
-    
+    input_img_data = get_initial_features(len(channel_indices), input_shape)
+    feature_maps = ascend_activations(submodel, input_img_data, channel_indices,
+                                      epochs=epochs, step_size=step_size, batch_size=batch_size)
     del submodel
-    return feature_map
+    if np.ndim(channel_index) == 0:
+        return np.squeeze(feature_maps[0])
+    return np.squeeze(feature_maps, axis=-1) if feature_maps.shape[-1] == 1 else feature_maps
 
 
 def plot_most_activating_features(data_set, model_name, layer=None, filter_index=None,
                                   epochs=100, step_size=1., seed=None, ax=None,
                                   fig_sf=2, colourbar=True,
-                                  results_dir="/work/results", fresh=False):
+                                  results_dir="/work/results", fresh=False, batch_size=None):
 
     # Set the RNG seed for reproducibility
     if seed is None:
@@ -451,32 +669,26 @@ def plot_most_activating_features(data_set, model_name, layer=None, filter_index
     out_dir = os.path.join(results_dir, data_set, 'activating_features')
     os.makedirs(out_dir, exist_ok=True)
 
-    for ax, filter_index in zip(axes.ravel(), filter_indices):
+    maf_filenames = {filter_index: os.path.join(out_dir, f'{model_name}_L{layer_index}_C{filter_index}.npy')
+                     for filter_index in filter_indices}
+    missing = [filter_index for filter_index in filter_indices
+               if fresh or not os.path.isfile(maf_filenames[filter_index])]
+    if missing:
+        # Optimise all the missing channels together as one batch
+        input_shape = tuple(submodel.input.shape[1:])
+        if None in input_shape:
+            input_shape = (224, 224, 1)
+        input_img_data = get_initial_features(len(missing), input_shape)
+        optimised = ascend_activations(submodel, input_img_data, missing,
+                                       epochs=epochs, step_size=step_size, batch_size=batch_size)
+        for filter_index, feature_map in zip(missing, optimised):
+            feature_map = np.squeeze(feature_map)
+            with open(maf_filenames[filter_index], 'wb') as maf:
+                np.save(maf, feature_map)
 
-        maf_filename = os.path.join(out_dir, f'{model_name}_L{layer_index}_C{filter_index}.npy')
-        if os.path.isfile(maf_filename) and not fresh:
-            feature_map = np.load(maf_filename)
+    for ax, filter_index in zip(axes.ravel(), filter_indices):
 
-        else:
-            # Initiate random noise
-            input_img_data = np.random.random((1, 224, 224, 1))
-            input_img_data = (input_img_data - 0.5) * 20 #+ 128.
-            # Cast random noise from np.float64 to tf.float32 Variable
-            input_img_data = tf.Variable(tf.cast(input_img_data, tf.float32))
-
-            # Iterate gradient ascents
-            for _ in range(epochs):
-                with tf.GradientTape() as tape:
-                    outputs = submodel(input_img_data)
-                    loss_value = tf.reduce_mean(outputs[:, :, :, filter_index])
-                grads = tape.gradient(loss_value, input_img_data)
-                normalized_grads = grads / (tf.sqrt(tf.reduce_mean(tf.square(grads))) + 1e-5)
-                input_img_data.assign_add(normalized_grads * step_size)
-            feature_map = np.squeeze(input_img_data.numpy())
-            # feature_maps[filter_index] = feature_map
-
-            with open(maf_filename, 'wb') as maf:
-                np.save(maf, feature_map)
+        feature_map = np.load(maf_filenames[filter_index])
 
         cbmap = ax.imshow(feature_map)
         ax.set_aspect('equal')
@@ -0,0 +1,509 @@
+"""
+`tf.data` input pipelines for training and testing models.
+
+Batches of images are gathered (from arrays, memory maps or image files), 
+optionally upscaled from the 32x32 CIFAR10 images, augmented and normalised 
+in parallel graph operations rather than Python threads. The upscaling keeps 
+the images as uint8 RGB arrays (about 1/50 of the memory of the materialised 
+224x224 images) and converts them to luminance, upscales, clips and 
+normalises them as each batch is requested.
+"""
+
+import os
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2
+import tensorflow as tf
+
+from bionet.config import luminance_weights, image_size, workers
+from bionet.cache import upscale_images
+
+
+def get_resize_matrix(in_size, out_size, interpolation=4):
+    """Return the matrix `R` such that `R @ image @ R.T` upscales a square image with OpenCV.
+
+    OpenCV's resizing is separable and linear so the matrix is obtained by
+    resizing an impulse in each row. This makes the upscaling two matrix
+    multiplications which match `cv2.resize` (up to floating point error)
+    including for the Lanczos (8x8) kernel which has no `tf.image.resize`
+    equivalent.
+
+    Args:
+        in_size (int): Size of the source images.
+        out_size (int): Size of the upscaled images.
+        interpolation (int): OpenCV interpolation code (0: nearest, 4: lanczos).
+
+    Returns:
+        np.ndarray: The resize matrix with shape (out_size, in_size).
+    """
+    matrix = np.zeros((out_size, in_size), dtype=np.float64)
+    for row in range(in_size):
+        impulse = np.zeros((in_size, in_size), dtype=np.float64)
+        impulse[row, :] = 1  # Constant along the rows so only the columns vary
+        matrix[:, row] = cv2.resize(impulse, dsize=(out_size, out_size),
+                                    interpolation=interpolation)[:, 0]
+    return matrix
+
+
+class Upscaler:
+    """Convert batches of uint8 RGB images to normalised, upscaled luminance images in graph.
+
+    The images are rounded to float16 after clipping to match the
+    materialised arrays in `model.py`. If `mean` and `std` are None,
+    samplewise normalisation is used (as with `ImageDataGenerator`).
+
+    Args:
+        image_size (tuple): Size of the upscaled images.
+        interpolation (int): OpenCV interpolation code (0: nearest, 4: lanczos).
+        mean (float): Featurewise mean.
+        std (float): Featurewise standard deviation.
+        in_size (int): Size of the source images.
+    """
+
+    def __init__(self, image_size=image_size, interpolation=4, mean=None, std=None,
+                 in_size=32):
+        assert image_size[0] == image_size[1], "Only square images are supported!"
+        self.resize = tf.constant(get_resize_matrix(in_size, image_size[0], interpolation),
+                                  dtype=tf.float32)
+        self.weights = tf.constant(luminance_weights, dtype=tf.float32)
+        self.mean = mean
+        self.std = std
+
+    def upscale(self, images):
+        images = tf.tensordot(tf.cast(images, tf.float32), self.weights, axes=1)
+        images = tf.einsum('ij,njk,lk->nil', self.resize, images, self.resize)
+        images = tf.clip_by_value(images, 0, 255)
+        images = tf.cast(tf.cast(images, tf.float16), tf.float32)
+        return images[..., tf.newaxis]
+
+    def normalise(self, images):
+        return normalise(images, self.mean, self.std)
+
+    def __call__(self, images, labels):
+        return self.normalise(self.upscale(images)), labels
+
+
+def normalise(images, mean=None, std=None):
+    """Normalise a batch of images featurewise or (if `mean` or `std` are None) samplewise.
+
+    This is equivalent to `ImageDataGenerator.standardize`.
+    """
+    if (mean is not None) and (std is not None):
+        return (images - mean) / (std + 1e-6)
+    images -= tf.reduce_mean(images, axis=(1, 2, 3), keepdims=True)
+    return images / (tf.math.reduce_std(images, axis=(1, 2, 3), keepdims=True) + 1e-6)
+
+
+@functools.lru_cache(maxsize=None)
+def get_keras_conventions():
+    """Probe the installed `ImageDataGenerator` for the conventions of its transforms.
+
+    These changed between versions of Keras: the centre of the affine transform
+    (`h/2 + 0.5` or `h/2 - 0.5`), whether the transform matrix is applied to 
+    (row, col) or swapped (col, row) coordinates and whether brightness shifts 
+    rescale each image to [0, 255] first.
+
+    Returns:
+        dict: The centre `offset`, whether the axes are `swapped` and whether brightness is `rescaled`.
+    """
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+
+    generator = ImageDataGenerator()
+    # Rotating by 180 degrees maps (2, 2) to (2 * o_x - 2, 2 * o_y - 2) where o_x = 3 +/- 0.5
+    probe = np.arange(6 * 6, dtype=np.float32).reshape((6, 6, 1))
+    rotated = generator.apply_transform(probe, {"theta": 180})
+    offset = 0.5 if np.isclose(rotated[2, 2, 0], probe[5, 5, 0], atol=1e-3) else -0.5
+    # Height shifts move the rows unless the coordinates are swapped
+    probe = np.arange(5 * 7, dtype=np.float32).reshape((5, 7, 1))
+    shifted = generator.apply_transform(probe, {"tx": 1})
+    swapped = not np.allclose(shifted[:-1], probe[1:])
+    brightened = generator.apply_transform(probe, {"brightness": 1.0})
+    rescaled = np.amax(brightened) > np.amax(probe)
+    return {"offset": offset, "swapped": bool(swapped), "rescaled": bool(rescaled)}
+
+
+def get_augmentation_transforms(seed, n_images, image_size, rotation_range=0, 
+                                width_shift_range=0., height_shift_range=0., 
+                                shear_range=0., zoom_range=0.):
+    """Draw the affine transforms of `ImageDataGenerator.get_random_transform` for a batch.
+
+    The matrices are composed as in `apply_affine_transform` (rotation, shift, 
+    shear then zoom about the centre) with the conventions of the installed 
+    version of Keras and converted to the flattened (x, y) form of 
+    `ImageProjectiveTransformV3`. Angles are in degrees and shifts < 1 are 
+    fractions of the image size.
+
+    Returns:
+        tf.Tensor: Transforms with shape (n_images, 8).
+    """
+    conventions = get_keras_conventions()
+    h, w = image_size
+    seeds = tf.random.experimental.stateless_split(seed, num=6)
+    shape = [n_images]
+
+    def draw(index, low, high):
+        return tf.random.stateless_uniform(shape, seeds[index], minval=low, maxval=high)
+
+    zeros = tf.zeros(shape)
+    ones = tf.ones(shape)
+    theta = draw(0, -rotation_range, rotation_range) * np.pi / 180 if rotation_range else zeros
+    tx = draw(1, -height_shift_range, height_shift_range) if height_shift_range else zeros
+    if 0 < height_shift_range < 1:
+        tx *= h
+    ty = draw(2, -width_shift_range, width_shift_range) if width_shift_range else zeros
+    if 0 < width_shift_range < 1:
+        ty *= w
+    shear = draw(3, -shear_range, shear_range) * np.pi / 180 if shear_range else zeros
+    if np.isscalar(zoom_range):
+        zoom_range = (1 - zoom_range, 1 + zoom_range)
+    if tuple(zoom_range) == (1, 1):
+        zx, zy = ones, ones
+    else:
+        zx = draw(4, *zoom_range)
+        zy = draw(5, *zoom_range)
+
+    def matrix(rows):
+        return tf.stack([tf.stack(row, axis=-1) for row in rows], axis=-2)
+
+    rotation = matrix([[tf.cos(theta), -tf.sin(theta), zeros],
+                       [tf.sin(theta), tf.cos(theta), zeros],
+                       [zeros, zeros, ones]])
+    shift = matrix([[ones, zeros, tx], [zeros, ones, ty], [zeros, zeros, ones]])
+    shearing = matrix([[ones, -tf.sin(shear), zeros],
+                       [zeros, tf.cos(shear), zeros],
+                       [zeros, zeros, ones]])
+    zoom = matrix([[zx, zeros, zeros], [zeros, zy, zeros], [zeros, zeros, ones]])
+    transform = rotation @ shift @ shearing @ zoom
+
+    # Transform about the centre (as in `transform_matrix_offset_center`)
+    o_x, o_y = h / 2 + conventions["offset"], w / 2 + conventions["offset"]
+    offset = tf.constant([[1, 0, o_x], [0, 1, o_y], [0, 0, 1]], dtype=tf.float32)
+    reset = tf.constant([[1, 0, -o_x], [0, 1, -o_y], [0, 0, 1]], dtype=tf.float32)
+    m = offset @ transform @ reset
+
+    # Map output (col, row) to input (col, row)
+    if conventions["swapped"]:  # The matrix is in (col, row) coordinates
+        return tf.stack([m[:, 0, 0], m[:, 0, 1], m[:, 0, 2], 
+                         m[:, 1, 0], m[:, 1, 1], m[:, 1, 2], 
+                         zeros, zeros], axis=-1)
+    return tf.stack([m[:, 1, 1], m[:, 1, 0], m[:, 1, 2], 
+                     m[:, 0, 1], m[:, 0, 0], m[:, 0, 2], 
+                     zeros, zeros], axis=-1)
+
+
+def augment(images, seed, rotation_range=0, width_shift_range=0., 
+            height_shift_range=0., shear_range=0., zoom_range=0., 
+            horizontal_flip=False, vertical_flip=False, brightness_range=None, 
+            fill_mode='nearest', cval=0.):
+    """Randomly augment a batch of images with the semantics of `ImageDataGenerator`.
+
+    The keyword arguments are those of `ImageDataGenerator`. The affine 
+    transform is applied with bilinear interpolation (as `interpolation_order=1`), 
+    followed by flips then brightness shifts. The brightness shift truncates 
+    to uint8 as `array_to_img` and PIL do (after rescaling each image to 
+    [0, 255] with older versions of Keras).
+    All random numbers are drawn statelessly from `seed` (a shape [2] tensor).
+
+    Args:
+        images (tf.Tensor): Batch of images with shape (n_images, n_rows, n_cols, n_channels).
+        seed (tf.Tensor): Seed for the stateless random number generators.
+
+    Returns:
+        tf.Tensor: The augmented images.
+    """
+    n_images = tf.shape(images)[0]
+    image_size = tuple(images.shape[1:3])
+    seeds = tf.random.experimental.stateless_split(seed, num=4)
+
+    if rotation_range or width_shift_range or height_shift_range or shear_range or zoom_range:
+        transforms = get_augmentation_transforms(seeds[0], n_images, image_size, 
+                                                 rotation_range=rotation_range, 
+                                                 width_shift_range=width_shift_range, 
+                                                 height_shift_range=height_shift_range, 
+                                                 shear_range=shear_range, 
+                                                 zoom_range=zoom_range)
+        images = tf.raw_ops.ImageProjectiveTransformV3(
+            images=images, transforms=transforms, 
+            output_shape=tf.constant(image_size, dtype=tf.int32), 
+            fill_value=tf.cast(cval, tf.float32), 
+            interpolation="BILINEAR", fill_mode=fill_mode.upper())
+
+    if horizontal_flip:
+        flip = tf.random.stateless_uniform([n_images], seeds[1]) < 0.5
+        images = tf.where(flip[:, None, None, None], tf.reverse(images, axis=[2]), images)
+    if vertical_flip:
+        flip = tf.random.stateless_uniform([n_images], seeds[2]) < 0.5
+        images = tf.where(flip[:, None, None, None], tf.reverse(images, axis=[1]), images)
+
+    if brightness_range is not None:
+        brightness = tf.random.stateless_uniform([n_images, 1, 1, 1], seeds[3], 
+                                                 minval=brightness_range[0], 
+                                                 maxval=brightness_range[1])
+        if get_keras_conventions()["rescaled"]:
+            images = images + tf.maximum(-tf.reduce_min(images, axis=(1, 2, 3), keepdims=True), 0)
+            maxima = tf.reduce_max(images, axis=(1, 2, 3), keepdims=True)
+            images = tf.math.divide_no_nan(images, maxima) * 255
+        images = tf.floor(tf.floor(images) * brightness)
+
+    return images
+
+
+def load_image_files(paths, image_size=image_size, interpolation='lanczos', colour='grayscale'):
+    """Read, decode and resize a batch of image files (as `flow_from_directory`).
+
+    Greyscale images are converted with the ITU-R 601-2 luma transform and 
+    rounded (as PIL's "L" mode). `tf.image.resize` is used for resizing with 
+    "lanczos3" in place of PIL's Lanczos filter.
+    """
+    method = {'nearest': 'nearest', 'lanczos': 'lanczos3'}.get(interpolation, interpolation)
+
+    def load(path):
+        image = tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+        image = tf.cast(image, tf.float32)
+        if colour == 'grayscale':
+            image = tf.round(tf.tensordot(image, tf.constant(luminance_weights, dtype=tf.float32), 
+                                          axes=1))[..., tf.newaxis]
+        if tuple(image.shape[:2]) != tuple(image_size):
+            image = tf.image.resize(image, image_size, method=method, antialias=True)
+        image.set_shape((*image_size, 1 if colour == 'grayscale' else 3))
+        return image
+
+    return tf.map_fn(load, paths, fn_output_signature=tf.float32)
+
+
+def list_image_files(directory):
+    """List the image files and one-hot labels of a directory of class sub-directories.
+
+    The classes and files are sorted as in `flow_from_directory`.
+    """
+    extensions = ('png', 'jpg', 'jpeg', 'bmp', 'ppm', 'tif', 'tiff')
+    class_names = sorted(name for name in os.listdir(directory) 
+                         if os.path.isdir(os.path.join(directory, name)))
+    paths, labels = [], []
+    for c_ind, class_name in enumerate(class_names):
+        for root, _, files in sorted(os.walk(os.path.join(directory, class_name), followlinks=True)):
+            for file_name in sorted(files):
+                if file_name.lower().endswith(extensions):
+                    paths.append(os.path.join(root, file_name))
+                    labels.append(c_ind)
+    labels = np.eye(len(class_names), dtype=np.float32)[labels]
+    return np.array(paths), labels
+
+
+def get_dataset(x, y, batch_size, mean=None, std=None, upscaler=None, augmentation=None, 
+                shuffle=False, seed=None, repeat=False, cache=False, 
+                image_size=image_size, interpolation='lanczos', colour='grayscale'):
+    """Return a `tf.data.Dataset` of augmented and normalised batches of (images, labels).
+
+    The images are gathered by index so large arrays (which may be memory-mapped) 
+    are not embedded in the graph. Each batch is upscaled (if `upscaler` is given),
+    augmented then normalised in parallel `map` calls and prefetched. 
+
+    Randomness is derived from `seed` alone: the indices are reshuffled each 
+    epoch and the augmentation of each batch is seeded with `(seed, batch counter)`. 
+    The counter follows `repeat` so each epoch draws new transformations. With
+    `repeat=True`, pass `steps_per_epoch=len_batches` to `model.fit`.
+
+    Args:
+        x: Images as an array (or array-like), uint8 RGB source images with an 
+            `upscaler`, or an array of image file paths.
+        y (np.ndarray): One-hot labels.
+        batch_size (int): Number of images per batch.
+        mean (float): Featurewise mean (None for samplewise normalisation).
+        std (float): Featurewise standard deviation (None for samplewise normalisation).
+        upscaler (Upscaler): Upscale the source images at batch time.
+        augmentation (dict): `ImageDataGenerator` augmentation arguments for `augment`.
+        shuffle (bool): Reshuffle the images each epoch.
+        seed (int): Seed for shuffling and augmentation.
+        repeat (bool): Repeat the dataset indefinitely.
+        cache (bool or str): Cache the loaded (unaugmented) batches in memory 
+            (True) or in files with this prefix. This requires `shuffle=False`.
+        image_size (tuple): Size of images loaded from files.
+        interpolation (str): Resizing method for images loaded from files.
+        colour (str): Colour mode for images loaded from files.
+
+    Returns:
+        tf.data.Dataset: Batches of (images, labels).
+    """
+    assert len(x) == len(y)
+    assert not (cache and shuffle), "Cached batches cannot be shuffled!"
+    if seed is None:
+        seed = 0
+    from_files = isinstance(x, np.ndarray) and x.dtype.kind in ('U', 'S', 'O')
+
+    def gather(indices):
+        return np.asarray(x[indices], dtype=np.float32), np.asarray(y[indices], dtype=np.float32)
+
+    def load(indices):
+        images, labels = tf.numpy_function(gather, [indices], (tf.float32, tf.float32))
+        images.set_shape((None, *x.shape[1:]))
+        labels.set_shape((None, *y.shape[1:]))
+        return images, labels
+
+    def load_files(indices):
+        images = load_image_files(tf.gather(x, indices), image_size=image_size, 
+                                  interpolation=interpolation, colour=colour)
+        return images, tf.gather(y, indices)
+
+    dataset = tf.data.Dataset.range(len(x))
+    if shuffle:
+        dataset = dataset.shuffle(len(x), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(load_files if from_files else load, num_parallel_calls=tf.data.AUTOTUNE)
+    if upscaler is not None:
+        dataset = dataset.map(lambda images, labels: (upscaler.upscale(images), labels), 
+                              num_parallel_calls=tf.data.AUTOTUNE)
+    if cache:
+        dataset = dataset.cache() if cache is True else dataset.cache(cache)
+    if repeat:
+        dataset = dataset.repeat()
+
+    def process(counter, batch):
+        images, labels = batch
+        if augmentation:
+            images = augment(images, tf.stack([tf.cast(seed, tf.int64), counter]), **augmentation)
+        return normalise(images, mean, std), labels
+
+    dataset = tf.data.Dataset.zip((tf.data.experimental.Counter(), dataset))
+    dataset = dataset.map(process, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def get_upscaling_dataset(x, y, batch_size, image_size=image_size, interpolation=4,
+                          mean=None, std=None, shuffle=False, seed=None, 
+                          augmentation=None, repeat=False):
+    """Return a `tf.data.Dataset` of normalised, upscaled batches from uint8 RGB images.
+
+    Args:
+        x (np.ndarray): Source images with shape (n_images, 32, 32, 3) in uint8.
+        y (np.ndarray): One-hot labels.
+        batch_size (int): Number of images per batch.
+        image_size (tuple): Size of the upscaled images.
+        interpolation (int): OpenCV interpolation code (0: nearest, 4: lanczos).
+        mean (float): Featurewise mean (None for samplewise normalisation).
+        std (float): Featurewise standard deviation (None for samplewise normalisation).
+        shuffle (bool): Reshuffle the images each epoch.
+        seed (int): Seed for shuffling and augmentation.
+        augmentation (dict): `ImageDataGenerator` augmentation arguments.
+        repeat (bool): Repeat the dataset indefinitely.
+
+    Returns:
+        tf.data.Dataset: Batches of (images, labels).
+    """
+    upscaler = Upscaler(image_size=image_size, interpolation=interpolation,
+                        in_size=x.shape[1])
+    return get_dataset(x, y, batch_size, mean=mean, std=std, upscaler=upscaler, 
+                       augmentation=augmentation, shuffle=shuffle, seed=seed, 
+                       repeat=repeat)
+
+
+class UpscaledImages:
+    """Array-like view of uint8 RGB images which upscales them with OpenCV when indexed.
+
+    Indexing returns float16 luminance images with shape
+    (n_images, *image_size, 1) identical to the materialised arrays, so slices
+    can be passed to the vectorised perturbation functions.
+    """
+
+    def __init__(self, images, image_size=image_size, interpolation=4, dtype=np.float16):
+        assert images.ndim == 4 and images.shape[-1] == 3, f"Given: {images.shape}"
+        self.images = images
+        self.image_size = tuple(image_size)
+        self.interpolation = interpolation
+        self.dtype = dtype
+
+    @property
+    def shape(self):
+        return (len(self.images), *self.image_size, 1)
+
+    @property
+    def ndim(self):
+        return 4
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, index):
+        images = self.images[index]
+        single = images.ndim == 3
+        if single:
+            images = images[np.newaxis]
+        out = np.empty((len(images), *self.image_size, 1), dtype=self.dtype)
+        upscale_images(np.dot(images, luminance_weights), out,
+                       image_size=self.image_size, interpolation=self.interpolation)
+        return out[0] if single else out
+
+
+def get_moments(images):
+    """Return the (count, mean, sum of squared deviations) of the pixels of a batch."""
+    images = np.asarray(images, dtype=np.float64)
+    mean = np.mean(images)
+    return images.size, mean, np.sum((images - mean) ** 2)
+
+
+def merge_moments(moments_a, moments_b):
+    """Combine the moments of two sets of pixels (Chan et al.'s parallel form of Welford's update)."""
+    count_a, mean_a, m2_a = moments_a
+    count_b, mean_b, m2_b = moments_b
+    count = count_a + count_b
+    if count == 0:
+        return 0, 0.0, 0.0
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / count
+    return count, mean, m2
+
+
+def calculate_statistics(images, batch_size=1000):
+    """Calculate the mean and standard deviation of all pixels in a single streaming pass.
+
+    Args:
+        images: An array or array-like (e.g. `UpscaledImages`) of images.
+        batch_size (int): Number of images per batch.
+
+    Returns:
+        tuple: (mean, std)
+    """
+    moments = (0, 0.0, 0.0)
+    for start in range(0, len(images), batch_size):
+        moments = merge_moments(moments, get_moments(images[start:start+batch_size]))
+    count, mean, m2 = moments
+    return float(mean), float(np.sqrt(m2 / count))
+
+
+def load_image_batch(paths, image_size=image_size, interpolation='lanczos', colour='grayscale'):
+    """Load and resize image files with PIL (as `flow_from_directory`) into an array."""
+    return np.stack([tf.keras.preprocessing.image.img_to_array(
+                         tf.keras.preprocessing.image.load_img(path, color_mode=colour, 
+                                                               target_size=image_size, 
+                                                               interpolation=interpolation))
+                     for path in paths])
+
+
+def calculate_directory_statistics(directory, image_size=image_size, interpolation='lanczos', 
+                                   colour='grayscale', batch_size=256, workers=workers):
+    """Calculate the pixel mean and standard deviation of a directory of class sub-directories.
+
+    The images are loaded (and resized) as by `flow_from_directory` in batches 
+    spread across threads and the moments of each batch are merged so the 
+    statistics are computed in a single pass without holding the images.
+
+    Returns:
+        tuple: (mean, std)
+    """
+    paths, _ = list_image_files(directory)
+    assert len(paths) > 0, f"No images found in {directory}!"
+
+    def get_batch_moments(batch_paths):
+        return get_moments(load_image_batch(batch_paths, image_size=image_size, 
+                                            interpolation=interpolation, colour=colour))
+
+    batches = [paths[start:start+batch_size] for start in range(0, len(paths), batch_size)]
+    moments = (0, 0.0, 0.0)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch_moments in executor.map(get_batch_moments, batches):
+            moments = merge_moments(moments, batch_moments)
+    count, mean, m2 = moments
+    return float(mean), float(np.sqrt(m2 / count))
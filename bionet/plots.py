@@ -18,7 +18,9 @@ from tensorflow.keras import backend as K
 from sklearn.metrics import auc
 from scipy.integrate import simps
 
-from bionet.utils import find_conv_layer, calc_sigma, calc_lambda  # calc_bandwidth,
+from bionet.utils import (find_conv_layer, calc_sigma, calc_lambda,  # calc_bandwidth,
+                          separable_convolve2d)
+from bionet.results import ResultsIndex
 from bionet.preparation import (perturbations, cifar_wrapper, sanity_check, 
                                 invert_luminance, get_noise_preprocessor)
 from bionet.config import (convolutions_order, bases_order, classes, 
@@ -539,7 +541,7 @@ def plot_image_predictions(label, models, top_k=3, params=None, gpu=None):
 
                         if params is not None:
                             if gpu is None:
-                                fimg = signal.convolve2d(image, kernels[0], mode='same')
+                                fimg = separable_convolve2d(image, kernels[0], rank=1)
                             else:
                                 kernels = K.stack(kernels, axis=-1)
                                 kernels = K.expand_dims(kernels, -1)
@@ -685,13 +687,11 @@ def inspect_results(label, seed="*", reference="VGG16", annotate="Convolution",
         print(f"Unknown reference_set passed: {reference} ({type(reference)})")
 
 
-    df = pd.concat([pd.read_csv(filename) for filename in glob.glob(pattern)], ignore_index=True)
-    # if "imagenet" in filename.lower():
-    #     df["Weights"] = "imagenet"
-    # else:
-    #     df["Weights"] = "None"
-    df["Weights"] = df["Weights"].fillna("None")
-    df = df[columns]
+    # Only read the results files which are new since the last call
+    index = ResultsIndex(os.path.join(results_dir, label), os.path.basename(pattern),
+                         name=f"perturb_s{seed}".replace("*", "all"))
+    index.update(verbose=verbose)
+    df = index.table[columns].copy()  # Missing "Weights" are set to "None"
     df.sort_values(by=['Trial', 'Noise', 'Level'], inplace=True, ignore_index=True)
     if save:
         output = os.path.join(results_dir, label, f"perturb_{label}_Set.csv")
@@ -700,7 +700,7 @@ def inspect_results(label, seed="*", reference="VGG16", annotate="Convolution",
     # df["Base"] = "*" + df["Base"]  # Preprend "*" to differentiate new results
     # df["Convolution"] = "*" + df["Convolution"]  # Preprend "*" to differentiate new results
     if annotate:  # Preprend "*" to differentiate new results for plots
-        df[annotate] = "*" + df[annotate]
+        df[annotate] = "*" + df[annotate].astype(str)
     perturbations = pd.concat([df, *[pd.read_csv(ref) for ref in references]], ignore_index=True)
 
     fig, axes = plot_perturbations(perturbations, label, fig_sf=fig_sf)
@@ -717,14 +717,17 @@ def inspect_results(label, seed="*", reference="VGG16", annotate="Convolution",
     # output = os.path.join(results_dir, label, "generalise_Set.csv")
     reference = os.path.join(results_dir, reference_dir, "generalise_Set.csv")  # Compare to standard results
 
-    df = pd.concat([pd.read_csv(filename) for filename in glob.glob(pattern)], ignore_index=True)
+    index = ResultsIndex(os.path.join(results_dir, label), os.path.basename(pattern),
+                         name=f"generalise_s{seed}".replace("*", "all"))
+    index.update(verbose=verbose)
+    df = index.table.drop(columns="File")
     df.sort_values(by=['Trial', 'Convolution', 'Base'], inplace=True, ignore_index=True)  # , 'Set', 'Inverted'
     # df.to_csv(output, index=False)  # Save new results
     # generalisations = pd.concat([pd.read_csv(output), pd.read_csv(reference)], ignore_index=True)
     # df["Base"] = "*" + df["Base"]  # Preprend "*" to differentiate new results
     # df["Convolution"] = "*" + df["Convolution"]  # Preprend "*" to differentiate new results
     if annotate:  # Preprend "*" to differentiate new results for plots
-        df[annotate] = "*" + df[annotate]
+        df[annotate] = "*" + df[annotate].astype(str)
     generalisations = pd.concat([df, pd.read_csv(reference)], ignore_index=True)
 
     # hue_order = ['VGG16', 'VGG19', 'ALL-CNN']
@@ -717,3 +717,304 @@ def invert_luminance(image, level):
     new_image[new_image < 0] = 0
     new_image[new_image > 1] = 1
     return new_image
+
+
+# Vectorised perturbations for batches of images with shape (n_images, n_rows, n_cols)
+# NOTE: Each function draws its random numbers for the whole batch at once.
+# With a np.random.RandomState these are the same values (in the same order) 
+# as drawn by the single image functions above when applied image by image.
+# With an ImageSeededRNG each image has its own stream of random numbers.
+
+class ImageSeededRNG:
+    """Counter-based random number generator with a stream for each image.
+
+    The stream for image `i` at perturbation level `l_ind` is seeded from 
+    `(seed, l_ind, i)` so the noise drawn for an image is the same regardless 
+    of which worker, batch size or ordering of batches produced it. This 
+    allows the stochastic perturbations to be generated in parallel. 
+
+    Bind the indices of a batch of images with `for_images` to get an object 
+    with the `uniform` and `random` methods used by the batch functions. 
+    """
+
+    def __init__(self, seed, l_ind=0):
+        self.seed = int(seed)
+        self.l_ind = int(l_ind)
+
+    def get_generator(self, index):
+        """Return the generator for a single image."""
+        seeds = np.random.SeedSequence([self.seed, self.l_ind, int(index)])
+        return np.random.Generator(np.random.Philox(seeds))
+
+    def for_images(self, indices):
+        """Return a generator for a batch of images with the given indices."""
+        return ImageBatchRNG([self.get_generator(index) for index in indices])
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(seed={self.seed}, l_ind={self.l_ind})"
+
+
+class ImageBatchRNG:
+    """Draw random numbers for a batch of images from their own streams.
+
+    The first dimension of `size` must equal the number of images. 
+    """
+
+    def __init__(self, generators):
+        self.generators = generators
+
+    def _draw(self, method, size, **kwargs):
+        assert size[0] == len(self.generators), f"Expected {len(self.generators)} images, given: {size}"
+        return np.stack([getattr(generator, method)(size=size[1:], **kwargs)
+                         for generator in self.generators])
+
+    def uniform(self, low=0.0, high=1.0, size=None):
+        return self._draw("uniform", size, low=low, high=high)
+
+    def random(self, size=None):
+        return self._draw("random", size)
+
+def salt_and_pepper_noise_batch(images, p, contrast_level, rng=None):
+    """Apply salt and pepper noise to a batch of greyscale images.
+
+    parameters:
+    - images: a numpy.ndarray with shape (n_images, n_rows, n_cols)
+    - p: a scalar indicating probability of white and black pixels, in [0, 1]
+    - contrast_level: a scalar in [0, 1]; with 1 -> full contrast
+    - rng: a np.random.RandomState(seed=XYZ) to make it reproducible
+    """
+
+    assert 0 <= p <= 1
+    if rng is None:
+        rng = np.random
+
+    images = adjust_contrast(images, contrast_level)
+
+    u = rng.uniform(size=images.shape)
+
+    salt = (u >= 1 - p / 2).astype(images.dtype)
+    pepper = -(u < p / 2).astype(images.dtype)
+
+    images = images + salt + pepper
+    images[images < 0] = 0
+    images[images > 1] = 1
+    return images
+
+
+def uniform_noise_batch(images, width, contrast_level, rng=None):
+    """Apply uniform noise in the range [-width, width) to a batch of greyscale images.
+
+    parameters:
+    - images: a numpy.ndarray with shape (n_images, n_rows, n_cols)
+    - width: a scalar indicating width of additive uniform noise
+    - contrast_level: a scalar in [0, 1]; with 1 -> full contrast
+    - rng: a np.random.RandomState(seed=XYZ) to make it reproducible
+    """
+
+    if rng is None:
+        rng = np.random
+
+    images = adjust_contrast(images, contrast_level)
+
+    images = images + rng.uniform(low=-width, high=width, size=images.shape)
+    images[images < 0] = 0
+    images[images > 1] = 1
+    return images
+
+
+def high_pass_filter_batch(images, std, bg_grey=0.4423):
+    """Apply a Gaussian high pass filter to a batch of greyscale images.
+
+    parameters:
+    - images: a numpy.ndarray with shape (n_images, n_rows, n_cols)
+    - std: a scalar providing the Gaussian low-pass filter's standard deviation
+    """
+
+    # A zero standard deviation along the first axis filters each image independently
+    gauss_filter = gaussian_filter(images.astype(np.float64), (0, std, std), 
+                                   mode='constant', cval=bg_grey)
+    new_images = images - gauss_filter.astype(images.dtype)
+
+    # add mean of old image to retain image statistics
+    mean_diff = bg_grey - np.mean(new_images, axis=(1, 2), keepdims=True)
+    new_images = new_images + mean_diff
+
+    new_images[new_images < 0] = 0
+    new_images[new_images > 1] = 1
+    return new_images
+
+
+def low_pass_filter_batch(images, std, bg_grey=0.4423):
+    """Apply a Gaussian low-pass filter to a batch of greyscale images.
+
+    parameters:
+    - images: a numpy.ndarray with shape (n_images, n_rows, n_cols)
+    - std: a scalar providing the Gaussian low-pass filter's standard deviation
+    """
+
+    new_images = gaussian_filter(images.astype(np.float64), (0, std, std), 
+                                 mode='constant', cval=bg_grey)
+    new_images = new_images.astype(images.dtype)
+
+    new_images[new_images < 0] = 0
+    new_images[new_images > 1] = 1
+    return new_images
+
+
+def scramble_phases_batch(images, width, rng=None):
+    """Apply random shifts to the phases of a batch of greyscale images in the Fourier domain.
+
+    parameters:
+    - images: a numpy.ndarray with shape (n_images, n_rows, n_cols)
+    - width: maximal width of the random phase shifts
+    - rng: a np.random.RandomState(seed=XYZ) to make it reproducible
+    """
+
+    if rng is None:
+        rng = np.random
+
+    n_images, n_rows, n_cols = images.shape
+    length = (n_rows-1)*(n_cols-1)
+    phase_shifts = rng.random((n_images, length//2)) - 0.5
+    phase_shifts = phase_shifts * 2 * width/180 * np.pi
+
+    # Stacked Fourier transforms over the image axes
+    f = fp.fft2(images, axes=(1, 2))
+    f = fp.fftshift(f, axes=(1, 2))
+
+    f_amp = np.abs(f)
+    f_phase = np.angle(f)
+
+    # Apply the same transformation as shift_phases to every image
+    flat_phase = f_phase[:, 1:, 1:].reshape((n_images, length))
+    flat_phase[:, :length//2] += phase_shifts
+    flat_phase[:, length//2+1:] -= phase_shifts
+    f_phase[:, 1:, 1:] = flat_phase.reshape((n_images, n_rows-1, n_cols-1))
+
+    fnew = f_amp*np.exp(1j*f_phase)
+
+    fnew = fp.ifftshift(fnew, axes=(1, 2))
+    new_images = fp.ifft2(fnew, axes=(1, 2)).real
+
+    new_images[new_images > 1] = 1
+    new_images[new_images < 0] = 0
+    return new_images
+
+
+def rotate_image_batch(images, degrees):
+    """Rotate a batch of images anticlockwise by a multiple of 90 degrees.
+
+    parameters:
+    - images: a numpy.ndarray with shape (n_images, n_rows, n_cols)
+    - degrees: one of 0, 90, 180 or 270
+    """
+    assert degrees in (0, 90, 180, 270), f"Unsupported rotation: {degrees} degrees!"
+    return np.rot90(images, k=int(degrees)//90, axes=(1, 2))
+
+
+batch_perturbations = {
+    "Uniform": uniform_noise_batch,
+    "Salt and Pepper": salt_and_pepper_noise_batch,
+    "High Pass": high_pass_filter_batch,
+    "Low Pass": low_pass_filter_batch,
+    "Contrast": adjust_contrast,  # Elementwise functions also apply to batches
+    "Phase Scrambling": scramble_phases_batch,
+    "Darken": adjust_brightness,
+    "Brighten": adjust_brightness,
+    "Rotation": rotate_image_batch,
+    "Invert": invert_luminance,
+}
+
+
+def get_batch_perturbation(name, level=None, contrast_level=1, 
+                           bg_grey=None, rng=None, rescale=1/255):
+    """Get a vectorised perturbation function from the registry of `batch_perturbations`.
+
+    This is the batch equivalent of `get_noise_preprocessor` and takes the 
+    names returned by `get_perturbations`.
+
+    Args:
+        name (str): The name of the perturbation (or "None" for no perturbation).
+        level (float): The level of the perturbation.
+        contrast_level (float): Contrast level for the Uniform and Salt and Pepper noise.
+        bg_grey (float): Background grey level for the High Pass and Low Pass filters.
+        rng (np.random.RandomState or ImageSeededRNG): Random number generator for the stochastic perturbations.
+        rescale (float): Scaling factor to put the images into the range [0, 1].
+
+    Returns:
+        function: The wrapped perturbation function for batches of images.
+    """
+
+    if name == "None":
+        return batch_wrapper(sanity_check, rescale=rescale)
+    if name not in batch_perturbations:
+        raise ValueError(f"Unknown noise type: {name}!")
+    function = batch_perturbations[name]
+
+    if name == "Uniform":
+        perturbation_fn = functools.partial(function, width=level, 
+                                            contrast_level=contrast_level, rng=rng)
+    elif name == "Salt and Pepper":
+        perturbation_fn = functools.partial(function, p=level, 
+                                            contrast_level=contrast_level, rng=rng)
+    elif name in ["High Pass", "Low Pass"]:
+        perturbation_fn = functools.partial(function, std=level, bg_grey=bg_grey)
+    elif name == "Contrast":
+        perturbation_fn = functools.partial(function, contrast_level=level)
+    elif name == "Phase Scrambling":
+        perturbation_fn = functools.partial(function, width=level, rng=rng)
+    elif name == "Rotation":
+        perturbation_fn = functools.partial(function, degrees=level)
+    else:  # ["Darken", "Brighten", "Invert"]
+        perturbation_fn = functools.partial(function, level=level)
+
+    if isinstance(rng, ImageSeededRNG) and name in stochastic_perturbations:
+        return batch_wrapper(perturbation_fn, rescale=rescale, rng=rng)
+    return batch_wrapper(perturbation_fn, rescale=rescale)
+
+
+def batch_wrapper(f, rescale=1/255, dtype=np.float32, rng=None):
+    """
+    Wrapper for vectorised perturbation functions applied to batches of upscaled CIFAR10 images.
+
+    This is the batch equivalent of `cifar_wrapper`: the images are copied 
+    and rescaled to the range [0, 1], the perturbation is applied to the 
+    whole batch then the result is rescaled to the range [0, 255]. 
+
+    Args:
+        f (function): The perturbation function manipulating batches of images in the range [0, 1].
+        rescale (float): Scaling factor to put the images into the range [0, 1].
+        dtype: The data type of the perturbed images.
+        rng (ImageSeededRNG): Per-image random number generator passed to `f` 
+            for the images with the `indices` of the batch.
+
+    Returns:
+        function: The wrapped perturbation function.
+    """
+    @functools.wraps(f)
+    def wrapper(images, indices=None):
+        # Assume the images have already been converted to greyscale
+        assert images.ndim == 4 and images.shape[-1] == 1, f"Given: {images.shape}"
+
+        # Copy the images to avoid modifying the source (which may be memory-mapped)
+        images = np.asarray(images, dtype=dtype) * rescale
+        assert 0 <= np.amin(images), f"Min = {np.amin(images)}"
+        assert np.amax(images) <= 1, f"Max = {np.amax(images)}"
+
+        if rng is None:
+            perturbed = f(images[..., 0])
+        else:
+            if indices is None:
+                indices = np.arange(len(images))
+            assert len(indices) == len(images)
+            perturbed = f(images[..., 0], rng=rng.for_images(indices))
+
+        assert 0 <= np.amin(perturbed), f"Min = {np.amin(perturbed)}"
+        assert np.amax(perturbed) <= 1, f"Max = {np.amax(perturbed)}"
+        perturbed = perturbed[..., np.newaxis]
+        assert images.shape == perturbed.shape, f"Original: {images.shape} --> Perturbed: {perturbed.shape}"
+
+        perturbed = perturbed.astype(dtype)
+        perturbed *= 255
+        return perturbed
+    return wrapper
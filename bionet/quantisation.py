@@ -0,0 +1,133 @@
+"""
+Post-training int8 quantisation of trained models for CPU inference.
+
+Models are converted to TensorFlow Lite graphs with int8 weights and
+activations, calibrated on a representative sample of (normalised) training
+images. The inputs and outputs remain float32 so the quantised graph can be
+used in place of the Keras model with the same (normalised) image batches,
+e.g. for the perturbation battery in `assess.test_noise_perturbations`.
+"""
+
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from bionet.config import workers
+from bionet.utils import as_standard_convolutions
+from bionet.assess import calculate_metrics
+
+
+def get_representative_dataset(images, mean, std, n_images=200, seed=0):
+    """Return a generator of single normalised images for calibrating the quantisation.
+
+    Args:
+        images: An array or array-like (e.g. a memory map or `UpscaledImages`) of training images.
+        mean (float): Mean of the training images.
+        std (float): Standard deviation of the training images.
+        n_images (int): Number of images to sample.
+        seed (int): Seed for sampling the images.
+
+    Returns:
+        callable: A generator function for `TFLiteConverter.representative_dataset`.
+    """
+    rng = np.random.RandomState(seed=seed)
+    indices = np.sort(rng.choice(len(images), size=min(n_images, len(images)), replace=False))
+
+    def representative_dataset():
+        for index in indices:
+            image = (np.asarray(images[index:index+1], dtype=np.float32) - mean) / std
+            yield [image]
+
+    return representative_dataset
+
+
+def export_int8_model(model, path, representative_dataset):
+    """Convert a Keras model to an int8 quantised TensorFlow Lite model.
+
+    Operations without an int8 kernel fall back to float32. The front-end
+    layers computed with FFTs or separable passes are converted as standard
+    convolutions.
+
+    Args:
+        model (tf.keras.Model): The trained model.
+        path (str): File to write the `.tflite` model to.
+        representative_dataset (callable): From `get_representative_dataset`.
+
+    Returns:
+        str: The path of the quantised model.
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(as_standard_convolutions(model))
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8,
+                                           tf.lite.OpsSet.TFLITE_BUILTINS]
+    tflite_model = converter.convert()
+    suffix = f".{os.getpid()}.tmp"
+    with open(path + suffix, 'wb') as mf:
+        mf.write(tflite_model)
+    os.replace(path + suffix, path)
+    return path
+
+
+class QuantisedModel:
+    """Run a TensorFlow Lite model with the `predict` and `evaluate` interface of a Keras model.
+
+    The interpreter is resized to each batch so the same image sequences
+    (Keras `Sequence`, iterators or `tf.data` datasets) can be passed.
+
+    Args:
+        path (str): Path of the `.tflite` model.
+        num_threads (int): Number of CPU threads for the interpreter.
+    """
+
+    metrics_names = ['loss', 'acc']
+
+    def __init__(self, path, num_threads=workers):
+        self.path = path
+        self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=num_threads)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = None
+
+    def predict_on_batch(self, images):
+        images = np.asarray(images, dtype=np.float32)
+        if len(images) != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, images.shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = len(images)
+        self.interpreter.set_tensor(self.input_index, images)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index).copy()
+
+    def get_batches(self, data, steps=None):
+        if steps is None:
+            try:
+                steps = len(data)
+            except TypeError:  # e.g. a dataset of unknown cardinality
+                steps = None
+        if hasattr(data, '__getitem__') and steps is not None:
+            batches = (data[index] for index in range(steps))
+        else:
+            batches = iter(data)
+        for step, batch in enumerate(batches):
+            if steps is not None and step >= steps:
+                break
+            if isinstance(batch, (tuple, list)):
+                yield batch[0], (batch[1] if len(batch) > 1 else None)
+            else:
+                yield batch, None
+
+    def predict(self, data, steps=None, verbose=0, **kwargs):
+        """Return the predictions for a sequence of (images, labels) batches."""
+        return np.concatenate([self.predict_on_batch(np.asarray(images))
+                               for images, _ in self.get_batches(data, steps)])
+
+    def evaluate(self, data, steps=None, verbose=0, **kwargs):
+        """Return the [loss, accuracy] for a sequence of (images, labels) batches."""
+        predictions, labels = [], []
+        for images, y in self.get_batches(data, steps):
+            predictions.append(self.predict_on_batch(np.asarray(images)))
+            labels.append(np.argmax(np.asarray(y), axis=1))
+        loss, accuracy, _ = calculate_metrics(np.concatenate(predictions), np.concatenate(labels))
+        return [loss, accuracy]
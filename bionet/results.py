@@ -0,0 +1,376 @@
+"""
+Storage of per-image predictions and per-run metrics.
+
+Predictions are stored as compressed Arrow (Feather v2) files in a Hive-partitioned
+dataset (directories named `<key>=<value>`) under a root directory, one file
+per partition, e.g. for the perturbation tests:
+
+    predictions/perturb/Model=<model>/Trial=<trial>/Seed=<seed>/Set=<set>/Noise=<noise>/LI=<level index>/
+
+Probabilities are stored as float16 (which Arrow supports natively, unlike
+Parquet) and labels as small integers. When a
+dataset is loaded the partition keys are read back as categorical columns
+and can be used as filters so only the matching files are read.
+
+Metrics (one row per test set or perturbation level) are written with a
+`MetricsWriter` which only creates the final CSV file once the run has
+finished, and can also append the rows of completed runs to a CSV file shared
+by the concurrent runs of a sweep. A `ResultsIndex` consolidates the metrics
+files of a results directory into one typed table which is updated
+incrementally, only reading files which are new or have changed.
+"""
+
+import os
+import io
+import csv
+import glob
+import json
+import hashlib
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from bionet.config import classes
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+
+predictions_dtype = np.float16
+partition_file = "part-0.arrow"
+
+
+def get_partition_dir(root, partition):
+    """Return the directory of a partition (an ordered dictionary of keys and values)."""
+    segments = [f"{key}={quote(str(value), safe='')}" for key, value in partition.items()]
+    return os.path.join(root, *segments)
+
+
+def write_predictions(root, partition, predictions, labels, columns=None, compression="zstd"):
+    """Write the predictions for a set of images to a partition of the store.
+
+    The file is written to a temporary (hidden) file then renamed so readers
+    never see a partially written partition. An existing partition is
+    replaced.
+
+    Args:
+        root (str): Root directory of the dataset (e.g. `<results>/predictions/perturb`).
+        partition (dict): Partition keys and values in directory order (e.g. Model, Trial, Seed, Set).
+        predictions (np.ndarray): Class probabilities with shape (n_images, n_classes).
+        labels (np.ndarray): True class indices.
+        columns (dict): Additional per-image or constant columns (e.g. {'Level': level}).
+        compression (str): Compression codec ("zstd" or "lz4").
+
+    Returns:
+        str: The path of the written file.
+    """
+    predictions = np.asarray(predictions)
+    labels = np.asarray(labels)
+    assert len(predictions) == len(labels)
+    classifications = np.argmax(predictions, axis=1)
+
+    df = pd.DataFrame(predictions.astype(predictions_dtype), columns=classes)
+    df["Predicted"] = classifications.astype(np.uint8)
+    df["Class"] = labels.astype(np.uint8)
+    df["Correct"] = classifications == labels
+    df["Image"] = np.arange(len(labels), dtype=np.int32)
+    for column, values in (columns or {}).items():
+        df[column] = values
+
+    partition_dir = get_partition_dir(root, partition)
+    os.makedirs(partition_dir, exist_ok=True)
+    path = os.path.join(partition_dir, partition_file)
+    temp_path = os.path.join(partition_dir, f".{partition_file}.{os.getpid()}.tmp")
+    df.to_feather(temp_path, compression=compression)
+    os.replace(temp_path, path)
+    return path
+
+
+def get_partition_keys(root):
+    """Return the partition keys of a dataset in directory order."""
+    keys = []
+    path = root
+    while True:
+        subdirs = sorted(entry for entry in os.listdir(path)
+                         if "=" in entry and os.path.isdir(os.path.join(path, entry)))
+        if not subdirs:
+            return keys
+        keys.append(subdirs[0].split("=", 1)[0])
+        path = os.path.join(path, subdirs[0])
+
+
+def load_predictions_store(root, columns=None, **filters):
+    """Load predictions from the store, only reading the partitions which match the filters.
+
+    Args:
+        root (str): Root directory of the dataset.
+        columns (list): Columns to read (defaults to all).
+        **filters: Partition keys and the value (or list of values) to select, e.g. `Model="Gabor", Trial=1`.
+
+    Returns:
+        pd.DataFrame: The predictions with the partition keys as categorical columns.
+    """
+    # Partition values are read as strings so the filters do not depend on inferred types
+    keys = get_partition_keys(root)
+    partitioning = ds.partitioning(pa.schema([(key, pa.string()) for key in keys]), flavor="hive")
+    dataset = ds.dataset(root, format="feather", partitioning=partitioning)
+    expression = None
+    for key, value in filters.items():
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple, set)):
+            condition = ds.field(key).isin([str(v) for v in value])
+        else:
+            condition = ds.field(key) == str(value)
+        expression = condition if expression is None else expression & condition
+    df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    return df.astype({key: "category" for key in keys if key in df})
+
+
+def has_predictions_store(root):
+    """Return whether a predictions dataset has been written under `root`."""
+    return os.path.isdir(root) and len(os.listdir(root)) > 0
+
+
+def append_rows(path, fieldnames, rows, keys=None):
+    """Append rows to a CSV file shared between processes.
+
+    The rows are written while holding an exclusive lock on the file so the
+    rows of concurrent runs are never interleaved. The header is written if
+    the file is empty. When `keys` are given, existing rows with the same
+    values of those columns as a new row (e.g. from a retried or `--clean`
+    run) are replaced rather than duplicated.
+    """
+    with open(path, 'a+', newline='') as shared:
+        if fcntl is not None:
+            fcntl.flock(shared, fcntl.LOCK_EX)
+        try:
+            shared.seek(0)
+            existing = list(csv.DictReader(shared)) if keys else []
+            if keys:
+                replaced = {tuple(str(row[key]) for key in keys) for row in rows}
+                kept = [row for row in existing
+                        if tuple(row[key] for key in keys) not in replaced]
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=fieldnames)
+            if keys and len(kept) < len(existing):
+                shared.truncate(0)  # Rewrite the file without the replaced rows
+                writer.writeheader()
+                writer.writerows(kept)
+            else:
+                shared.seek(0, os.SEEK_END)
+                if shared.tell() == 0:
+                    writer.writeheader()
+            writer.writerows(rows)
+            shared.write(buffer.getvalue())
+            shared.flush()
+            os.fsync(shared.fileno())
+        finally:
+            if fcntl is not None:
+                fcntl.flock(shared, fcntl.LOCK_UN)
+
+
+metrics_columns = ('Loss', 'Accuracy')  # Measured (rather than identifying) columns
+
+
+class MetricsWriter:
+    """Buffered and crash-safe writer of the metrics of a run to a CSV file.
+
+    Rows are written through one open handle to a temporary file, flushed
+    every `flush_every` rows, and the file is renamed to `path` when the
+    writer is closed. An interrupted run therefore never leaves a partial
+    results file (which would be skipped as complete when rerun) and the
+    temporary file is removed if the writer is aborted. When
+    `store` is given, the rows of the completed run are also appended to that
+    shared CSV file (see `append_rows`), replacing any rows with the same
+    `keys` (all columns except the metrics by default) from earlier attempts.
+
+    Args:
+        path (str): The metrics file to write.
+        fieldnames (list): The CSV columns.
+        flush_every (int): Number of rows to buffer before writing them to disk.
+        store (str): Optional CSV file shared between runs (e.g. of a sweep).
+        keys (list): Columns identifying a row in the store.
+    """
+
+    def __init__(self, path, fieldnames, flush_every=10, store=None, keys=None):
+        self.path = path
+        self.fieldnames = fieldnames
+        if keys is None:
+            keys = [column for column in fieldnames if column not in metrics_columns]
+        self.keys = keys
+        self.flush_every = flush_every
+        self.store = store
+        self.temp_path = f"{path}.{os.getpid()}.tmp"
+        self.file = open(self.temp_path, 'w', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=fieldnames)
+        self.writer.writeheader()
+        self.buffer = []
+        self.rows = []
+
+    def writerow(self, row):
+        self.buffer.append(row)
+        self.rows.append(row)
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.writer.writerows(self.buffer)
+        self.buffer = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        """Write any buffered rows and move the completed file into place."""
+        if self.file.closed:
+            return
+        self.flush()
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+        if self.store:
+            os.makedirs(os.path.dirname(os.path.abspath(self.store)), exist_ok=True)
+            append_rows(self.store, self.fieldnames, self.rows, keys=self.keys)
+
+    def abort(self):
+        """Close and remove the temporary file without replacing `path` (e.g. after an error)."""
+        if not self.file.closed:
+            self.file.close()
+        if os.path.isfile(self.temp_path):
+            os.remove(self.temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+# Types of the metrics columns (others are inferred)
+results_dtypes = {'Model': 'category', 'Convolution': 'category', 'Base': 'category',
+                  'Weights': 'category', 'Set': 'category', 'Type': 'category',
+                  'Noise': 'category', 'Trial': 'Int32', 'Seed': 'Int64', 'LI': 'Int32'}
+
+
+def set_results_dtypes(df):
+    """Convert the columns of a metrics table to their compact types."""
+    if 'Weights' in df:
+        df['Weights'] = df['Weights'].astype(object).fillna("None").astype(str)
+    return df.astype({column: dtype for column, dtype in results_dtypes.items() if column in df})
+
+
+class ResultsIndex:
+    """Incremental catalogue of the metrics files in a results directory.
+
+    The files matching `pattern` are consolidated into a single typed table
+    (with a `File` column recording the source of each row) which is cached
+    as an Arrow file with a manifest of the size and modification time of
+    each ingested file. Calling `update` only reads files which are new or
+    have changed since the last update and drops the rows of deleted files.
+
+    Args:
+        directory (str): Results directory to search.
+        pattern (str): Glob pattern (relative to `directory`, `**` matches subdirectories).
+        name (str): Name of the cached index (defaults to a hash of the pattern).
+        index_dir (str): Directory for the cached index (defaults to `<directory>/.index`).
+    """
+
+    def __init__(self, directory, pattern="**/*perturb_*.csv", name=None, index_dir=None):
+        self.directory = directory
+        self.pattern = pattern
+        if name is None:
+            name = hashlib.sha1(pattern.encode("utf-8")).hexdigest()[:12]
+        if index_dir is None:
+            index_dir = os.path.join(directory, ".index")
+        self.table_file = os.path.join(index_dir, f"{name}.arrow")
+        self.manifest_file = os.path.join(index_dir, f"{name}.json")
+        self.table, self.manifest = self.load()
+
+    def load(self):
+        if os.path.isfile(self.table_file) and os.path.isfile(self.manifest_file):
+            with open(self.manifest_file, "r") as mf:
+                manifest = json.load(mf)
+            return pd.read_feather(self.table_file), manifest
+        return pd.DataFrame(), {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.table_file), exist_ok=True)
+        suffix = f".{os.getpid()}.tmp"
+        self.table.to_feather(self.table_file + suffix, compression="zstd")
+        os.replace(self.table_file + suffix, self.table_file)
+        with open(self.manifest_file + suffix, "w") as mf:
+            json.dump(self.manifest, mf)
+        os.replace(self.manifest_file + suffix, self.manifest_file)
+
+    def update(self, verbose=0):
+        """Ingest new and changed files and drop deleted ones.
+
+        Returns:
+            int: The number of files read.
+        """
+        files = {os.path.relpath(path, self.directory): path
+                 for path in glob.glob(os.path.join(self.directory, self.pattern), recursive=True)}
+        stats = {}
+        for rel_path, path in files.items():
+            stat = os.stat(path)
+            stats[rel_path] = [stat.st_mtime_ns, stat.st_size]
+        stale = [rel_path for rel_path in self.manifest if self.manifest[rel_path] != stats.get(rel_path)]
+        new = [rel_path for rel_path in stats if self.manifest.get(rel_path) != stats[rel_path]]
+        if verbose:
+            n_removed = sum(rel_path not in stats for rel_path in self.manifest)
+            print(f"Results index: {len(new)} new or changed files, {n_removed} removed "
+                  f"({len(stats)} files in total)")
+        if not stale and not new:
+            return 0
+
+        table = self.table
+        if stale and len(table):
+            table = table[~table["File"].isin(stale)]
+        frames = [pd.read_csv(files[rel_path]).assign(File=rel_path) for rel_path in new]
+        table = pd.concat([table.astype({column: object for column in table.select_dtypes("category")}),
+                           *frames], ignore_index=True)
+        table["File"] = table["File"].astype(str)
+        self.table = set_results_dtypes(table)
+        self.manifest = stats
+        self.save()
+        return len(new)
+
+    def select(self, **filters):
+        """Return the rows matching the filters (a value or list of values per column)."""
+        table = self.table
+        mask = np.ones(len(table), dtype=bool)
+        for column, value in filters.items():
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple, set)):
+                mask &= table[column].isin(value).to_numpy()
+            else:
+                mask &= (table[column] == value).to_numpy()
+        return table[mask]
+
+    def accuracy_curves(self, by=("Model", "Noise"), **filters):
+        """Return the accuracy at each level averaged over trials (and seeds) for each group.
+
+        Returns:
+            pd.DataFrame: Columns `by`, `Level`, `mean`, `std` and `count` (sorted by level).
+        """
+        by = list(by)
+        df = self.select(**filters)
+        return (df.groupby([*by, "Level"], observed=True, sort=True)["Accuracy"]
+                  .agg(["mean", "std", "count"]).reset_index())
+
+    def aucs(self, by=("Model", "Noise"), **filters):
+        """Return the area under the mean accuracy curve (trapezoid rule) for each group."""
+        by = list(by)
+        curves = self.accuracy_curves(by, **filters)
+        groups = curves.groupby(by, observed=True, sort=False)
+        areas = groups["Level"].diff() * (curves["mean"] + groups["mean"].shift()) / 2
+        return (areas.groupby([curves[column] for column in by], observed=True).sum()
+                     .rename("AUC").reset_index())
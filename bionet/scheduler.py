@@ -0,0 +1,187 @@
+"""
+Schedule a sweep of model configurations across several GPUs or CPU slices.
+
+Each worker slot is pinned to a device: a GPU (through `CUDA_VISIBLE_DEVICES`)
+or a slice of the CPU cores (through the process affinity and TensorFlow's
+thread pools). Pending configurations are queued and run as `model.py`
+processes on the free slots, failed jobs are retried and the status of every
+job is recorded in a JSON state file so an interrupted sweep resumes where it
+stopped, skipping the jobs which have completed.
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import subprocess
+from datetime import datetime
+
+
+def get_job_id(args):
+    """Return a stable identifier for a configuration (list of arguments)."""
+    return hashlib.sha1(" ".join(args).encode("utf-8")).hexdigest()[:12]
+
+
+def get_slots(gpus=None, workers_per_gpu=1, n_workers=None):
+    """Return the worker slots for a set of GPUs or, if none are given, slices of the CPU cores.
+
+    Args:
+        gpus (list): GPU indices to run on (`None` or empty to run on CPUs).
+        workers_per_gpu (int): Number of concurrent jobs on each GPU.
+        n_workers (int): Number of CPU workers (defaults to one per 4 cores).
+
+    Returns:
+        list: Slot dictionaries with a `name`, environment variables `env` and `cpus`.
+    """
+    if gpus:
+        return [{"name": f"gpu{gpu}.{w_ind}", "env": {"CUDA_VISIBLE_DEVICES": str(gpu)}, "cpus": None}
+                for gpu in gpus for w_ind in range(workers_per_gpu)]
+
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") \
+           else list(range(os.cpu_count()))
+    if n_workers is None:
+        n_workers = max(1, len(cpus) // 4)
+    assert 0 < n_workers <= len(cpus)
+    slots = []
+    for w_ind in range(n_workers):
+        cpu_slice = cpus[w_ind::n_workers]
+        n_threads = str(len(cpu_slice))
+        slots.append({"name": f"cpu{w_ind}",
+                      "env": {"CUDA_VISIBLE_DEVICES": "-1",
+                              "TF_NUM_INTRAOP_THREADS": n_threads,
+                              "TF_NUM_INTEROP_THREADS": "2",
+                              "OMP_NUM_THREADS": n_threads},
+                      "cpus": cpu_slice})
+    return slots
+
+
+class SweepScheduler:
+    """Run configurations of `model.py` concurrently on a set of worker slots.
+
+    Args:
+        script (str): Path to `model.py`.
+        slots (list): Worker slots from `get_slots`.
+        state_file (str): JSON file recording the status of each job.
+        log_dir (str): Directory for the output of each job (`<job_id>.log`).
+        max_attempts (int): Number of times to run a job before giving up.
+        poll_interval (float): Seconds between checks on the running jobs.
+    """
+
+    def __init__(self, script, slots, state_file, log_dir=None, max_attempts=2, poll_interval=5):
+        self.script = script
+        self.slots = slots
+        self.state_file = state_file
+        if log_dir is None:
+            log_dir = os.path.join(os.path.dirname(os.path.abspath(state_file)), "jobs")
+        self.log_dir = log_dir
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.jobs = self.load_state()
+
+    def load_state(self):
+        if not os.path.isfile(self.state_file):
+            return {}
+        with open(self.state_file, "r") as sf:
+            jobs = json.load(sf)
+        for job in jobs.values():
+            if job["status"] == "running":  # Interrupted
+                job["status"] = "pending"
+        return jobs
+
+    def save_state(self):
+        suffix = f".{os.getpid()}.tmp"
+        with open(self.state_file + suffix, "w") as sf:
+            json.dump(self.jobs, sf, indent=4)
+        os.replace(self.state_file + suffix, self.state_file)
+
+    def add(self, configurations):
+        """Queue configurations (lists of arguments) which are not already recorded."""
+        for args in configurations:
+            job_id = get_job_id(args)
+            if job_id not in self.jobs:
+                self.jobs[job_id] = {"args": list(args), "status": "pending", "attempts": 0,
+                                     "slot": None, "returncode": None, "updated": None}
+        self.save_state()
+
+    def get_command(self, job):
+        """Return the command for a job on its (pinned) device."""
+        args = list(job["args"])
+        if "--gpu" in args:  # The pinned GPU is the only visible device
+            del args[args.index("--gpu"):args.index("--gpu")+2]
+        return [sys.executable, self.script, *args, "--gpu", "0"]
+
+    def launch(self, job_id, slot):
+        job = self.jobs[job_id]
+        job["status"] = "running"
+        job["attempts"] += 1
+        job["slot"] = slot["name"]
+        job["updated"] = datetime.now().isoformat(timespec="seconds")
+        env = {**os.environ, **slot["env"]}
+        cpus = slot["cpus"]
+        preexec_fn = (lambda: os.sched_setaffinity(0, cpus)) \
+                     if cpus and hasattr(os, "sched_setaffinity") else None
+        log = open(os.path.join(self.log_dir, f"{job_id}.log"), "a")
+        log.write(f"[{job['updated']}] Attempt {job['attempts']} on {slot['name']}: "
+                  f"{' '.join(job['args'])}\n")
+        log.flush()
+        process = subprocess.Popen(self.get_command(job), env=env, preexec_fn=preexec_fn,
+                                   stdout=log, stderr=subprocess.STDOUT, text=True)
+        print(f"[{slot['name']}] Started job {job_id} (attempt {job['attempts']}/{self.max_attempts})",
+              flush=True)
+        return process, log
+
+    def finish(self, job_id, returncode):
+        job = self.jobs[job_id]
+        job["returncode"] = returncode
+        job["updated"] = datetime.now().isoformat(timespec="seconds")
+        if returncode == 0:
+            job["status"] = "done"
+        elif job["attempts"] < self.max_attempts:
+            job["status"] = "pending"  # Retry
+        else:
+            job["status"] = "failed"
+        print(f"[{job['slot']}] Job {job_id} {job['status']} (return code {returncode})", flush=True)
+
+    def run(self, configurations=None):
+        """Run all pending jobs (after queuing `configurations`) and return the job states."""
+        if configurations is not None:
+            self.add(configurations)
+        pending = [job_id for job_id, job in self.jobs.items() if job["status"] == "pending"]
+        n_done = sum(job["status"] == "done" for job in self.jobs.values())
+        print(f"Scheduling {len(pending)} jobs on {len(self.slots)} workers "
+              f"({n_done} already completed)...", flush=True)
+        running = {}  # slot index: (job_id, process, log)
+        try:
+            while pending or running:
+                for s_ind, slot in enumerate(self.slots):
+                    if s_ind not in running and pending:
+                        job_id = pending.pop(0)
+                        running[s_ind] = (job_id, *self.launch(job_id, slot))
+                        self.save_state()
+                time.sleep(self.poll_interval)
+                for s_ind in list(running):
+                    job_id, process, log = running[s_ind]
+                    returncode = process.poll()
+                    if returncode is None:
+                        continue
+                    log.close()
+                    del running[s_ind]
+                    self.finish(job_id, returncode)
+                    if self.jobs[job_id]["status"] == "pending":
+                        pending.append(job_id)
+                    self.save_state()
+        except KeyboardInterrupt:
+            print("Interrupted: stopping running jobs...", flush=True)
+            for job_id, process, log in running.values():
+                process.terminate()
+                process.wait()
+                log.close()
+                self.jobs[job_id]["status"] = "pending"
+                self.jobs[job_id]["attempts"] -= 1
+            self.save_state()
+            raise
+        n_failed = sum(job["status"] == "failed" for job in self.jobs.values())
+        print(f"Sweep finished: {len(self.jobs) - n_failed} completed, {n_failed} failed.", flush=True)
+        return self.jobs
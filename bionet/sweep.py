@@ -0,0 +1,87 @@
+"""
+Run a sweep of model configurations in a single process.
+
+Each configuration is a list of command line arguments for `model.py` which is
+executed in the current interpreter (as `python model.py <args>` would) rather
+than in a new subprocess. TensorFlow, the GPUs and the `bionet` modules are
+therefore initialised once and the in-memory caches they hold (e.g. the memory
+mapped dataset store from `load_cifar10_store`) are shared between
+configurations, as are the on-disk training statistics and perturbation caches.
+The Keras session is cleared after each configuration and failures are
+recorded without stopping the sweep.
+"""
+
+import os
+import sys
+import gc
+import time
+import runpy
+import traceback
+from datetime import timedelta
+
+import tensorflow as tf
+
+
+def run_configuration(script, args):
+    """Run `script` in this process with the command line arguments `args`.
+
+    Returns:
+        tuple: (succeeded, message)
+    """
+    argv = sys.argv
+    sys.argv = [script, *args]
+    floatx = tf.keras.backend.floatx()
+    policy = tf.keras.mixed_precision.global_policy()
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as error:
+        # model.py calls sys.exit() when it finishes early (e.g. skipping testing)
+        if error.code not in (None, 0):
+            return False, f"Exited with code {error.code}"
+    except Exception:
+        return False, traceback.format_exc()
+    finally:
+        sys.argv = argv
+        # Reset global state changed by the script (e.g. a mixed precision policy)
+        tf.keras.backend.set_floatx(floatx)
+        tf.keras.mixed_precision.set_global_policy(policy)
+        tf.keras.backend.clear_session()
+        gc.collect()
+    return True, ""
+
+
+def run_sweep(script, configurations, halt_on_error=False, verbose=1):
+    """Run each configuration (list of arguments) of `script` in turn in this process.
+
+    Args:
+        script (str): Path to `model.py`.
+        configurations (list): Lists of command line arguments.
+        halt_on_error (bool): Stop the sweep at the first failed configuration.
+        verbose (int): Print the outcome of each configuration.
+
+    Returns:
+        list: (args, message) for each failed configuration.
+    """
+    failures = []
+    n_succeeded = 0
+    t0 = time.time()
+    for c_ind, args in enumerate(configurations):
+        if verbose:
+            print(f"[{c_ind+1}/{len(configurations)}] {os.path.basename(script)} {' '.join(args)}",
+                  flush=True)
+        t_start = time.time()
+        succeeded, message = run_configuration(script, args)
+        t_elapsed = timedelta(seconds=time.time() - t_start)
+        if succeeded:
+            n_succeeded += 1
+            if verbose:
+                print(f"[{c_ind+1}/{len(configurations)}] Finished [{t_elapsed}]", flush=True)
+            continue
+        print(f"[{c_ind+1}/{len(configurations)}] Failed [{t_elapsed}]:", flush=True)
+        print(message, flush=True)
+        failures.append((args, message))
+        if halt_on_error:
+            break
+    print(f"Sweep finished [{timedelta(seconds=time.time() - t0)}]: "
+          f"{n_succeeded} succeeded, {len(failures)} failed.", flush=True)
+    return failures
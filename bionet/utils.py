@@ -5,18 +5,23 @@ This module contains help functions and general utilities for building custom co
 import os
 import json
 import glob
+import hashlib
+import inspect
+import importlib
+import functools
+import warnings
 # import subprocess
 from pprint import pprint
 
 import pandas as pd
 import numpy as np
-# from scipy import signal
+from scipy import signal
 import cv2
 # from matplotlib import pyplot as plt
 import tensorflow as tf
 from tensorflow.keras import backend as K
 from tensorflow.keras.models import Model
-from tensorflow.keras.layers import Lambda, Input, Conv2D  # , Dense
+from tensorflow.keras.layers import Lambda, Input, Conv2D, MaxPooling2D, Flatten, Dense
 from tensorflow.keras.initializers import Initializer
 from tensorflow.keras.datasets import cifar10
 from tensorflow.python.framework import dtypes
@@ -24,15 +29,17 @@ from tensorflow.keras.utils import to_categorical
 # from K.tensorflow_backend import set_session
 # from K.tensorflow_backend import clear_session
 # from K.tensorflow_backend import get_session
-from sklearn.metrics import auc
 from scipy.integrate import simps
 
 # Needed for load_images
 from tqdm import tqdm
 from matplotlib import pyplot as plt
 
-from bionet.config import (luminance_weights, generalisation_sets, classes)
+from bionet.config import (luminance_weights, generalisation_sets, classes,
+                           fft_kernel_threshold)
 from bionet.preparation import get_perturbations
+from bionet.cache import load_cifar10_store, get_cache_key
+from bionet.results import has_predictions_store, load_predictions_store, ResultsIndex
 # all_test_sets = ['line_drawings', 'silhouettes', 'contours']  # , 'scharr']
 # generalisation_sets = ['line_drawings', 'silhouettes', 'contours',
 #                        'line_drawings_inverted', 'silhouettes_inverted', 'contours_inverted']
@@ -65,9 +72,11 @@ def get_simulation_params(sim_set, model_name, models_dir='/work/models'):
     return sim
 
 
-def get_cifar10_images(colour='grayscale', upscale=True, interpolate=True, fresh=False):
+def get_cifar10_images(colour='grayscale', upscale=True, interpolate=True, fresh=False,
+                       store_dir=None):
 
-    # TODO: Save the processed image arrays to disk and reload if not fresh
+    # NOTE: If `store_dir` is given, the upscaled images are memory-mapped from 
+    # the dataset store (built on first use) unless `fresh` is True
     
     n_classes = len(classes)
     interpolation = cv2.INTER_LANCZOS4  # cv2.INTER_NEAREST, cv2.INTER_LINEAR, cv2.INTER_AREA, cv2.INTER_CUBIC
@@ -82,14 +91,19 @@ def get_cifar10_images(colour='grayscale', upscale=True, interpolate=True, fresh
         image_shape = image_size + (1,)
         # image_shape = (32, 32, 1)
 
+    stored = bool(store_dir) and upscale and interpolate and not fresh
+
     # Set up stimuli
-    (x_train, y_train), (x_test, y_test) = cifar10.load_data()  # RGB format
-    x_train = np.expand_dims(np.dot(x_train, luminance_weights), axis=-1)
-    x_test = np.expand_dims(np.dot(x_test, luminance_weights), axis=-1)
-    y_train = to_categorical(y_train, num_classes=n_classes, dtype='uint8')
-    y_test = to_categorical(y_test, num_classes=n_classes, dtype='uint8')
+    if stored:
+        (x_train, y_train), (x_test, y_test) = load_cifar10_store(store_dir, interpolation, image_size)
+    else:
+        (x_train, y_train), (x_test, y_test) = cifar10.load_data()  # RGB format
+        x_train = np.expand_dims(np.dot(x_train, luminance_weights), axis=-1)
+        x_test = np.expand_dims(np.dot(x_test, luminance_weights), axis=-1)
+        y_train = to_categorical(y_train, num_classes=n_classes, dtype='uint8')
+        y_test = to_categorical(y_test, num_classes=n_classes, dtype='uint8')
 
-    if upscale:
+    if upscale and not stored:
         if interpolate:
             print(f'Interpolating upscaled images with "{interpolation}"...')
             x_train_interp = np.zeros(shape=(x_train.shape[0], *image_shape), dtype=np.float16)
@@ -115,6 +129,7 @@ def get_cifar10_images(colour='grayscale', upscale=True, interpolate=True, fresh
             x_test = x_test.repeat(7, axis=1).repeat(7, axis=2)
 
     # NOTE: This is later overridden by the ImageDataGenerator which has 'float32' as the default
+    # NOTE: This also copies the (read-only) memory-mapped images before normalising them in place
     x_train = x_train.astype(np.float16)
     x_test = x_test.astype(np.float16)
 
@@ -242,7 +257,21 @@ def load_images(path, shuffle=True, verbose=1):
     return image_set, X[shuffle], y[shuffle]
 
 
-def load_predictions(data_set, model_name, verbose=1, results_dir="/work/results"):
+def check_single_seed(df_store, model_name, seed):
+    """Raise an error if predictions loaded without a seed filter come from several seeds."""
+    if seed is None and df_store["Seed"].nunique() > 1:
+        seeds = sorted(df_store["Seed"].unique(), key=int)
+        raise ValueError(f"Predictions of {model_name} are stored for seeds {seeds}: "
+                         f"specify which one to load with `seed`!")
+
+
+def load_predictions(data_set, model_name, verbose=1, results_dir="/work/results", seed=None):
+    """Load the generalisation and perturbation predictions of a model.
+
+    Predictions are read from the columnar store (`bionet.results`) when it
+    exists, otherwise from the legacy per-level CSV files. The `seed` of the
+    model must be given if the store holds the predictions of several seeds.
+    """
 
     # TODO: Reduce the tolerance in np.isclose -->
     # generalisation: 100 images: 1e-2; noise: 10000 images: 1e-4 
@@ -267,6 +296,13 @@ def load_predictions(data_set, model_name, verbose=1, results_dir="/work/results
     df_records = pd.read_csv(records_file)
     df_records["Weights"].replace(np.nan, "None", inplace=True)
 
+    generalise_store = os.path.join(predictions_dir, 'generalise')
+    if has_predictions_store(generalise_store):
+        df_store = load_predictions_store(generalise_store, Model=model_type, Trial=model_run, Seed=seed)
+        check_single_seed(df_store, model_name, seed)
+    else:
+        df_store = None
+
     frames = []
     for image_set in generalisation_sets:
         if image_set.endswith("inverted"):
@@ -275,9 +311,14 @@ def load_predictions(data_set, model_name, verbose=1, results_dir="/work/results
         else:
             inverted = False
             image_set_type = image_set
-        pred_file = os.path.join(predictions_dir, f"{model_name}_{image_set}.csv")
-        probabilities = np.loadtxt(pred_file, delimiter=',', skiprows=0)
-        classifications = np.argmax(probabilities, axis=1)
+        if df_store is not None:
+            df_set = df_store[df_store["Set"] == image_set].sort_values("Image")
+            probabilities = df_set[classes].to_numpy(dtype=np.float32)
+            classifications = df_set["Predicted"].to_numpy()  # Calculated before rounding to float16
+        else:
+            pred_file = os.path.join(predictions_dir, f"{model_name}_{image_set}.csv")
+            probabilities = np.loadtxt(pred_file, delimiter=',', skiprows=0)
+            classifications = np.argmax(probabilities, axis=1)
         assert len(classifications) == len(y_generalise)
         accuracy = sum(classifications == y_generalise) / len(y_generalise)
         mask = (df_records["Model"] == model_type) & \
@@ -314,6 +355,14 @@ def load_predictions(data_set, model_name, verbose=1, results_dir="/work/results
     df_perturb_records = pd.read_csv(perturb_records_file)
     df_perturb_records["Weights"].replace(np.nan, "None", inplace=True)
 
+    perturb_store = os.path.join(predictions_dir, 'perturb')
+    if has_predictions_store(perturb_store):
+        df_store = load_predictions_store(perturb_store, Model=model_type, Trial=model_run,
+                                          Seed=seed, Set=data_set)
+        check_single_seed(df_store, model_name, seed)
+    else:
+        df_store = None
+
     n_levels = 11
     noise_types = get_perturbations(n_levels=n_levels)
     frames = []
@@ -321,9 +370,15 @@ def load_predictions(data_set, model_name, verbose=1, results_dir="/work/results
         if verbose:
             print(f"{noise}: ", end="")
         for l_ind, level in enumerate(levels):
-            pred_file = os.path.join(predictions_dir, f'{model_name}_{noise.replace(" ", "_").lower()}_L{l_ind+1:02d}.csv')
-            probabilities = np.loadtxt(pred_file, delimiter=',', skiprows=0)
-            classifications = np.argmax(probabilities, axis=1)
+            if df_store is not None:
+                df_level = df_store[(df_store["Noise"] == noise) & (df_store["LI"] == str(l_ind))]
+                df_level = df_level.sort_values("Image")
+                probabilities = df_level[classes].to_numpy(dtype=np.float32)
+                classifications = df_level["Predicted"].to_numpy()
+            else:
+                pred_file = os.path.join(predictions_dir, f'{model_name}_{noise.replace(" ", "_").lower()}_L{l_ind+1:02d}.csv')
+                probabilities = np.loadtxt(pred_file, delimiter=',', skiprows=0)
+                classifications = np.argmax(probabilities, axis=1)
             assert len(classifications) == len(y_test)
             accuracy = sum(classifications == y_test) / len(y_test)
 
@@ -489,9 +544,81 @@ def insert_noise_layer(model, layer=None, std=1, verbose=0):
     return model
 
 
+def get_frontend_configuration(filter_type, params):
+    """Return a dictionary of the parameters of each front-end filter type."""
+    if filter_type.capitalize().startswith('Combined'):
+        assert isinstance(params, dict)
+        assert len(params) > 1
+        for layer_type in params:
+            assert isinstance(params[layer_type], dict)
+        return params
+    # Assume an unnested dictionary has been passed
+    return {filter_type: params}
+
+
+def apply_frontend(x, configuration, original_layer, use_initializer=False, noise_std=0,
+                   fft_threshold=fft_kernel_threshold, separable=False, verbose=0):
+    """Apply the front-end convolution(s) to the tensor `x`.
+
+    Args:
+        x: The input tensor.
+        configuration (dict): Parameters of each filter type (`None` keeps the original layer).
+        original_layer (callable): Returns a new instance of the layer being replaced.
+        use_initializer (bool): Generate the fixed kernels with an initializer (else a `Lambda` layer).
+        noise_std (float): Standard deviation of Gaussian noise added after the convolution(s).
+        fft_threshold (int): Minimum kernel size to convolve with FFTs.
+        separable (bool): Convolve low-rank kernels with separable 1-D passes.
+
+    Returns:
+        The output tensor.
+    """
+    for layer_type, params in configuration.items():
+        if params is not None:  # Replace convolutional layer
+            print(f"Replacing layer --> '{layer_type.lower()}_conv'...")
+            if verbose:
+                print(f"{layer_type.capitalize()} filter parameters:")
+                pprint(params)
+            if use_initializer:
+                if layer_type.lower() == 'gabor':
+                    # Parse parameters
+                    assert 'bs' in params
+                    if 'sigmas' not in params:
+                        assert 'lambdas' in params
+                        # params['sigmas'] = [utils.calc_sigma(lambd, b) for lambd in params['lambdas']
+                        #                     for b in params['bs']]
+                    kernel_initializer = GaborInitializer(**params)
+                elif layer_type.lower() == 'dog':
+                    kernel_initializer = DifferenceOfGaussiansInitializer(**params)
+                elif layer_type.lower() == 'low-pass':
+                    kernel_initializer = LowPassInitializer(**params)
+                n_kernels = kernel_initializer.n_kernels
+                # When using this layer as the first layer in a model, provide the keyword argument 
+                # input_shape (tuple of integers, does not include the batch axis), 
+                # e.g. input_shape=(128, 128, 3) for 128x128 RGB pictures in data_format="channels_last".
+
+                # Input shape: (batch, rows, cols, channels)
+                # Output shape: (batch, new_rows, new_cols, filters)
+                x = get_frontend_conv(n_kernels, params['ksize'], padding='same',
+                                      name=f"{layer_type.lower()}_conv",
+                                      kernel_initializer=kernel_initializer,
+                                      fft_threshold=fft_threshold,
+                                      separable=separable)(x)
+            else:  # Deprecated
+                tensor = get_gabor_tensor(**params)  # Generate Gabor filters
+                x = Lambda(convolve_tensor, arguments={'kernel_tensor': tensor},
+                        name=f"{layer_type.lower()}_conv")(x)
+        else:
+            x = original_layer()(x)
+        if noise_std:
+            # Add noise after the convolutional layer
+            x = tf.keras.layers.GaussianNoise(stddev=noise_std)(x)
+    return x
+
+
 def substitute_layer(model, params, filter_type='gabor', replace_layer=1, 
                      input_shape=None, colour_input='rgb', 
-                     use_initializer=False, noise_std=0, verbose=0):
+                     use_initializer=False, noise_std=0,
+                     fft_threshold=fft_kernel_threshold, separable=False, verbose=0):
 
     if replace_layer is None:
         # Attempt to find the first convolutional layer
@@ -499,15 +626,9 @@ def substitute_layer(model, params, filter_type='gabor', replace_layer=1,
     assert isinstance(replace_layer, int)
     assert 0 < replace_layer < len(model.layers)
 
-    if filter_type.capitalize().startswith('Combined'):
-        assert isinstance(params, dict)
-        assert len(params) > 1
-        configuration = params
-        for layer_type in configuration:
-            assert isinstance(configuration[layer_type], dict)
-    else:
-        # Assume an unnested dictionary has been passed
-        configuration = {filter_type: params}
+    configuration = get_frontend_configuration(filter_type, params)
+    if not use_initializer:
+        assert isinstance(model.layers[replace_layer], tf.keras.layers.Conv2D)
 
     for ind, layer in enumerate(model.layers):
         # print(ind, layer.name)
@@ -537,49 +658,13 @@ def substitute_layer(model, params, filter_type='gabor', replace_layer=1,
             x = inp
             print(f"{config['shape']}")
         elif ind == replace_layer:
-            for layer_type, params in configuration.items():
-                if params is not None:  # Replace convolutional layer
-                    print(f"Replacing layer {ind}: '{layer.name}' --> '{layer_type.lower()}_conv'...")
-                    if verbose:
-                        print(f"{layer_type.capitalize()} filter parameters:")
-                        pprint(params)
-                    if use_initializer:
-                        if layer_type.lower() == 'gabor':
-                            # Parse parameters
-                            assert 'bs' in params
-                            if 'sigmas' not in params:
-                                assert 'lambdas' in params
-                                # params['sigmas'] = [utils.calc_sigma(lambd, b) for lambd in params['lambdas']
-                                #                     for b in params['bs']]
-                            kernel_initializer = GaborInitializer(**params)
-                        elif layer_type.lower() == 'dog':
-                            kernel_initializer = DifferenceOfGaussiansInitializer(**params)
-                        elif layer_type.lower() == 'low-pass':
-                            kernel_initializer = LowPassInitializer(**params)
-                        n_kernels = kernel_initializer.n_kernels
-                        # When using this layer as the first layer in a model, provide the keyword argument 
-                        # input_shape (tuple of integers, does not include the batch axis), 
-                        # e.g. input_shape=(128, 128, 3) for 128x128 RGB pictures in data_format="channels_last".
-
-                        # Input shape: (batch, rows, cols, channels)
-                        # Output shape: (batch, new_rows, new_cols, filters)
-                        x = Conv2D(n_kernels, params['ksize'], padding='same', 
-                                activation='relu', use_bias=True,
-                                #    activation=None, use_bias=False,
-                                name=f"{layer_type.lower()}_conv",
-                                kernel_initializer=kernel_initializer, 
-                                trainable=False)(x)
-                    else:  # Deprecated
-                        assert isinstance(layer, tf.keras.layers.Conv2D)
-                        tensor = get_gabor_tensor(**params)  # Generate Gabor filters
-                        x = Lambda(convolve_tensor, arguments={'kernel_tensor': tensor},
-                                name=f"{layer_type.lower()}_conv")(x)
-                else:
-                    x = tf.keras.layers.deserialize({'class_name': layer.__class__.__name__, 
-                                                    'config': layer.get_config()})(x)
-                if noise_std:
-                    # Add noise after the convolutional layer
-                    x = tf.keras.layers.GaussianNoise(stddev=noise_std)(x)
+            original_layer = functools.partial(tf.keras.layers.deserialize,
+                                               {'class_name': layer.__class__.__name__,
+                                                'config': layer.get_config()})
+            print(f"Replacing layer {ind}: '{layer.name}'...")
+            x = apply_frontend(x, configuration, original_layer,
+                               use_initializer=use_initializer, noise_std=noise_std,
+                               fft_threshold=fft_threshold, separable=separable, verbose=verbose)
         # elif ind == replace_layer + 1 and params is not None:  # Replace next layer
         #     # Check input_shape matches output_shape?
         #     # x = Conv2D(**layers[layer].get_config())(x)
@@ -600,6 +685,127 @@ def substitute_layer(model, params, filter_type='gabor', replace_layer=1,
     return model
 
 
+# Number of convolutional layers in each block of the VGG architectures
+vgg_blocks = {'vgg16': (2, 2, 3, 3, 3), 'vgg19': (2, 2, 4, 4, 4)}
+
+
+def build_vgg(base_name, params, filter_type='Original', input_shape=(224, 224), colour_input='grayscale',
+              classes=10, use_initializer=False, noise_std=0, fft_threshold=fft_kernel_threshold,
+              separable=False, verbose=0):
+    """Build a VGG-16 or VGG-19 model with a front-end in place of its first convolutional layer.
+
+    The architecture is the same as `substitute_layer` applied to the Keras
+    `VGG16` or `VGG19` application (with `include_top=True` and no weights)
+    but is built directly, without instantiating the base model and then
+    rebuilding it layer by layer.
+
+    Args:
+        base_name (str): 'vgg16' or 'vgg19'.
+        params (dict): Front-end filter parameters (see `substitute_layer`).
+        filter_type (str): The front-end filter type (e.g. 'Gabor', 'DoG', 'Low-pass', 'Combined' or 'Original').
+        input_shape (tuple): (rows, cols) of the input images.
+        colour_input (str): 'rgb' or 'grayscale'.
+        classes (int): Number of output classes.
+
+    Returns:
+        tf.keras.Model: The (randomly initialised) model.
+    """
+    assert base_name in vgg_blocks
+    assert colour_input in ('rgb', 'grayscale'), f"Unknown colour_input: {colour_input}"
+    channels = 3 if colour_input == 'rgb' else 1
+    configuration = get_frontend_configuration(filter_type, params)
+
+    inp = Input(shape=(*input_shape, channels), name='input_1')
+    x = inp
+    for b_ind, n_convs in enumerate(vgg_blocks[base_name]):
+        filters = min(64 * 2**b_ind, 512)
+        for c_ind in range(n_convs):
+            conv_layer = functools.partial(Conv2D, filters, (3, 3), activation='relu', padding='same',
+                                           name=f'block{b_ind+1}_conv{c_ind+1}')
+            if b_ind == 0 and c_ind == 0:
+                print(f"Building {base_name} with a {filter_type} front-end...")
+                x = apply_frontend(x, configuration, conv_layer,
+                                   use_initializer=use_initializer, noise_std=noise_std,
+                                   fft_threshold=fft_threshold, separable=separable, verbose=verbose)
+            else:
+                x = conv_layer()(x)
+        x = MaxPooling2D((2, 2), strides=(2, 2), name=f'block{b_ind+1}_pool')(x)
+    x = Flatten(name='flatten')(x)
+    x = Dense(4096, activation='relu', name='fc1')(x)
+    x = Dense(4096, activation='relu', name='fc2')(x)
+    x = Dense(classes, activation='softmax', name='predictions')(x)
+
+    if noise_std:
+        name = f"{filter_type}_noise_{base_name}"
+    else:
+        name = f"{filter_type}_{base_name}"
+    return Model(inputs=inp, outputs=x, name=name)
+
+
+def split_frontend(model):
+    """Split a model after its frozen front-end convolutional layer(s).
+
+    The front-end is the prefix of layers (e.g. the input, padding and the 
+    fixed Gabor, DoG or Low-pass convolutions) up to the last frozen 
+    convolutional layer which have no trainable weights. The back-end is 
+    rebuilt from a new input of the front-end's output shape by calling the 
+    original (shared) layers so training the back-end trains the full model.
+
+    Args:
+        model (tf.keras.Model): A model with a frozen front-end (e.g. from `substitute_layer`).
+
+    Returns:
+        tuple: (frontend, backend) models.
+    """
+    cut = None
+    for ind, layer in enumerate(model.layers):
+        if isinstance(layer, Conv2D) and not layer.trainable:
+            cut = ind
+        elif layer.trainable_weights:
+            break
+    assert cut is not None, f"No frozen front-end convolutional layer found in {model.name}!"
+    cut_layer = model.layers[cut]
+    print(f"Splitting {model.name} after layer {cut}: '{cut_layer.name}'")
+
+    frontend = Model(inputs=model.inputs, outputs=cut_layer.output, name=f"{model.name}_frontend")
+
+    inp = Input(shape=cut_layer.output_shape[1:], name=f"{cut_layer.name}_features")
+    tensors = {id(cut_layer.output): inp}
+    for layer in model.layers[cut+1:]:
+        # Map the layer's original inputs to the rebuilt tensors (each layer is called once)
+        inputs = tf.nest.map_structure(lambda tensor: tensors[id(tensor)], layer.input)
+        outputs = layer(inputs)
+        for tensor, new_tensor in zip(tf.nest.flatten(layer.output), tf.nest.flatten(outputs)):
+            tensors[id(tensor)] = new_tensor
+    outputs = tf.nest.map_structure(lambda tensor: tensors[id(tensor)], model.outputs)
+    backend = Model(inputs=inp, outputs=outputs, name=f"{model.name}_backend")
+    return frontend, backend
+
+
+def cast_output(model, dtype='float32'):
+    """Return the model with its final softmax computed in `dtype`.
+
+    Under a mixed precision policy the layers compute in (b)float16 so the 
+    softmax is split from its layer (sharing the weights) and computed in 
+    float32 for numerical stability. The weighted layers are unchanged so 
+    saved weights load as before.
+    """
+    layer = model.layers[-1]
+    if getattr(layer, 'activation', None) is not tf.keras.activations.softmax:
+        return model
+    if isinstance(layer, tf.keras.layers.Activation):
+        outputs = tf.keras.layers.Activation('softmax', dtype=dtype, name=layer.name)(layer.input)
+    else:
+        config = layer.get_config()
+        config['activation'] = 'linear'
+        logits_layer = layer.__class__.from_config(config)
+        logits = logits_layer(layer.input)
+        logits_layer.set_weights(layer.get_weights())
+        outputs = tf.keras.layers.Activation('softmax', dtype=dtype, 
+                                             name=f"{layer.name}_softmax")(logits)
+    return Model(inputs=model.inputs, outputs=outputs, name=model.name)
+
+
 def substitute_output(model, n_classes=16):
 
     if model.get_layer(index=-1).output_shape[-1] == n_classes:
@@ -662,6 +868,7 @@ class DifferenceOfGaussiansInitializer(Initializer):
             assert gamma > 1
         self.gammas = gammas
         self.verbose = verbose
+        self.separable_rank = 2  # Difference of two separable Gaussians
 
     def __call__(self, shape, dtype=None):
         """Returns a tensor object initialized as specified by the initializer.
@@ -721,7 +928,8 @@ class DifferenceOfGaussiansInitializer(Initializer):
         kernel_tensor = K.stack(kernels, axis=-1)
 
         if dtype:
-            assert dtype in ('float16', 'float32', 'float64')
+            dtype = dtypes.as_dtype(dtype).name  # Accept DTypes (e.g. from a mixed precision policy)
+            assert dtype in ('float16', 'bfloat16', 'float32', 'float64')
             if self.verbose:
                 print(f"Casting to {dtype=}")
         else:
@@ -820,7 +1028,8 @@ class GaborInitializer(Initializer):
         # print(gf.get_shape())
         gf_tensor = K.stack(gabors, axis=-1)  # (ksize[0], ksize[1], 1, n_kernels)
         if dtype:
-            assert dtype in ('float16', 'float32', 'float64')
+            dtype = dtypes.as_dtype(dtype).name  # Accept DTypes (e.g. from a mixed precision policy)
+            assert dtype in ('float16', 'bfloat16', 'float32', 'float64')
             if self.verbose:
                 print(f"Casting to {dtype=}")
         else:
@@ -862,6 +1071,7 @@ class LowPassInitializer(Initializer):
         self.sigmas = sigmas
         self.n_kernels = len(self.sigmas)
         self.verbose = verbose
+        self.separable_rank = 1  # Outer product of 1-D Gaussians
 
     def __call__(self, shape, dtype=None):  #, partition_info=None):
         """Returns a tensor object initialized as specified by the initializer.
@@ -913,7 +1123,8 @@ class LowPassInitializer(Initializer):
         # return K.stack(kernels, axis=-1)
         tensor = K.stack(kernels, axis=-1)
         if dtype:
-            assert dtype in ('float16', 'float32', 'float64')
+            dtype = dtypes.as_dtype(dtype).name  # Accept DTypes (e.g. from a mixed precision policy)
+            assert dtype in ('float16', 'bfloat16', 'float32', 'float64')
             if self.verbose:
                 print(f"Casting to {dtype=}")
         else:
@@ -964,6 +1175,493 @@ class KernelInitializer(Initializer):
         return self.params
 
 
+def next_fast_len(n):
+    """Return the smallest 5-smooth integer >= n (an efficient FFT length)."""
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+
+class FFTConv2D(Conv2D):
+    """Conv2D layer computed as a product of spectra for large kernels.
+
+    The convolution (Keras' cross-correlation) is evaluated with batched real
+    FFTs, padded to avoid circular wrap-around and cropped to the 'same' or
+    'valid' output. When the layer is frozen the kernel spectra are computed
+    once and reused for every batch (call `refresh_spectrum` after changing the
+    kernel). The weights are identical to those of Conv2D so saved models
+    remain interchangeable.
+    """
+
+    def __init__(self, filters, kernel_size, **kwargs):
+        super().__init__(filters, kernel_size, **kwargs)
+        assert self.padding in ('same', 'valid')
+        assert self.data_format == 'channels_last'
+        assert tuple(self.strides) == (1, 1)
+        assert tuple(self.dilation_rate) == (1, 1)
+        assert getattr(self, 'groups', 1) == 1
+        # Bypass variable tracking so the weights match those of Conv2D
+        object.__setattr__(self, '_spectrum', None)
+        self.image_size = None
+        self.fft_shape = None
+
+    def build(self, input_shape):
+        super().build(input_shape)
+        input_shape = tf.TensorShape(input_shape)
+        rows, cols = input_shape[1], input_shape[2]
+        assert rows is not None and cols is not None, "FFTConv2D requires a fixed image size"
+        kh, kw = self.kernel_size
+        self.image_size = (rows, cols)  # Inputs may be traced without a static shape
+        self.fft_shape = (next_fast_len(rows + kh - 1), next_fast_len(cols + kw - 1))
+        if not self.trainable:
+            self.refresh_spectrum()
+
+    def get_spectrum(self):
+        """Return the kernel spectra with shape (in_channels, filters, *fft_shape)."""
+        # Flip the kernel to compute a correlation as Conv2D does
+        kernel = tf.reverse(tf.cast(self.kernel, tf.float32), axis=[0, 1])
+        kernel = tf.transpose(kernel, [2, 3, 0, 1])
+        return tf.signal.rfft2d(kernel, fft_length=self.fft_shape)
+
+    def refresh_spectrum(self):
+        """Recompute the stored kernel spectra from the current kernel."""
+        if self.fft_shape is None:  # Not yet built
+            return
+        with tf.init_scope():
+            spectrum = self.get_spectrum()
+            if self._spectrum is None:
+                object.__setattr__(self, '_spectrum',
+                                   tf.Variable(spectrum, trainable=False, name='spectrum'))
+            else:
+                self._spectrum.assign(spectrum)
+
+    def set_weights(self, weights):
+        super().set_weights(weights)
+        self.refresh_spectrum()
+
+    def call(self, inputs):
+        if self.trainable or self._spectrum is None:
+            spectrum = self.get_spectrum()
+        else:
+            spectrum = self._spectrum
+        rows, cols = self.image_size
+        kh, kw = self.kernel_size
+        x = tf.transpose(tf.cast(inputs, tf.float32), [0, 3, 1, 2])
+        x = tf.signal.rfft2d(x, fft_length=self.fft_shape)
+        x = tf.einsum('nchw,cohw->nohw', x, spectrum)
+        x = tf.signal.irfft2d(x, fft_length=self.fft_shape)
+        if self.padding == 'same':
+            top, left = kh - 1 - (kh - 1) // 2, kw - 1 - (kw - 1) // 2
+        else:  # 'valid'
+            top, left = kh - 1, kw - 1
+            rows, cols = rows - kh + 1, cols - kw + 1
+        x = x[:, :, top:top + rows, left:left + cols]
+        outputs = tf.cast(tf.transpose(x, [0, 2, 3, 1]), self.compute_dtype)
+        if self.use_bias:
+            outputs = tf.nn.bias_add(outputs, tf.cast(self.bias, self.compute_dtype))
+        if self.activation is not None:
+            outputs = self.activation(outputs)
+        return outputs
+
+
+class SeparableKernelConv2D(Conv2D):
+    """Conv2D layer computed as a sum of separable (1-D column and row) passes.
+
+    Each kernel is factorised by SVD into `separable_rank` outer products, so a rank-1
+    (e.g. Gaussian low-pass) kernel costs two 1-D passes and a rank-2
+    (difference of Gaussians) kernel two pairs, i.e. O(k) rather than O(k^2)
+    operations per pixel. The factors are precomputed while the layer is frozen
+    (call `refresh_factors` after changing the kernel) and the weights are
+    identical to those of Conv2D.
+
+    Kernels which are not exactly separable (e.g. Gabor) may be approximated by
+    passing a relative (Frobenius norm) error `tolerance` instead of a
+    `separable_rank`:
+    the smallest rank meeting the tolerance for every kernel is chosen when the
+    layer is built.
+    """
+
+    def __init__(self, filters, kernel_size, separable_rank=None, tolerance=None, **kwargs):
+        super().__init__(filters, kernel_size, **kwargs)
+        assert self.padding in ('same', 'valid')
+        assert self.data_format == 'channels_last'
+        assert tuple(self.strides) == (1, 1)
+        assert tuple(self.dilation_rate) == (1, 1)
+        assert getattr(self, 'groups', 1) == 1
+        if separable_rank is None and tolerance is None:
+            separable_rank = 1
+        if separable_rank is not None:
+            assert 0 < separable_rank <= min(self.kernel_size)
+            separable_rank = int(separable_rank)
+        self.separable_rank = separable_rank
+        self.tolerance = tolerance
+        # Bypass variable tracking so the weights match those of Conv2D
+        object.__setattr__(self, '_factors', None)
+
+    def build(self, input_shape):
+        super().build(input_shape)
+        if self.separable_rank is None:
+            with tf.init_scope():
+                self.separable_rank = get_low_rank(self.kernel.numpy(), self.tolerance)
+        if not self.trainable:
+            self.refresh_factors()
+
+    def get_approximation_errors(self):
+        """Return the relative (Frobenius norm) error of each kernel's factorisation."""
+        with tf.init_scope():
+            return get_approximation_errors(self.kernel.numpy(), self.separable_rank)
+
+    def get_factors(self):
+        """Return the depthwise (column, row) kernels of the truncated SVD."""
+        kh, kw = self.kernel_size
+        n_in, n_out = self.kernel.shape[2], self.kernel.shape[3]
+        kernel = tf.transpose(tf.cast(self.kernel, tf.float32), [2, 3, 0, 1])
+        s, u, v = tf.linalg.svd(kernel)  # (in, out, min(kh, kw)), (in, out, kh, .), (in, out, kw, .)
+        scale = tf.sqrt(s[..., tf.newaxis, :self.separable_rank])
+        columns = tf.transpose(u[..., :self.separable_rank] * scale, [2, 0, 1, 3])
+        rows = tf.transpose(v[..., :self.separable_rank] * scale, [2, 0, 1, 3])
+        # Depthwise kernels: (kh, 1, in, out * rank) and (1, kw, in * out * rank, 1)
+        columns = tf.reshape(columns, (kh, 1, n_in, n_out * self.separable_rank))
+        rows = tf.reshape(rows, (1, kw, n_in * n_out * self.separable_rank, 1))
+        return columns, rows
+
+    def refresh_factors(self):
+        """Recompute the stored separable factors from the current kernel."""
+        if not self.built:
+            return
+        with tf.init_scope():
+            factors = self.get_factors()
+            if self._factors is None:
+                object.__setattr__(self, '_factors',
+                                   tuple(tf.Variable(f, trainable=False) for f in factors))
+            else:
+                for variable, factor in zip(self._factors, factors):
+                    variable.assign(factor)
+
+    def set_weights(self, weights):
+        super().set_weights(weights)
+        self.refresh_factors()
+
+    def get_config(self):
+        config = super().get_config()
+        config['separable_rank'] = self.separable_rank
+        config['tolerance'] = self.tolerance
+        return config
+
+    def call(self, inputs):
+        if self.trainable or self._factors is None:
+            columns, rows = self.get_factors()
+        else:
+            columns, rows = self._factors
+        padding = self.padding.upper()
+        x = tf.cast(inputs, tf.float32)
+        x = tf.nn.depthwise_conv2d(x, columns, strides=(1, 1, 1, 1), padding=padding)
+        x = tf.nn.depthwise_conv2d(x, rows, strides=(1, 1, 1, 1), padding=padding)
+        # Sum the rank-1 terms over the input channels and ranks
+        n_in, n_out = self.kernel.shape[2], self.kernel.shape[3]
+        x = tf.reshape(x, tf.concat([tf.shape(x)[:3], [n_in, n_out, self.separable_rank]], axis=0))
+        outputs = tf.cast(tf.reduce_sum(x, axis=(3, 5)), self.compute_dtype)
+        if self.use_bias:
+            outputs = tf.nn.bias_add(outputs, tf.cast(self.bias, self.compute_dtype))
+        if self.activation is not None:
+            outputs = self.activation(outputs)
+        return outputs
+
+
+def get_separable_factors(kernel, rank=None, tol=1e-6):
+    """Factorise a 2D kernel into `rank` (column, row) pairs by SVD.
+
+    If `rank` is None, the numerical rank (relative tolerance `tol`) is used.
+    """
+    u, s, vt = np.linalg.svd(kernel)
+    if rank is None:
+        rank = max(1, int(np.sum(s > tol * s[0])))
+    scale = np.sqrt(s[:rank])
+    return [(u[:, r] * scale[r], vt[r] * scale[r]) for r in range(rank)]
+
+
+def separable_convolve2d(image, kernel, rank=None):
+    """Equivalent of `signal.convolve2d(image, kernel, mode='same')` with 1-D passes."""
+    filtered = np.zeros(image.shape, dtype=np.result_type(image, kernel))
+    for column, row in get_separable_factors(kernel, rank):
+        pass_1 = signal.convolve2d(image, column[:, np.newaxis], mode='same')
+        filtered += signal.convolve2d(pass_1, row[np.newaxis, :], mode='same')
+    return filtered
+
+
+def get_approximation_errors(kernel, rank):
+    """Return the relative error of the rank-`rank` SVD of each kernel.
+
+    Args:
+        kernel (np.ndarray): Conv2D kernel with shape (rows, cols, in, out).
+        rank (int): Number of separable terms.
+
+    Returns:
+        np.ndarray: Errors with shape (in, out).
+    """
+    s = np.linalg.svd(np.transpose(kernel, (2, 3, 0, 1)), compute_uv=False)
+    energy = np.sum(s**2, axis=-1)
+    residual = np.sum(s[..., rank:]**2, axis=-1)
+    return np.sqrt(residual / np.maximum(energy, np.finfo(s.dtype).tiny))
+
+
+def get_low_rank(kernel, tolerance):
+    """Return the smallest rank approximating every kernel within `tolerance`."""
+    for rank in range(1, min(kernel.shape[:2]) + 1):
+        if np.all(get_approximation_errors(kernel, rank) <= tolerance):
+            return rank
+    return min(kernel.shape[:2])
+
+
+def rebuild_model(model, replace, name=None):
+    """Return a copy of a (functional) model with some of its layers replaced.
+
+    Args:
+        model (tf.keras.Model): The model to copy.
+        replace (callable): Called as `replace(layer, inputs)` for each layer 
+            and returns the outputs of a replacement layer or None to reuse 
+            (share) the original layer.
+        name (str): Name of the new model (defaults to the original name).
+
+    Returns:
+        tf.keras.Model: The rebuilt model.
+    """
+    tensors = {id(tensor): tensor for tensor in model.inputs}
+    for layer in model.layers:
+        if isinstance(layer, tf.keras.layers.InputLayer):
+            continue
+        inputs = tf.nest.map_structure(lambda tensor: tensors[id(tensor)], layer.input)
+        outputs = replace(layer, inputs)
+        if outputs is None:
+            outputs = layer(inputs)
+        for tensor, new_tensor in zip(tf.nest.flatten(layer.output), tf.nest.flatten(outputs)):
+            tensors[id(tensor)] = new_tensor
+    outputs = tf.nest.map_structure(lambda tensor: tensors[id(tensor)], model.outputs)
+    return Model(inputs=model.inputs, outputs=outputs, name=name or model.name)
+
+
+def approximate_frontend(model, tolerance, verbose=1):
+    """Return a copy of a model with its frozen front-end convolutions approximated
+    by low-rank separable convolutions (`SeparableKernelConv2D`).
+
+    The other layers (and their weights) are shared with the original model.
+
+    Args:
+        model (tf.keras.Model): A model with a frozen front-end (e.g. from `substitute_layer`).
+        tolerance (float): Maximum relative (Frobenius norm) error of each kernel.
+        verbose (int): Print the rank and approximation error of each kernel.
+
+    Returns:
+        tf.keras.Model: The approximated model.
+    """
+    def approximate(layer, inputs):
+        if not (isinstance(layer, Conv2D) and not layer.trainable and max(layer.kernel_size) > 1):
+            return None
+        config = layer.get_config()
+        for key in ('separable_rank', 'tolerance', 'kernel_initializer'):
+            config.pop(key, None)
+        rank = get_low_rank(layer.get_weights()[0], tolerance)
+        approximation = SeparableKernelConv2D(separable_rank=rank, tolerance=tolerance, **config)
+        outputs = approximation(inputs)
+        approximation.set_weights(layer.get_weights())
+        errors = approximation.get_approximation_errors()
+        print(f"Approximating '{layer.name}' with rank {approximation.separable_rank}: "
+              f"max error = {errors.max():.2e} (tolerance = {tolerance:.2e})")
+        if verbose:
+            for ind, error in enumerate(errors.max(axis=0)):
+                print(f"    Kernel {ind:3d}: error = {error:.2e}")
+        return outputs
+
+    return rebuild_model(model, approximate, name=f"{model.name}_lowrank")
+
+
+def as_standard_convolutions(model):
+    """Return a copy of a model with the front-end layers (FFTConv2D and 
+    SeparableKernelConv2D) replaced by Conv2D layers with the same weights 
+    (e.g. for conversion to other formats)."""
+    def standardise(layer, inputs):
+        if not isinstance(layer, (FFTConv2D, SeparableKernelConv2D)):
+            return None
+        config = layer.get_config()
+        for key in ('separable_rank', 'tolerance', 'kernel_initializer'):
+            config.pop(key, None)
+        conv = Conv2D(**config)
+        outputs = conv(inputs)
+        conv.set_weights(layer.get_weights())
+        return outputs
+
+    return rebuild_model(model, standardise)
+
+
+def select_frontend_conv(ksize, kernel_initializer, fft_threshold=fft_kernel_threshold,
+                         separable=False):
+    """Return the (class, kwargs) of the fastest front-end convolution or None for Conv2D.
+
+    Kernels with a known low rank (`separable_rank` of the initializer) are
+    convolved with 1-D passes when `separable` is set, otherwise FFTConv2D is
+    selected when the largest kernel dimension is at least `fft_threshold`
+    (set to 0 or None to disable).
+    """
+    rank = getattr(kernel_initializer, 'separable_rank', None)
+    ksize_max = max(ksize) if isinstance(ksize, (tuple, list)) else ksize
+    if separable and rank is not None:
+        return SeparableKernelConv2D, {'separable_rank': rank}
+    if fft_threshold and ksize_max >= fft_threshold:
+        return FFTConv2D, {}
+    return None
+
+
+def get_frontend_conv(n_kernels, ksize, name, kernel_initializer, padding='same',
+                      fft_threshold=fft_kernel_threshold, separable=False):
+    """Return a frozen front-end convolution using `select_frontend_conv`."""
+    conv, kwargs = select_frontend_conv(ksize, kernel_initializer, fft_threshold,
+                                        separable) or (Conv2D, {})
+    return conv(n_kernels, ksize, padding=padding, activation='relu', use_bias=True,
+                name=name, kernel_initializer=kernel_initializer, trainable=False, **kwargs)
+
+
+def refresh_precomputed_kernels(model):
+    """Recompute the cached spectra and factors of front-end layers (e.g. after load_weights)."""
+    for layer in model.layers:
+        if isinstance(layer, FFTConv2D):
+            layer.refresh_spectrum()
+        elif isinstance(layer, SeparableKernelConv2D):
+            layer.refresh_factors()
+        elif isinstance(layer, Model):
+            refresh_precomputed_kernels(layer)
+
+
+class TrainingCheckpoint(tf.keras.callbacks.Callback):
+    """Checkpoint the weights, optimizer state and epoch counter after every epoch.
+
+    The checkpoints are written to a directory for each model (trial and seed)
+    so concurrent runs do not overwrite each other. The state of other
+    callbacks (e.g. the plateau counter of `ReduceLROnPlateau`) is saved
+    alongside so that training resumes exactly where it stopped.
+
+    Args:
+        directory (str): Directory to store the checkpoints in.
+        model (tf.keras.Model): The model (whose layers are shared by the model being fit).
+        optimizer: The optimizer of the model being fit.
+        callbacks (dict): Callbacks (by name) with state to save.
+        max_to_keep (int): Number of checkpoints to keep.
+    """
+
+    callback_state = ('wait', 'best', 'cooldown_counter')
+
+    def __init__(self, directory, model, optimizer, callbacks=None, max_to_keep=2):
+        super().__init__()
+        self.directory = directory
+        self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False, name='epoch')
+        self.checkpoint = tf.train.Checkpoint(model=model, optimizer=optimizer, epoch=self.epoch)
+        self.manager = tf.train.CheckpointManager(self.checkpoint, directory, max_to_keep=max_to_keep)
+        self.callbacks = callbacks or {}
+        self.state_file = os.path.join(directory, "callbacks.json")
+        self.restored_state = None
+
+    def restore(self):
+        """Restore the latest checkpoint (if any) and return the number of completed epochs."""
+        if self.manager.latest_checkpoint is None:
+            return 0
+        self.checkpoint.restore(self.manager.latest_checkpoint)
+        if os.path.isfile(self.state_file):
+            with open(self.state_file, 'r') as sf:
+                self.restored_state = json.load(sf)
+        print(f"Restored {self.manager.latest_checkpoint} after epoch {int(self.epoch.numpy())}")
+        return int(self.epoch.numpy())
+
+    def on_train_begin(self, logs=None):
+        # Other callbacks reset their state when training begins so restore it afterwards
+        for name, state in (self.restored_state or {}).items():
+            if name in self.callbacks:
+                for attribute, value in state.items():
+                    setattr(self.callbacks[name], attribute, value)
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epoch.assign(epoch + 1)
+        self.manager.save(checkpoint_number=epoch + 1)
+        state = {name: {attribute: np.asarray(getattr(callback, attribute)).item()
+                        for attribute in self.callback_state if hasattr(callback, attribute)}
+                 for name, callback in self.callbacks.items()}
+        suffix = f".{os.getpid()}.tmp"
+        with open(self.state_file + suffix, 'w') as sf:
+            json.dump(state, sf, indent=4)
+        os.replace(self.state_file + suffix, self.state_file)
+
+
+# Custom classes which may appear in a model's JSON configuration
+architecture_objects = {'GaborInitializer': GaborInitializer,
+                        'DifferenceOfGaussiansInitializer': DifferenceOfGaussiansInitializer,
+                        'LowPassInitializer': LowPassInitializer,
+                        'FFTConv2D': FFTConv2D,
+                        'SeparableKernelConv2D': SeparableKernelConv2D}
+
+
+# Modules whose code builds the architectures (in addition to the builder itself)
+architecture_modules = ("bionet.utils", "bionet.bases")
+
+
+def get_source_digest(build, modules=architecture_modules):
+    """Return a hash of the source code of a builder function and the named modules."""
+    digest = hashlib.sha1()
+    for name in sorted(set(modules)):
+        with open(inspect.getfile(importlib.import_module(name)), "rb") as sf:
+            digest.update(sf.read())
+    try:
+        digest.update(inspect.getsource(build).encode("utf-8"))
+    except (OSError, TypeError):  # Defined interactively
+        warnings.warn(f"The source of {build!r} is unavailable so changes to it will not invalidate "
+                      f"cached architectures!")
+    return digest.hexdigest()
+
+
+def get_architecture(build, cache_dir=None, verbose=0, **config):
+    """Build a model or load its architecture from a cache of JSON configurations.
+
+    The cache is keyed by a hash of `config` (which must determine the
+    architecture built by `build`), the source code of `build` and the
+    `architecture_modules` (so changes to the builders or their initializers
+    invalidate the cache), the TensorFlow version and the global
+    precision policy. Only the architecture is cached: the weights are
+    initialised afresh either way, so `build` should not load weights.
+
+    Args:
+        build (callable): Returns the model when it is not cached.
+        cache_dir (str): Directory of cached architectures (`None` disables the cache).
+        verbose (int): Print whether the architecture was loaded from the cache.
+        **config: JSON serialisable parameters of the architecture.
+
+    Returns:
+        tf.keras.Model: The model.
+    """
+    if not cache_dir:
+        return build()
+    source = get_source_digest(build)
+    key = get_cache_key(**config, source=source, tensorflow=tf.__version__,
+                        policy=tf.keras.mixed_precision.global_policy().name)
+    path = os.path.join(cache_dir, f"{key}.json")
+    if os.path.isfile(path):
+        if verbose:
+            print(f"Loading cached architecture: {path}")
+        with open(path, "r") as af:
+            return tf.keras.models.model_from_json(af.read(), custom_objects=architecture_objects)
+
+    model = build()
+    os.makedirs(cache_dir, exist_ok=True)
+    suffix = f".{os.getpid()}.tmp"
+    with open(path + suffix, "w") as af:
+        af.write(model.to_json())
+    os.replace(path + suffix, path)
+    if verbose:
+        print(f"Cached architecture: {path}")
+    return model
+
+
 def load_model(data_set, name, project_root_dir=None, verbose=0):
     # TODO: Check shape and dtype work
     # TODO: Restore optimizer state (and ReduceLR)
@@ -1008,7 +1706,9 @@ def load_model(data_set, name, project_root_dir=None, verbose=0):
         custom_objects = {'DifferenceOfGaussiansInitializer': DifferenceOfGaussiansInitializer(**filter_params['DoG']),
                           'GaborInitializer': GaborInitializer(**filter_params['Gabor'])}
     else:
-        custom_objects = None
+        custom_objects = {}
+    custom_objects['FFTConv2D'] = FFTConv2D
+    custom_objects['SeparableKernelConv2D'] = SeparableKernelConv2D
     if verbose:
         print("Parameters: ")
         pprint(filter_params)
@@ -1023,6 +1723,7 @@ def load_model(data_set, name, project_root_dir=None, verbose=0):
     # with CustomObjectScope(custom_objects):
     model = tf.keras.models.model_from_json(config, custom_objects)
     model.load_weights(os.path.join(path_to_model, f"{stub}_weights.h5"))
+    refresh_precomputed_kernels(model)
     if verbose:
         model.summary()
 
@@ -1062,11 +1763,12 @@ def get_perturbation_results(tag):
     tag = 'noise_s_0_2'
     sigma = 0.2
     seed =  1895185933 #1086513891  #2817631224
-    pattern = f'/work/results/{tag}/perturb_*s{seed}.csv'
+    pattern = f'perturb_*s{seed}.csv'
     output = f'/work/results/{tag}/perturb_noise_{sigma}_Set.csv'
-    df = pd.concat([pd.read_csv(file) for file in glob.glob(pattern)], ignore_index=True)
+    index = ResultsIndex(f'/work/results/{tag}', pattern, name=f"perturb_s{seed}")
+    index.update()
+    df = index.table[columns].copy()
     df["Weights"] = "None"
-    df = df[columns]
     df.sort_values(by=['Trial', 'Noise', 'Level'], inplace=True, ignore_index=True)
     df.to_csv(output, index=False)
     frames.append(pd.read_csv(output))
@@ -1076,33 +1778,101 @@ def get_perturbation_results(tag):
     return perturbations
 
 
-def calc_aucs(df, verbose=1):
-    
-    # noise_types = df.Noise.unique().tolist()
-    noise_types = ["Uniform", "Salt and Pepper", "High Pass", "Low Pass", 
-                   "Contrast", "Phase Scrambling", "Darken", "Brighten", 
-                   "Rotation", "Invert"]
-    models = df.Model.unique().tolist()
-    convolutions = df.Convolution.unique().tolist()
-    bases = df.Base.unique().tolist()
+def calc_aucs(df, noise_types=None, n_bootstrap=1000, confidence=0.95, seed=0, verbose=1):
+    """Calculate the area under the accuracy curves of every model for every noise type.
+
+    The perturbation results are arranged into an array of accuracies indexed
+    by (model, noise, trial, level) so the trapezoid and Simpson areas of all
+    the curves are computed at once. The levels of each noise are sorted into
+    ascending order (so the areas are positive) and noise types may have
+    different numbers of levels. Since both rules are linear in the
+    accuracies, the area of the curve averaged over trials is the mean of the
+    areas of each trial. Confidence intervals are estimated by resampling the
+    trials of each model with replacement.
+
+    Args:
+        df (pd.DataFrame): Perturbation results with Model, Noise, Trial, Level and Accuracy columns.
+        noise_types (list): Noise types to include (defaults to those reported in the paper).
+        n_bootstrap (int): Number of bootstrap samples of the trials (0 skips the intervals).
+        confidence (float): Width of the confidence intervals.
+        seed (int): Seed for the bootstrap samples.
+        verbose (int): Print the areas.
+
+    Returns:
+        pd.DataFrame: One row per (Model, Noise) with the number of trials, the
+            trapezoid (`AUC`) and Simpson (`Simpson`) areas and their `_lower` and `_upper` bounds.
+    """
 
-    if verbose > 1:
-        print(noise_types)
-        print(models)
-        print(convolutions)
-        print(bases)
-
-    scores = {}
-    for noise in noise_types:
-        scores[noise] = {}
-        for model in models:
-            query = f"Noise == '{noise}' and Model == '{model}'"
-            x = df.query(f"{query} and Trial == 1").Level.to_numpy()
-            y = df.query(query).groupby('Level').mean().Accuracy.to_numpy()  # Average over trials
-
-            scores[noise][model] = auc(x, y)
-            if verbose:
-                print(f'{noise:16} | {model:14}: AUC = {scores[noise][model]:6.3f} | SIMP = {simps(y, x):7.3f}')
-        if verbose:
+    if noise_types is None:
+        noise_types = ["Uniform", "Salt and Pepper", "High Pass", "Low Pass", 
+                       "Contrast", "Phase Scrambling", "Darken", "Brighten", 
+                       "Rotation", "Invert"]
+    df = df[df.Noise.isin(noise_types)]
+
+    # Average any repeated measurements (e.g. seeds) of each point of each curve
+    df = df.groupby(['Model', 'Noise', 'Trial', 'Level'], observed=True, sort=False,
+                    as_index=False)['Accuracy'].mean()
+    model_codes, models = pd.factorize(df['Model'].astype(str), sort=True)
+    noise_order = [noise for noise in noise_types if noise in set(df['Noise'].astype(str))]
+    noise_codes = pd.Categorical(df['Noise'].astype(str), categories=noise_order).codes
+    trial_codes, _ = pd.factorize(df['Trial'], sort=True)
+    # Index of each level in ascending order within its noise type
+    level_codes = df.groupby('Noise', observed=True)['Level'].rank(method='dense').to_numpy(dtype=int) - 1
+
+    n_models, n_noise = len(models), len(noise_order)
+    n_trials, n_levels = trial_codes.max() + 1, level_codes.max() + 1
+    accuracy = np.full((n_models, n_noise, n_trials, n_levels), np.nan)
+    accuracy[model_codes, noise_codes, trial_codes, level_codes] = df['Accuracy'].to_numpy()
+    levels = np.full((n_noise, n_levels), np.nan)
+    levels[noise_codes, level_codes] = df['Level'].to_numpy()
+    n_noise_levels = np.sum(~np.isnan(levels), axis=1)
+
+    # Areas of each trial: (models, noise, trials)
+    x = levels[np.newaxis, :, np.newaxis, :]
+    trapezoids = np.diff(x, axis=-1) * (accuracy[..., 1:] + accuracy[..., :-1]) / 2
+    trapz_areas = np.where(np.all(np.isnan(trapezoids), axis=-1), np.nan,
+                           np.nansum(trapezoids, axis=-1))
+    simps_areas = np.full(trapz_areas.shape, np.nan)
+    for n_points in np.unique(n_noise_levels):
+        noise_mask = n_noise_levels == n_points
+        y = accuracy[:, noise_mask, :, :n_points]
+        x_points = np.broadcast_to(x[:, noise_mask, :, :n_points], y.shape)
+        simps_areas[:, noise_mask] = simps(y, x=x_points, axis=-1)
+    # A trial is missing a curve if it has no (or incomplete) results
+    trial_mask = np.sum(~np.isnan(accuracy), axis=-1) == n_noise_levels[np.newaxis, :, np.newaxis]
+    trapz_areas[~trial_mask] = np.nan
+    simps_areas[~trial_mask] = np.nan
+    n_curves = trial_mask.sum(axis=-1)
+
+    scores = {'AUC': trapz_areas, 'Simpson': simps_areas}
+    results = {'Model': np.repeat(models, n_noise), 'Noise': np.tile(noise_order, n_models),
+               'Trials': n_curves.ravel()}
+    if n_bootstrap:
+        rng = np.random.default_rng(seed)
+        # Resample the available trials of each curve with replacement (as indices of the flattened areas)
+        offsets = np.arange(n_models * n_noise).reshape(n_models, n_noise, 1) * n_trials
+        order = np.argsort(~trial_mask, axis=-1, kind='stable') + offsets  # Available trials first
+        draws = (rng.random((n_bootstrap, n_models, n_noise, n_trials))
+                 * n_curves[..., np.newaxis]).astype(np.int64)
+        samples = order.ravel()[draws + offsets]
+        sample_mask = np.arange(n_trials) < n_curves[..., np.newaxis]
+        tail = (1 - confidence) / 2 * 100
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)  # Curves without any results
+        for name, areas in scores.items():
+            results[name] = np.nanmean(areas, axis=-1).ravel()
+            if n_bootstrap:
+                resampled = areas.ravel()[samples]
+                means = np.sum(np.where(sample_mask, resampled, 0), axis=-1) / n_curves
+                lower, upper = np.percentile(means, [tail, 100 - tail], axis=0)
+                results[f'{name}_lower'] = lower.ravel()
+                results[f'{name}_upper'] = upper.ravel()
+    aucs = pd.DataFrame(results)
+    aucs = aucs[aucs['Trials'] > 0].reset_index(drop=True)
+
+    if verbose:
+        for noise, df_noise in aucs.groupby('Noise', sort=False):
+            for row in df_noise.itertuples():
+                print(f'{noise:16} | {row.Model:14}: AUC = {row.AUC:6.3f} | SIMP = {row.Simpson:7.3f}')
             print('-' * 64)
-    return scores
+    return aucs
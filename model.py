@@ -6,8 +6,9 @@ import argparse
 import pprint
 import warnings
 import functools
-import csv
 import json
+import hashlib
+import shutil
 from datetime import datetime, timedelta
 import time
 import gc
@@ -43,7 +44,7 @@ from bionet.config import (#data_set, classes, n_classes,
                            luminance_weights,
                            colour, contrast_level,
                            upscale, image_size, image_shape, train_image_stats,
-                           interpolation_names,
+                           interpolation_names, fft_kernel_threshold,
 #                            data_dir, models_dir, logs_dir, results_dir,
                            max_queue_size, workers, use_multiprocessing,
                            report, extension,
@@ -59,7 +60,15 @@ from bionet.preparation import (#as_perturbation_fn, as_greyscale_perturbation_f
                                 rotate_image, adjust_brightness, 
                                 invert_luminance)
 from bionet.bases import BioResNet50, allcnn, allcnn_imagenet
-from bionet.assess import test_noise_perturbations
+from bionet.assess import test_noise_perturbations, calculate_metrics, compare_perturbation_results
+from bionet.cache import (load_cifar10_store, get_cache_key, cache_features, load_features, 
+                          FeatureSequence, load_statistics, store_statistics, 
+                          get_statistics_path, build_lock)
+from bionet.pipeline import (UpscaledImages, get_upscaling_dataset, calculate_statistics,
+                             calculate_directory_statistics, get_dataset, list_image_files,
+                             load_image_batch)
+from bionet.quantisation import get_representative_dataset, export_int8_model, QuantisedModel
+from bionet.results import write_predictions, MetricsWriter
 
 
 # try:
@@ -172,6 +181,38 @@ parser.add_argument('--save_images', action='store_true', default=False, require
                     help='Flag to save preprocessed (perturbed) test images')
 parser.add_argument('-p', '--save_predictions', action='store_true', default=False, required=False,  # type=bool, 
                     help='Flag to save category predictions')
+parser.add_argument('--single_pass', action='store_true', default=False, required=False,
+                    help='Flag to derive the loss, accuracy and predictions from a single pass through the test images')
+parser.add_argument('--vectorise_perturbations', action='store_true', default=False, required=False,
+                    help='Flag to perturb whole batches of test images at once')
+parser.add_argument('--seed_per_image', action='store_true', default=False, required=False,
+                    help='Flag to seed stochastic perturbations for each test image so they can be generated in parallel (implies --vectorise_perturbations)')
+parser.add_argument('--cache_perturbations', action='store_true', default=False, required=False,
+                    help='Flag to cache perturbed test images on disk for reuse across models (implies --vectorise_perturbations). '
+                         'Each 224x224 CIFAR10 level takes 2 GB (about 220 GB for the whole battery) and the cache is '
+                         'limited to perturbation_cache_max_size GB (see bionet/config.py)')
+parser.add_argument('--dataset_store', action='store_true', default=False, required=False,
+                    help='Flag to memory-map the upscaled CIFAR10 images from a store on disk (built on first use)')
+parser.add_argument('--lazy_upscaling', action='store_true', default=False, required=False,
+                    help='Flag to keep CIFAR10 at 32x32 and upscale each batch as it is used (implies --vectorise_perturbations)')
+parser.add_argument('--tf_data', action='store_true', default=False, required=False,
+                    help='Flag to train with a tf.data input pipeline instead of the ImageDataGenerator')
+parser.add_argument('--cache_frontend', action='store_true', default=False, required=False,
+                    help='Flag to precompute the responses of the frozen front-end and train only the rest of the model')
+parser.add_argument('--quantise_frontend', action='store_true', default=False, required=False,
+                    help='Flag to store the cached front-end responses as uint8')
+parser.add_argument('--fft_threshold', type=int, default=fft_kernel_threshold, required=False,
+                    help='Minimum front-end kernel size to convolve with FFTs (0 disables)')
+parser.add_argument('--separable_kernels', action='store_true', default=False, required=False,
+                    help='Flag to convolve low-rank (Low-pass and DoG) kernels with separable 1-D passes')
+parser.add_argument('--low_rank_tolerance', type=float, default=0, required=False,
+                    help='Also test a low-rank separable approximation of the front-end with this relative error per kernel (0 disables)')
+parser.add_argument('--mixed_precision', action='store_true', default=False, required=False,
+                    help='Flag to train and test with a mixed precision policy (float16 on GPUs, bfloat16 on CPUs)')
+parser.add_argument('--quantise_int8', action='store_true', default=False, required=False,
+                    help='Flag to export an int8 quantised TensorFlow Lite model and test it on the perturbations (on CPU)')
+parser.add_argument('--metrics_store', type=str, default='', required=False,
+                    help='Directory of CSV files shared between runs (e.g. of a sweep) to append the metrics of each completed run to')
 parser.add_argument('--gpu', type=int, default=0, required=False,
                     help='GPU ID to run on')
 parser.add_argument('--project_dir', type=str, default='',
@@ -187,7 +228,11 @@ if not args:
 
 # gpus = tf.config.experimental.list_physical_devices('GPU')
 assert 0 <= args["gpu"] <= len(gpus)
-tf.config.experimental.set_visible_devices(gpus[args["gpu"]], 'GPU')
+if gpus:  # Running on CPUs otherwise (e.g. a CPU slot of bionet.scheduler)
+    try:
+        tf.config.experimental.set_visible_devices(gpus[args["gpu"]], 'GPU')
+    except RuntimeError:  # Already initialised e.g. by a previous run in the same process (bionet.sweep)
+        print(f"Visible devices already set: {tf.config.get_visible_devices('GPU')}")
 
 convolution = args['convolution']
 base = args['base']
@@ -216,6 +261,32 @@ internal_noise = args['internal_noise']
 skip_test = args['skip_test']
 save_images = args['save_images']
 save_predictions = args['save_predictions']
+single_pass = args['single_pass']
+vectorise_perturbations = args['vectorise_perturbations']
+seed_per_image = args['seed_per_image']
+cache_perturbations = args['cache_perturbations']
+dataset_store = args['dataset_store']
+lazy_upscaling = args['lazy_upscaling']
+tf_data = args['tf_data'] or lazy_upscaling
+cache_validation = False  # Cache the normalised validation images in memory with tf.data
+cache_frontend = args['cache_frontend']
+quantise_frontend = args['quantise_frontend']
+fft_threshold = args['fft_threshold']
+separable_kernels = args['separable_kernels']
+low_rank_tolerance = args['low_rank_tolerance']
+quantise_int8 = args['quantise_int8']
+metrics_store = args['metrics_store']
+mixed_precision = args['mixed_precision']
+if mixed_precision:
+    # Compute in 16 bits with float32 variables (and softmax outputs)
+    precision_policy = 'mixed_float16' if gpus else 'mixed_bfloat16'
+else:
+    precision_policy = 'float32'
+tf.keras.mixed_precision.set_global_policy(precision_policy)
+print(f"Precision policy: {precision_policy}")
+if lazy_upscaling:
+    # The perturbations are applied to slices of the lazily upscaled test images
+    vectorise_perturbations = True
 seed = args['seed']  # 420420420
 trial = args['trial']
 label = args['label']
@@ -380,6 +451,13 @@ data_dir = os.path.join(project_dir, "data")
 models_dir = os.path.join(project_dir, "models")
 logs_dir = os.path.join(project_dir, "logs")
 results_dir = os.path.join(project_dir, "results")
+frontend_cache_dir = os.path.join(data_dir, "cache", "frontend")
+if cache_frontend:
+    os.makedirs(frontend_cache_dir, exist_ok=True)
+if cache_perturbations:
+    perturbation_cache_dir = os.path.join(data_dir, "cache", "perturbations")
+else:
+    perturbation_cache_dir = None
 
 # data_dir = '/work/data'
 # # Output paths
@@ -478,15 +556,31 @@ else:  # Default to standard CIFAR10 training and testing images
 #     classes = ('airplane', 'automobile', 'bird', 'cat', 'deer', 
 #                'dog', 'frog', 'horse', 'ship', 'truck')
 #     n_classes = len(classes)
-    (x_train, y_train), (x_test, y_test) = cifar10.load_data()  # RGB format
-    x_train = np.expand_dims(np.dot(x_train, luminance_weights), axis=-1)
-    x_test = np.expand_dims(np.dot(x_test, luminance_weights), axis=-1)
-    y_train = to_categorical(y_train, num_classes=n_classes, dtype='uint8')
-    y_test = to_categorical(y_test, num_classes=n_classes, dtype='uint8')
+    if lazy_upscaling and upscale:
+        # Keep the uint8 RGB images and upscale them as batches are requested
+        print(f'Upscaling images lazily with "{interpolation}" ({interpolation_name})...')
+        (x_train_source, y_train), (x_test_source, y_test) = cifar10.load_data()  # RGB format
+        y_train = to_categorical(y_train, num_classes=n_classes, dtype='uint8')
+        y_test = to_categorical(y_test, num_classes=n_classes, dtype='uint8')
+        x_train = UpscaledImages(x_train_source, image_size=image_size, interpolation=interpolation)
+        x_test = UpscaledImages(x_test_source, image_size=image_size, interpolation=interpolation)
+    elif dataset_store and upscale:
+        # Luminance-converted, upscaled and clipped images (read-only memory maps)
+        print(f'Loading upscaled images with "{interpolation}" ({interpolation_name}) from the dataset store...')
+        (x_train, y_train), (x_test, y_test) = load_cifar10_store(os.path.join(data_dir, "store"), 
+                                                                  interpolation, image_size)
+    else:
+        (x_train, y_train), (x_test, y_test) = cifar10.load_data()  # RGB format
+        x_train = np.expand_dims(np.dot(x_train, luminance_weights), axis=-1)
+        x_test = np.expand_dims(np.dot(x_test, luminance_weights), axis=-1)
+        y_train = to_categorical(y_train, num_classes=n_classes, dtype='uint8')
+        y_test = to_categorical(y_test, num_classes=n_classes, dtype='uint8')
 
 # print('-' * 80)
 if not load_images_from_disk or preload:
-    if upscale:
+    # Stored images are already upscaled (lazily upscaled images are never materialised)
+    stored = not load_images_from_disk and (dataset_store or lazy_upscaling) and upscale
+    if upscale and not stored:
         if interpolation:  #interpolate:
             print(f'Interpolating upscaled images with "{interpolation}" ({interpolation_name})...')
             x_train_interp = np.zeros(shape=(x_train.shape[0], *image_shape), dtype=np.float16)
@@ -512,8 +606,9 @@ if not load_images_from_disk or preload:
             x_test = x_test.repeat(7, axis=1).repeat(7, axis=2)
 
     # NOTE: This is later overridden by the ImageDataGenerator to tf.keras.backend.floatx() (default: 'float32')
-    x_train = x_train.astype(np.float16)
-    x_test = x_test.astype(np.float16)
+    if not stored:  # Avoid copying the memory-mapped arrays
+        x_train = x_train.astype(np.float16)
+        x_test = x_test.astype(np.float16)
 
     # TODO: Implement for testing stimuli
     # if weights == 'imagenet':
@@ -548,7 +643,20 @@ if not load_images_from_disk or preload:
 # Default normalisation method
 featurewise_normalisation = True
 samplewise_normalisation = False
-        
+# Statistics calculated previously for this dataset and preprocessing
+statistics_cache_dir = os.path.join(data_dir, "cache", "statistics")
+architecture_cache_dir = os.path.join(data_dir, "cache", "architectures")
+statistics_key = {'data_set': data_set, 'interpolation': interpolation_name,
+                  'colour': colour, 'image_size': image_size}
+if load_images_from_disk:
+    # Datasets in different directories may share a name
+    n_train_images = len(list_image_files(os.path.join(image_path, 'train'))[0])
+    statistics_key['source'] = {'image_path': os.path.realpath(image_path), 'n_images': n_train_images}
+if recalculate_statistics:
+    cached_statistics = None
+else:
+    cached_statistics = load_statistics(statistics_cache_dir, **statistics_key)
+
 if (not recalculate_statistics
     and colour == 'grayscale'
     and image_size == (224, 224)
@@ -556,44 +664,33 @@ if (not recalculate_statistics
     and interpolation_name in train_image_stats[data_set.lower()]):
     
     mean, std = train_image_stats[data_set.lower()][interpolation_name]
-else:  # Featurewise statistics not cached
+elif cached_statistics is not None:
+    print(f'Loading cached training image statistics for {data_set} ({interpolation_name})...')
+    mean, std = cached_statistics
+else:  # Featurewise statistics not cached
     print(f'Uncached interpolation method: {interpolation_name} for {data_set}!')
-    recalculate_statistics = True
-
-    print('Recalculating training image statistics...')    
-    if load_images_from_disk:
-        featurewise_normalisation = False
-        samplewise_normalisation = True
-        mean = None
-        std = None
-        print("INFO: Loading images form disk so switching to samplewise normalisation.")
-#         # Fit to a random sample of images from directory
-#         gen_train_sample = data_gen.flow_from_directory(
-#             os.path.join(image_path, 'train'),
-#             target_size=image_size,
-#             color_mode=colour,
-#             interpolation='lanczos',
-#             batch_size=1024,
-#             shuffle=True,
-#             seed=0,
-#             save_to_dir=None,
-#             follow_links=True,
-#             subset=None
-#         )
-#         data_gen.fit(gen_train_sample)
-
-#         mean = np.squeeze(data_gen.mean).tolist()
-#         std = np.squeeze(data_gen.std).tolist()
-    else:
-        featurewise_normalisation = True
-        samplewise_normalisation = False
-        data_gen = ImageDataGenerator(featurewise_center=featurewise_normalisation,
-                                      featurewise_std_normalization=featurewise_normalisation)
-        data_gen.fit(x_train)
-
-        # TODO: Calculate statistics from sample and unindent below
-        mean = np.squeeze(data_gen.mean).tolist()
-        std = np.squeeze(data_gen.std).tolist()
+    # Wait for any concurrent run calculating the same statistics then check the cache again
+    with build_lock(get_statistics_path(statistics_cache_dir, **statistics_key)):
+        if not recalculate_statistics:
+            cached_statistics = load_statistics(statistics_cache_dir, **statistics_key)
+        if cached_statistics is not None:
+            print(f'Loading training image statistics for {data_set} ({interpolation_name}) cached by another run...')
+            mean, std = cached_statistics
+        else:
+            recalculate_statistics = True
+
+            print('Recalculating training image statistics...')
+            t0 = time.time()
+            if load_images_from_disk:
+                # Stream the training images from disk (resized as by flow_from_directory)
+                mean, std = calculate_directory_statistics(os.path.join(image_path, 'train'), 
+                                                           image_size=image_size, 
+                                                           interpolation=interpolation_name, 
+                                                           colour=colour, workers=workers)
+            else:
+                mean, std = calculate_statistics(x_train)
+            print(f'Calculated statistics in {time.time() - t0:.1f}s')
+            store_statistics(statistics_cache_dir, mean, std, **statistics_key)
 print(f'Training statistics: mean={mean}; std={std}')
 
 # Save metadata
@@ -630,12 +727,22 @@ sim = {
     'luminance_rgb_weights': luminance_weights.tolist(),
     'contrast_level': contrast_level,
     'save_predictions': save_predictions,
+    'single_pass': single_pass,
+    'vectorise_perturbations': vectorise_perturbations,
+    'seed_per_image': seed_per_image,
+    'perturbation_cache_dir': perturbation_cache_dir,
     'image_out_dir': image_out_dir,
     'models_dir': models_dir,
     'results_dir': results_dir,
     'use_initializer': use_initializer,
 #     'add_noise': add_noise,
     'internal_noise': internal_noise,
+    'fft_threshold': fft_threshold,
+    'separable_kernels': separable_kernels,
+    'low_rank_tolerance': low_rank_tolerance,
+    'precision_policy': precision_policy,
+    'quantise_int8': quantise_int8,
+    'metrics_store': metrics_store,
     'filter_params': params,
     }
 
@@ -700,30 +807,60 @@ else:
     output_classes = 1000  # Default
 base_name = base.lower().replace('-', '')
 
-if base_name not in ["resnet"]:  # List of hard-coded exceptions
-    model = model_base[base_name](include_top=True, 
-                              weights=weights, 
-                            #   input_tensor=input_tensor,
-                              input_shape=image_shape,
-                              classes=output_classes)
-    # if add_noise:
-    #     model = utils.insert_noise_layer(model, layer=None, std=noise)
-    model = utils.substitute_layer(model, params,
-                                   filter_type=convolution,
-                                   replace_layer=None,
-                                   input_shape=image_size,
-                                   colour_input=colour,
-                                   use_initializer=use_initializer,
-                                   noise_std=internal_noise)
-else:
-    model = model_base[base_name](include_top=True, 
-                                  weights=weights,
-                                  kernels=filter_params,
-                                  # input_tensor=input_tensor,
+def build_model():
+    if base_name in utils.vgg_blocks and weights is None and use_initializer:
+        # Build the final architecture directly rather than rebuilding the Keras application
+        return utils.build_vgg(base_name, params,
+                               filter_type=convolution,
+                               input_shape=image_size,
+                               colour_input=colour,
+                               classes=n_classes,
+                               use_initializer=use_initializer,
+                               noise_std=internal_noise,
+                               fft_threshold=fft_threshold,
+                               separable=separable_kernels)
+    if base_name not in ["resnet"]:  # List of hard-coded exceptions
+        model = model_base[base_name](include_top=True, 
+                                  weights=weights, 
+                                #   input_tensor=input_tensor,
                                   input_shape=image_shape,
                                   classes=output_classes)
-if n_classes != output_classes:  # 1000:
-    model = utils.substitute_output(model, n_classes=n_classes)
+        # if add_noise:
+        #     model = utils.insert_noise_layer(model, layer=None, std=noise)
+        model = utils.substitute_layer(model, params,
+                                       filter_type=convolution,
+                                       replace_layer=None,
+                                       input_shape=image_size,
+                                       colour_input=colour,
+                                       use_initializer=use_initializer,
+                                       noise_std=internal_noise,
+                                       fft_threshold=fft_threshold,
+                                       separable=separable_kernels)
+    else:
+        model = model_base[base_name](include_top=True, 
+                                      weights=weights,
+                                      kernels=filter_params,
+                                      # input_tensor=input_tensor,
+                                      input_shape=image_shape,
+                                      classes=output_classes,
+                                      fft_threshold=fft_threshold,
+                                      separable=separable_kernels)
+    if n_classes != output_classes:  # 1000:
+        model = utils.substitute_output(model, n_classes=n_classes)
+    return model
+
+
+if weights is None and use_initializer:
+    # Randomly initialised architectures are cached by their configuration
+    model = utils.get_architecture(build_model, cache_dir=architecture_cache_dir, verbose=1,
+                                   base=base_name, convolution=convolution, params=params,
+                                   filter_params=filter_params, image_shape=image_shape,
+                                   colour=colour, n_classes=n_classes, internal_noise=internal_noise,
+                                   fft_threshold=fft_threshold, separable=separable_kernels)
+else:
+    model = build_model()
+if mixed_precision:
+    model = utils.cast_output(model, dtype='float32')
 
 opt_args = {'lr': lr, 'decay': decay}
 # if optimizer in []:
@@ -748,18 +885,15 @@ model_data_file = f"{full_path_to_model}_weights.{extension}"
 if not train:
     print(f"Loading {model_name}...", flush=True)
     model.load_weights(model_data_file)
+    utils.refresh_precomputed_kernels(model)
     print(f"{model_name} loaded!", flush=True)
 else:
     # Create Image Data Generators
+    # NOTE: The augmentation arguments are shared with the tf.data pipeline
     if data_augmentation:
         if extra_augmentation:
             print('Using extra data augmentation.')
-            data_gen = ImageDataGenerator(
-                featurewise_center=featurewise_normalisation,  # True,
-                featurewise_std_normalization=featurewise_normalisation,  # True,
-                samplewise_center=samplewise_normalisation,  # False,
-                samplewise_std_normalization=samplewise_normalisation,  # False,
-                zca_whitening=False,
+            augmentation = dict(
                 rotation_range=45,
                 brightness_range=(0.2, 1.0),
                 shear_range=0.2,
@@ -772,25 +906,23 @@ else:
                 vertical_flip=False)
         else:
             print('Using data augmentation.')
-            data_gen = ImageDataGenerator(
-                featurewise_center=featurewise_normalisation,  # True,
-                featurewise_std_normalization=featurewise_normalisation,  # True,
-                samplewise_center=samplewise_normalisation,  # False,
-                samplewise_std_normalization=samplewise_normalisation,  # False,
-                zca_whitening=False,
+            augmentation = dict(
                 rotation_range=0,
                 width_shift_range=0.1,
                 height_shift_range=0.1,
                 horizontal_flip=True,
                 vertical_flip=False)
     else:
-        data_gen = ImageDataGenerator(
-            #preprocessing_function=prep_image,
-            featurewise_center=featurewise_normalisation,
-            featurewise_std_normalization=featurewise_normalisation,
-            samplewise_center=samplewise_normalisation,
-            samplewise_std_normalization=samplewise_normalisation,
-        )
+        augmentation = {}
+    data_gen = ImageDataGenerator(
+        #preprocessing_function=prep_image,
+        featurewise_center=featurewise_normalisation,
+        featurewise_std_normalization=featurewise_normalisation,
+        samplewise_center=samplewise_normalisation,
+        samplewise_std_normalization=samplewise_normalisation,
+        zca_whitening=False,
+        **augmentation
+    )
     # data_gen.fit(x_train)
     if featurewise_normalisation:
         data_gen.mean = mean
@@ -798,7 +930,17 @@ else:
 
     # NOTE: When classes=None, the dictionary containing the mapping from class names to class indices can be obtained via the attribute class_indices.
 
-    if load_images_from_disk:
+    if load_images_from_disk and tf_data:
+        train_files, train_labels = list_image_files(os.path.join(image_path, 'train'))
+        gen_train = get_dataset(train_files, train_labels, batch, mean=mean, std=std, 
+                                augmentation=augmentation, shuffle=True, seed=seed, 
+                                repeat=True, image_size=image_size, colour=colour, 
+                                interpolation=interpolation_names[interpolation])
+        valid_files, valid_labels = list_image_files(validation_image_path)
+        gen_valid = get_dataset(valid_files, valid_labels, batch, mean=mean, std=std, 
+                                cache=cache_validation, image_size=image_size, colour=colour, 
+                                interpolation=interpolation_names[interpolation])
+    elif load_images_from_disk:
         gen_train = data_gen.flow_from_directory(
             os.path.join(image_path, 'train'),
             target_size=image_size,
@@ -826,16 +968,39 @@ else:
             interpolation=interpolation_names[interpolation],
             subset=None
         )
+    elif lazy_upscaling:
+        gen_train = get_upscaling_dataset(x_train_source, y_train, batch, image_size=image_size, 
+                                          interpolation=interpolation, mean=mean, std=std, 
+                                          shuffle=True, seed=seed, augmentation=augmentation, 
+                                          repeat=True)
+        gen_valid = get_upscaling_dataset(x_test_source, y_test, batch, image_size=image_size, 
+                                          interpolation=interpolation, mean=mean, std=std)
+    elif tf_data or stored:
+        # Memory-mapped images from the store are gathered by index (ImageDataGenerator.flow would copy them)
+        gen_train = get_dataset(x_train, y_train, batch, mean=mean, std=std, 
+                                augmentation=augmentation, shuffle=True, seed=seed, 
+                                repeat=True)
+        gen_valid = get_dataset(x_test, y_test, batch, mean=mean, std=std, 
+                                cache=cache_validation)
     else:
         gen_train = data_gen.flow(x_train, y=y_train, batch_size=batch, 
                                     shuffle=True, seed=seed, save_to_dir=None)
         gen_valid = data_gen.flow(x_test, y=y_test, batch_size=batch, 
                                     shuffle=True, seed=seed, save_to_dir=None)
 
+    if isinstance(gen_train, tf.data.Dataset):
+        # The training dataset repeats so the steps per epoch are set by the number of images
+        n_train = len(train_files) if load_images_from_disk else len(y_train)
+        train_steps = int(np.ceil(n_train / batch))
+    else:
+        train_steps = len(gen_train)
+    valid_steps = len(gen_valid)
+
     print(f'Checking for {model_data_file}...', flush=True)
     if os.path.exists(model_data_file) and not clean:
         print(f"Found {mod} - skipping training...", flush=True)
         model.load_weights(model_data_file)  # TODO: Check load_weights works when the whole model is saved
+        utils.refresh_precomputed_kernels(model)
         print(f"{model_name} loaded!", flush=True)
     else:
         print(f"Training {mod} for {epochs} epochs...", flush=True)
@@ -849,18 +1014,10 @@ else:
             tensorboard_cb = tf.keras.callbacks.TensorBoard(log_dir=logdir, histogram_freq=5, update_freq='epoch')  # 2048)
             callbacks.append(tensorboard_cb)
 
-        resume_training = False
         csv_logger_cb = tf.keras.callbacks.CSVLogger(os.path.join(logs_dir, f'{model_name}.csv'), 
-                                                        append=resume_training, separator=',')
+                                                        append=False, separator=',')
         callbacks.append(csv_logger_cb)
 
-        # Create a callback that saves the model's weights
-        checkpoint_path = os.path.join(models_dir, "model.ckpt")  # f"{model_name}.ckpt"
-        checkpoint_cb = tf.keras.callbacks.ModelCheckpoint(filepath=checkpoint_path,
-                                                           save_weights_only=True,
-                                                           verbose=0)
-        callbacks.append(checkpoint_cb)
-
         save_freq = None  # 10
         if save_freq:
             weights_path = os.path.join(model_output_dir, "{epoch:03d}_epochs.h5")
@@ -869,11 +1026,13 @@ else:
                                                             verbose=1, period=save_freq)
             callbacks.append(weights_cb)
 
+        stateful_callbacks = {}
         reduce_lr_on_plateau = True
         if reduce_lr_on_plateau:
             reduce_lr_cb = tf.keras.callbacks.ReduceLROnPlateau(monitor='val_loss', factor=0.2,
                                                                 patience=5, min_lr=1e-8, verbose=1)
             callbacks.append(reduce_lr_cb)
+            stateful_callbacks['reduce_lr'] = reduce_lr_cb
 
         # Alternative from Geirhos et al. 
         # Set training schedule
@@ -906,24 +1065,94 @@ else:
         #                               use_multiprocessing=use_multiprocessing,
         #                               workers=workers)
 
-        # if resume_training:
-        #     initial_epoch = ...
-        # else:
-        #     initial_epoch = 0
-        history = model.fit(gen_train,
-                            epochs=epochs,
-                            # steps_per_epoch and steps_per_epoch are required due to a regression in TF 2.2
-                            # https://github.com/tensorflow/tensorflow/issues/37968
-                            # steps_per_epoch=gen_train.n//batch,
-                            steps_per_epoch=len(gen_train),
-                            callbacks=callbacks,
-                            validation_data=gen_valid,
-                            # validation_steps=gen_valid.n//batch,
-                            validation_steps=len(gen_valid),
-                            shuffle=True,
-                            max_queue_size=max_queue_size,
-                            workers=workers,
-                            use_multiprocessing=use_multiprocessing)
+        if cache_frontend:
+            # Train the back-end on the precomputed responses of the frozen front-end
+            assert use_initializer, "Caching the front-end requires --use_initializer!"
+            assert not augmentation, "Front-end responses cannot be cached with data augmentation!"
+            frontend, fit_model = utils.split_frontend(model)
+            fit_model.compile(loss='categorical_crossentropy', optimizer=opt, metrics=['acc'])
+
+            if load_images_from_disk:
+                frontend_sources = {}
+                for subset, subset_path in (("train", os.path.join(image_path, 'train')), 
+                                            ("valid", validation_image_path)):
+                    source = data_gen.flow_from_directory(subset_path, target_size=image_size, 
+                                                          color_mode=colour, batch_size=batch, 
+                                                          shuffle=False, follow_links=True, 
+                                                          interpolation=interpolation_names[interpolation])
+                    frontend_sources[subset] = (source, source.n)
+            elif lazy_upscaling:
+                frontend_sources = {
+                    "train": (get_upscaling_dataset(x_train_source, y_train, batch, image_size=image_size, 
+                                                    interpolation=interpolation, mean=mean, std=std), 
+                              len(y_train)),
+                    "valid": (get_upscaling_dataset(x_test_source, y_test, batch, image_size=image_size, 
+                                                    interpolation=interpolation, mean=mean, std=std), 
+                              len(y_test))}
+            elif stored:
+                frontend_sources = {
+                    "train": (get_dataset(x_train, y_train, batch, mean=mean, std=std), len(y_train)),
+                    "valid": (get_dataset(x_test, y_test, batch, mean=mean, std=std), len(y_test))}
+            else:
+                frontend_sources = {
+                    "train": (data_gen.flow(x_train, y=y_train, batch_size=batch, shuffle=False), len(y_train)),
+                    "valid": (data_gen.flow(x_test, y=y_test, batch_size=batch, shuffle=False), len(y_test))}
+
+            frontend_digest = hashlib.sha1(b''.join(w.tobytes() for w in frontend.get_weights())).hexdigest()
+            frontend_sequences = {}
+            for subset, (source, n_images) in frontend_sources.items():
+                feature_key = get_cache_key(frontend=frontend_digest, data_set=data_set, 
+                                            image_path=image_path, subset=subset, n_images=n_images,
+                                            interpolation=interpolation, colour=colour, 
+                                            image_mean=mean, image_std=std, quantise=quantise_frontend)
+                feature_path = os.path.join(frontend_cache_dir, f"{feature_key}.npy")
+                cached = load_features(feature_path)
+                if cached is None:
+                    print(f"Caching front-end responses to the {subset} images in {feature_path}...", flush=True)
+                    cached = cache_features(frontend, source, n_images, feature_path, 
+                                            quantise=quantise_frontend)
+                features, labels, scales = cached
+                frontend_sequences[subset] = FeatureSequence(features, labels, batch_size=batch, 
+                                                             scales=scales, shuffle=(subset == "train"), 
+                                                             seed=seed)
+            gen_train = frontend_sequences["train"]
+            gen_valid = frontend_sequences["valid"]
+            train_steps = len(gen_train)
+            valid_steps = len(gen_valid)
+        else:
+            fit_model = model
+
+        # Save the weights, optimizer state and epoch after every epoch and resume from the last
+        checkpoint_dir = os.path.join(model_output_dir, f"checkpoints_s{seed}")
+        if clean and os.path.isdir(checkpoint_dir):
+            shutil.rmtree(checkpoint_dir)
+        checkpoint_cb = utils.TrainingCheckpoint(checkpoint_dir, model, fit_model.optimizer, 
+                                                 callbacks=stateful_callbacks)
+        callbacks.append(checkpoint_cb)  # After the callbacks with state to restore
+        initial_epoch = checkpoint_cb.restore()
+        resume_training = initial_epoch > 0
+        if resume_training:
+            print(f"Resuming training of {mod} from epoch {initial_epoch}...", flush=True)
+        csv_logger_cb.append = resume_training
+
+        if initial_epoch < epochs:
+            history = fit_model.fit(gen_train,
+                                epochs=epochs,
+                                initial_epoch=initial_epoch,
+                                # steps_per_epoch and steps_per_epoch are required due to a regression in TF 2.2
+                                # https://github.com/tensorflow/tensorflow/issues/37968
+                                # steps_per_epoch=gen_train.n//batch,
+                                steps_per_epoch=train_steps,
+                                callbacks=callbacks,
+                                validation_data=gen_valid,
+                                # validation_steps=gen_valid.n//batch,
+                                validation_steps=valid_steps,
+                                shuffle=True,
+                                max_queue_size=max_queue_size,
+                                workers=workers,
+                                use_multiprocessing=use_multiprocessing)
+        else:  # Stopped after the last checkpoint but before the model was saved
+            print(f"Training of {mod} already completed {initial_epoch} epochs.", flush=True)
 
         if use_initializer:
             model.save_weights(f"{full_path_to_model}_weights.{extension}")  # weights only
@@ -934,8 +1163,14 @@ else:
             model.save(f"{full_path_to_model}.{extension}")  # Full model
         with open(os.path.join(model_output_dir, "simulation.json"), "w") as sf:
             json.dump(sim, sf, indent=4)
+        shutil.rmtree(checkpoint_dir)  # Superseded by the saved model
 
         learning_curves = os.path.join(logs_dir, f'{model_name}.png')  # f'{mod}_train_CIFAR10_{trial}.png')
+        if resume_training:
+            # The history only covers the epochs since resuming so plot the whole log
+            log = pd.read_csv(csv_logger_cb.filename).drop_duplicates('epoch', keep='last')
+            history = tf.keras.callbacks.History()
+            history.history = log.drop(columns='epoch').to_dict('list')
         plots.plot_history(history, chance=1/n_classes, filename=learning_curves)
 
         t_elapsed = time.time() - t0
@@ -981,67 +1216,106 @@ if test_generalisation:
         inversions = [False]
 
     results_file = os.path.join(sim_results_dir, "metrics", f"{model_name}_generalise_s{seed}.csv")
-    with open(results_file, 'w') as results:
-        writer = csv.DictWriter(results, fieldnames=generalisation_columns)
-        writer.writeheader()
+    metrics_writer = MetricsWriter(results_file, generalisation_columns,
+                                   store=os.path.join(metrics_store, "generalise.csv") if metrics_store else None)
+
+try:
+    # if test_image_path and os.path.isdir(test_image_path):
+    for test_set in test_sets:
+        generalisation_image_path = os.path.join(data_dir, "CIFAR-10G", f"{image_size[0]}x{image_size[1]}", test_set)
+        assert os.path.isdir(generalisation_image_path)
+
+        for invert in inversions:
+            print(f"Testing {model_name} with images from {generalisation_image_path}{' (inverted)' if invert else ''}...", flush=True)
+            t0 = time.time()
+            # rng = np.random.RandomState(seed=seed)
+
+            full_set_name = f"{test_set}{'_inverted' if invert else ''}"
+            # NOTE: Generalisation test images are already in [0, 1] so do not rescale before preprocessing
+    #         if test_set in ['scharr']:
+    #             rescale = 1/255
+    #         else:
+    #             rescale = 1/255  # 1
+            rescale = 1/255
+
+            # Old method: create inverted images on the fly
+    #         if invert:
+    #             # prep_image = cifar_wrapper(functools.partial(invert_luminance, level=1),
+    #             #                            rescale=rescale)
+    #             prep_image = get_noise_preprocessor("Invert", invert_luminance, level=1, rescale=rescale)
+    #         else:
+    #             # prep_image = cifar_wrapper(sanity_check, rescale=rescale)
+    #             prep_image = get_noise_preprocessor("None", rescale=rescale)
+
+            # New method: use the same preprocessor and load pre-inverted images
+            prep_image = get_noise_preprocessor("None", rescale=rescale)  # The default is rescale=1/255
+            if invert:
+                generalisation_image_path = f"{generalisation_image_path}_inverted"
+                assert os.path.isdir(generalisation_image_path)
+
+            data_gen = ImageDataGenerator(# rescale=255,
+                                          preprocessing_function=prep_image,
+                                          featurewise_center=True, 
+                                          featurewise_std_normalization=True)
+
+            # data_gen.fit(x_train)  # Set mean and std
+    #         if invert:
+    #             data_gen.mean = 255 - mean
+    #             data_gen.std = std
+    #         else:
+    #             data_gen.mean = mean
+    #             data_gen.std = std
+            data_gen.mean = mean
+            data_gen.std = std
+
+            if save_images:
+                generalisation_image_out_dir = os.path.join(image_out_dir, full_set_name)
+                os.makedirs(generalisation_image_out_dir, exist_ok=True)
+                generalisation_prefix = ''
+            else:
+                generalisation_image_out_dir = None
+                generalisation_prefix = ''
 
-# if test_image_path and os.path.isdir(test_image_path):
-for test_set in test_sets:
-    generalisation_image_path = os.path.join(data_dir, "CIFAR-10G", f"{image_size[0]}x{image_size[1]}", test_set)
-    assert os.path.isdir(generalisation_image_path)
-
-    for invert in inversions:
-        print(f"Testing {model_name} with images from {generalisation_image_path}{' (inverted)' if invert else ''}...", flush=True)
-        t0 = time.time()
-        # rng = np.random.RandomState(seed=seed)
-
-        full_set_name = f"{test_set}{'_inverted' if invert else ''}"
-        # NOTE: Generalisation test images are already in [0, 1] so do not rescale before preprocessing
-#         if test_set in ['scharr']:
-#             rescale = 1/255
-#         else:
-#             rescale = 1/255  # 1
-        rescale = 1/255
-
-        # Old method: create inverted images on the fly
-#         if invert:
-#             # prep_image = cifar_wrapper(functools.partial(invert_luminance, level=1),
-#             #                            rescale=rescale)
-#             prep_image = get_noise_preprocessor("Invert", invert_luminance, level=1, rescale=rescale)
-#         else:
-#             # prep_image = cifar_wrapper(sanity_check, rescale=rescale)
-#             prep_image = get_noise_preprocessor("None", rescale=rescale)
-
-        # New method: use the same preprocessor and load pre-inverted images
-        prep_image = get_noise_preprocessor("None", rescale=rescale)  # The default is rescale=1/255
-        if invert:
-            generalisation_image_path = f"{generalisation_image_path}_inverted"
-            assert os.path.isdir(generalisation_image_path)
-
-        data_gen = ImageDataGenerator(# rescale=255,
-                                      preprocessing_function=prep_image,
-                                      featurewise_center=True, 
-                                      featurewise_std_normalization=True)
-
-        # data_gen.fit(x_train)  # Set mean and std
-#         if invert:
-#             data_gen.mean = 255 - mean
-#             data_gen.std = std
-#         else:
-#             data_gen.mean = mean
-#             data_gen.std = std
-        data_gen.mean = mean
-        data_gen.std = std
+            gen_test = data_gen.flow_from_directory(generalisation_image_path,
+                                                    target_size=image_size,
+                                                    color_mode=colour,
+                                                    batch_size=batch,
+                                                    shuffle=False, seed=seed,
+                                                    interpolation=interpolation_names[interpolation],
+                                                    save_to_dir=generalisation_image_out_dir, 
+                                                    save_prefix=generalisation_prefix)
 
-        if save_images:
-            generalisation_image_out_dir = os.path.join(image_out_dir, full_set_name)
-            os.makedirs(generalisation_image_out_dir, exist_ok=True)
-            generalisation_prefix = ''
-        else:
-            generalisation_image_out_dir = None
-            generalisation_prefix = ''
+            n_images_per_class = 10
+            n_images = n_images_per_class * n_classes
+            y_generalise = np.repeat(range(n_classes), n_images_per_class)
 
-        gen_test = data_gen.flow_from_directory(generalisation_image_path,
+            if single_pass:
+                predictions = model.predict(gen_test, 
+                                            verbose=1,
+                                            steps=len(gen_test),
+                                            max_queue_size=max_queue_size,
+                                            workers=workers,
+                                            use_multiprocessing=use_multiprocessing)
+                loss, accuracy, classifications = calculate_metrics(predictions, y_generalise)
+                metrics = [loss, accuracy]
+            else:
+                metrics = model.evaluate(gen_test, 
+                                         steps=len(gen_test),
+                                         verbose=1,
+                                         max_queue_size=max_queue_size,
+                                         workers=workers,
+                                         use_multiprocessing=use_multiprocessing)
+
+            if train:
+                metrics_dict = {metric: score for metric, score in zip(model.metrics_names, metrics)}
+                print(f"Evaluation results: {metrics_dict}")
+            else:
+                print(f"Evaluation results: {metrics}")
+
+            if save_predictions:  # Get classification probabilities
+                if not single_pass:
+                    # Reinitialise iterator
+                    gen_test = data_gen.flow_from_directory(generalisation_image_path,
                                                 target_size=image_size,
                                                 color_mode=colour,
                                                 batch_size=batch,
@@ -1050,105 +1324,68 @@ for test_set in test_sets:
                                                 save_to_dir=generalisation_image_out_dir, 
                                                 save_prefix=generalisation_prefix)
 
-        metrics = model.evaluate(gen_test, 
-                                 steps=len(gen_test),
-                                 verbose=1,
-                                 max_queue_size=max_queue_size,
-                                 workers=workers,
-                                 use_multiprocessing=use_multiprocessing)
-
-
-        if train:
-            metrics_dict = {metric: score for metric, score in zip(model.metrics_names, metrics)}
-            print(f"Evaluation results: {metrics_dict}")
-        else:
-            print(f"Evaluation results: {metrics}")
-
-        if save_predictions:  # Get classification probabilities
-            # Reinitialise iterator
-            gen_test = data_gen.flow_from_directory(generalisation_image_path,
-                                        target_size=image_size,
-                                        color_mode=colour,
-                                        batch_size=batch,
-                                        shuffle=False, seed=seed,
-                                        interpolation=interpolation_names[interpolation],
-                                        save_to_dir=generalisation_image_out_dir, 
-                                        save_prefix=generalisation_prefix)
-
-            predictions = model.predict(gen_test, 
-                                        verbose=1,
-                                        # steps=gen_test.n//batch,  # BAD: This skips the remainder of images
-                                        steps=len(gen_test),
-                                        max_queue_size=max_queue_size,
-                                        workers=workers,
-                                        use_multiprocessing=use_multiprocessing)
-            # print(predictions.shape)  # (n_images, n_classes)
-            file_name = f"{model_name}_generalise_{full_set_name}_s{seed}.csv"
-            predictions_file = os.path.join(sim_results_dir, 'predictions', file_name)
-
-#             np.savetxt(predictions_file, predictions, delimiter=',', 
-#                        header=','.join([f'p(class={c})' for c in classes]))
-
-            n_images_per_class = 10
-            n_images = n_images_per_class * n_classes
-            y_generalise = np.repeat(range(n_classes), n_images_per_class)
-            classifications = np.argmax(predictions, axis=1)
-
-#             loss = categorical_crossentropy(to_categorical(y_generalise, num_classes=n_classes, dtype='uint8'), predictions)
-#             loss = np.sum(loss.numpy())
-#             assert np.isclose(loss, metrics[0]), f"Loss: Calculated: {loss} =/= Recorded: {metrics[0]}"
-            # Check accuracy based on probabilities matches accuracy from .evaluate
-            assert len(classifications) == len(y_generalise)
-            accuracy = sum(classifications == y_generalise) / len(y_generalise)
-#             cat_acc = categorical_accuracy(y_generalise, classifications).numpy()
-#             assert np.isclose(accuracy, cat_acc), f"Calculated: {accuracy} =/= Library: {cat_acc}"
-            assert np.isclose(accuracy, metrics[1], atol=0.001), f"Calculated: {accuracy} =/= Evaluated: {metrics[1]}"
-#             if not np.isclose(accuracy, metrics[1], atol=0.001):  # 1/(2*n_images)
-#                 print(f"Calculated: {accuracy} =/= Evaluated: {metrics[1]}")
-
-            # Put predictions into DataFrame
-            df_gen = pd.DataFrame(predictions, columns=classes)
-            df_gen["Predicted"] = classifications
-            df_gen["Class"] = y_generalise
-            df_gen["Correct"] = classifications == y_generalise
-            df_gen["Image"] = range(n_images)
-            df_gen["Set"] = [full_set_name] * n_images
-            df_gen["Type"] = [test_set] * n_images
-            df_gen["Inverted"] = [invert] * n_images
-
-#             frames.append(df_gen)
-            df_gen.to_csv(predictions_file, index=False)
-
-            if verbose:
-                print(f'Predictions written to: {predictions_file}')
-            del predictions
-
-        if save_predictions:
-            # Manual calculation is more accurate, probably due to rounding errors
-            # However, the results are the same for dtype=float16 rounded to 7 d.p.
-            acc = accuracy
-        else:
-            acc = metrics[1]
-        # generalisation_columns = ['Model', 'Convolution', 'Base', 'Weights', 'Trial', 'Seed',
-        #                           'Set', 'Type', 'Inverted', 'Loss', 'Accuracy']
-
-        row = {'Model': mod, 'Convolution': convolution, 'Base': base,
-               'Weights': str(weights), 'Trial': trial, 'Seed': seed,
-               'Set': full_set_name, 'Type': test_set, 'Inverted': invert,
-               'Loss': metrics[0], 'Accuracy': acc}
-        with open(results_file, 'a') as results:
-            writer = csv.DictWriter(results, fieldnames=generalisation_columns)
-            writer.writerow(row)
-
-        t_elapsed = time.time() - t0
-        print(f"Testing {test_set}{' (inverted)' if invert else ''} images finished! [{t_elapsed:.3f}s]", flush=True)
-        print("-" * 80)
-
-        # Clean up
-        del data_gen
-        gc.collect()
-
-    print('Generalisation testing finished!')
+                    predictions = model.predict(gen_test, 
+                                                verbose=1,
+                                                # steps=gen_test.n//batch,  # BAD: This skips the remainder of images
+                                                steps=len(gen_test),
+                                                max_queue_size=max_queue_size,
+                                                workers=workers,
+                                                use_multiprocessing=use_multiprocessing)
+                # print(predictions.shape)  # (n_images, n_classes)
+                classifications = np.argmax(predictions, axis=1)
+
+    #             loss = categorical_crossentropy(to_categorical(y_generalise, num_classes=n_classes, dtype='uint8'), predictions)
+    #             loss = np.sum(loss.numpy())
+    #             assert np.isclose(loss, metrics[0]), f"Loss: Calculated: {loss} =/= Recorded: {metrics[0]}"
+                # Check accuracy based on probabilities matches accuracy from .evaluate
+                assert len(classifications) == len(y_generalise)
+                accuracy = sum(classifications == y_generalise) / len(y_generalise)
+    #             cat_acc = categorical_accuracy(y_generalise, classifications).numpy()
+    #             assert np.isclose(accuracy, cat_acc), f"Calculated: {accuracy} =/= Library: {cat_acc}"
+                assert np.isclose(accuracy, metrics[1], atol=0.001), f"Calculated: {accuracy} =/= Evaluated: {metrics[1]}"
+    #             if not np.isclose(accuracy, metrics[1], atol=0.001):  # 1/(2*n_images)
+    #                 print(f"Calculated: {accuracy} =/= Evaluated: {metrics[1]}")
+
+                predictions_file = write_predictions(os.path.join(sim_results_dir, 'predictions', 'generalise'),
+                                                     {'Model': mod, 'Trial': trial, 'Seed': seed,
+                                                      'Set': full_set_name},
+                                                     predictions, y_generalise,
+                                                     columns={'Type': test_set, 'Inverted': invert})
+
+                if verbose:
+                    print(f'Predictions written to: {predictions_file}')
+
+            if save_predictions or single_pass:
+                # Manual calculation is more accurate, probably due to rounding errors
+                # However, the results are the same for dtype=float16 rounded to 7 d.p.
+                acc = accuracy
+                del predictions
+            else:
+                acc = metrics[1]
+            # generalisation_columns = ['Model', 'Convolution', 'Base', 'Weights', 'Trial', 'Seed',
+            #                           'Set', 'Type', 'Inverted', 'Loss', 'Accuracy']
+
+            row = {'Model': mod, 'Convolution': convolution, 'Base': base,
+                   'Weights': str(weights), 'Trial': trial, 'Seed': seed,
+                   'Set': full_set_name, 'Type': test_set, 'Inverted': invert,
+                   'Loss': metrics[0], 'Accuracy': acc}
+            metrics_writer.writerow(row)
+
+            t_elapsed = time.time() - t0
+            print(f"Testing {test_set}{' (inverted)' if invert else ''} images finished! [{t_elapsed:.3f}s]", flush=True)
+            print("-" * 80)
+
+            # Clean up
+            del data_gen
+            gc.collect()
+
+        print('Generalisation testing finished!')
+except BaseException:
+    if test_generalisation:
+        metrics_writer.abort()  # Do not leave a partial results file
+    raise
+if test_generalisation:
+    metrics_writer.close()
 if not len(test_sets):
     print('Generalisation testing skipped!')
 print("=" * 80)
@@ -1164,12 +1401,6 @@ if not test_perturbations:
     sys.exit()
 
 
-ver_num = [int(x, 10) for x in tf.__version__.split('.')]
-if (ver_num[0] >= 2) and (ver_num[1] > 2) and True:
-    print("Setting default dtype to float16")
-    tf.keras.backend.set_floatx('float16')  # Set default dtype to 16 bit
-
-
 # Test perturbation images
 
 # Test on perturbed test images
@@ -1179,6 +1410,50 @@ if test_perturbations and (not os.path.isfile(results_file) or clean):
     test_noise_perturbations(model, sim, noise_types, sim_results_dir=sim_results_dir, 
                              test_set=test_set, test_images_path=test_images_path, x_test=x_test, y_test=y_test)
 
+# Test a low-rank separable approximation of the front-end on the perturbed test images
+if low_rank_tolerance:
+    lowrank_sim = {**sim, 'model': f"{mod}_lowrank"}
+    lowrank_results_file = os.path.join(sim_results_dir, "metrics", 
+                                        f"{mod}_lowrank_{trial}_perturb_{test_set.lower()}_s{seed}.csv")
+    if not os.path.isfile(lowrank_results_file) or clean:
+        lowrank_model = utils.approximate_frontend(model, low_rank_tolerance, verbose=verbose)
+        lowrank_model.compile(loss='categorical_crossentropy', metrics=['acc'])
+        test_noise_perturbations(lowrank_model, lowrank_sim, noise_types, sim_results_dir=sim_results_dir,
+                                 test_set=test_set, test_images_path=test_images_path, 
+                                 x_test=x_test, y_test=y_test)
+        del lowrank_model
+    if os.path.isfile(results_file):
+        # Report the accuracy impact of the approximation for each perturbation
+        compare_perturbation_results(results_file, lowrank_results_file, 
+                                     label=f"the low-rank front-end (tolerance={low_rank_tolerance})")
+
+# Test an int8 quantised (TensorFlow Lite) model on the perturbed test images (on CPU)
+if quantise_int8:
+    int8_sim = {**sim, 'model': f"{mod}_int8"}
+    int8_results_file = os.path.join(sim_results_dir, "metrics", 
+                                     f"{mod}_int8_{trial}_perturb_{test_set.lower()}_s{seed}.csv")
+    int8_model_file = f"{full_path_to_model}_int8.tflite"
+    if not os.path.isfile(int8_model_file) or clean:
+        print(f"Exporting {model_name} to an int8 quantised model: {int8_model_file}...", flush=True)
+        if load_images_from_disk:
+            train_files, _ = list_image_files(os.path.join(image_path, 'train'))
+            rng = np.random.RandomState(seed=seed)
+            calibration_images = load_image_batch(rng.choice(train_files, size=min(200, len(train_files)), 
+                                                             replace=False), 
+                                                  image_size=image_size, colour=colour,
+                                                  interpolation=interpolation_names[interpolation])
+        else:
+            calibration_images = x_train
+        representative_dataset = get_representative_dataset(calibration_images, mean, std, seed=seed)
+        export_int8_model(model, int8_model_file, representative_dataset)
+    if not os.path.isfile(int8_results_file) or clean:
+        # The TensorFlow Lite interpreter runs on the CPU
+        test_noise_perturbations(QuantisedModel(int8_model_file), int8_sim, noise_types, 
+                                 sim_results_dir=sim_results_dir, test_set=test_set, 
+                                 test_images_path=test_images_path, x_test=x_test, y_test=y_test)
+    if os.path.isfile(results_file):
+        compare_perturbation_results(results_file, int8_results_file, label="int8 quantisation")
+
     
 # Test on perturbed generalisation images
 for test_set in generalisation_sets:
@@ -37,13 +37,32 @@ internal_noise = 0
 skip_test = False
 save_images = False
 save_predictions = True
+single_pass = True
+vectorise_perturbations = True
+seed_per_image = False  # Per-image noise streams (a different noise realisation to the reference "paper" results)
+cache_perturbations = False  # Reuse perturbed test images across models (2 GB per level on disk)
+dataset_store = True
+lazy_upscaling = False
+tf_data = False  # Train with the tf.data pipeline (otherwise the ImageDataGenerator)
+cache_frontend = False  # Train on precomputed front-end responses (requires no augmentation)
+quantise_frontend = False
+separable_kernels = True  # Convolve Low-pass and DoG kernels with 1-D passes
+mixed_precision = False  # Train and test with float16 (GPU) or bfloat16 (CPU) computation
+quantise_int8 = False  # Also test an int8 quantised (TensorFlow Lite) model on CPU
+low_rank_tolerance = 0  # Also test a low-rank approximation of the front-end (e.g. 0.01)
+metrics_store = os.path.join(project_root_dir, "results", label, "sweep")  # Shared metrics of all runs ('' disables)
 test_generalisation = True
 test_perturbations = True
 interpolation = 4  # Lanczos
+fft_threshold = 31  # Front-end kernel size from which to convolve with FFTs (0 disables)
 recalculate_statistics = False
 verbose = 0
 halt_on_error = False
+in_process = True  # Run all configurations in this process (sharing the loaded data and caches)
 gpu = 0
+schedule = False  # Run configurations concurrently on several devices (overrides in_process)
+scheduler_gpus = [gpu]  # GPUs to schedule jobs on (empty to use slices of the CPU cores)
+n_workers = 1  # Concurrent jobs per GPU (or the number of CPU slices)
 ######################################
 script = os.path.join(project_root_dir, "model.py")
 flags = ['--log']
@@ -63,6 +82,30 @@ if recalculate_statistics:
     flags.append('--recalculate_statistics')
 if save_predictions:
     flags.append('--save_predictions')
+if single_pass:
+    flags.append('--single_pass')
+if vectorise_perturbations:
+    flags.append('--vectorise_perturbations')
+if seed_per_image:
+    flags.append('--seed_per_image')
+if cache_perturbations:
+    flags.append('--cache_perturbations')
+if dataset_store:
+    flags.append('--dataset_store')
+if lazy_upscaling:
+    flags.append('--lazy_upscaling')
+if tf_data:
+    flags.append('--tf_data')
+if cache_frontend:
+    flags.append('--cache_frontend')
+if quantise_frontend:
+    flags.append('--quantise_frontend')
+if separable_kernels:
+    flags.append('--separable_kernels')
+if mixed_precision:
+    flags.append('--mixed_precision')
+if quantise_int8:
+    flags.append('--quantise_int8')
 optional_args = []
 if image_path:
     optional_args.extend(['--image_path', str(image_path)])
@@ -76,9 +119,21 @@ if internal_noise:
     optional_args.extend(['--internal_noise', str(internal_noise)])
 if interpolation:
     optional_args.extend(['--interpolation', str(interpolation)])
+if fft_threshold is not None:
+    optional_args.extend(['--fft_threshold', str(fft_threshold)])
+if low_rank_tolerance:
+    optional_args.extend(['--low_rank_tolerance', str(low_rank_tolerance)])
+if metrics_store:
+    optional_args.extend(['--metrics_store', str(metrics_store)])
 if verbose:
     optional_args.extend(['--verbose', str(verbose)])
+if schedule:
+    from bionet.scheduler import SweepScheduler, get_slots
+    in_process = False
+elif in_process:
+    from bionet.sweep import run_sweep
 count = 1
+configurations = []
 for trial in tqdm(trials, desc='Trial'):
     if seed is None:
         seed = random.randrange(2**32)
@@ -92,9 +147,23 @@ for trial in tqdm(trials, desc='Trial'):
                         '--optimizer', optimizer, '--lr', str(lr),
                         '--epochs', str(epochs), '--gpu', str(gpu)])
             cmd.extend(optional_args)
-            completed = subprocess.run(cmd, shell=False, capture_output=True, text=True)
-            if completed.returncode != 0:
-                print(completed.stdout)
-                print(completed.stderr)
+            if schedule or in_process:
+                configurations.append(cmd[1:])
+            else:
+                completed = subprocess.run(cmd, shell=False, capture_output=True, text=True)
+                if completed.returncode != 0:
+                    print(completed.stdout)
+                    print(completed.stderr)
             count += 1
-f'Finished job "{label}"!'
\ No newline at end of file
+if schedule:
+    if scheduler_gpus:
+        slots = get_slots(gpus=scheduler_gpus, workers_per_gpu=n_workers)
+    else:
+        slots = get_slots(n_workers=n_workers)
+    state_file = os.path.join(project_root_dir, "logs", f"sweep_{label}.json")
+    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    scheduler = SweepScheduler(script, slots, state_file)
+    jobs = scheduler.run(configurations)
+elif in_process:
+    failures = run_sweep(script, configurations, halt_on_error=halt_on_error)
+f'Finished job "{label}"!'